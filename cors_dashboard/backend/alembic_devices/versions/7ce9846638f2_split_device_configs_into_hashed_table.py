@@ -0,0 +1,123 @@
+"""Split device configs into content-hashed table
+
+Revision ID: 7ce9846638f2
+Revises: 765ea0a2347c
+Create Date: 2026-10-19 09:12:41.208317
+
+"""
+from typing import Sequence, Union
+import hashlib
+import json
+import time
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7ce9846638f2'
+down_revision: Union[str, Sequence[str], None] = '765ea0a2347c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+CONFIG_FIELDS = ('base_config', 'service_config', 'ntrip_status')
+HISTORY_FIELDS = ('base_config', 'service_config')
+
+
+def _config_hash(content) -> str | None:
+    # Phải giống hệt crud.compute_config_hash
+    if not content:
+        return None
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _load_json(value):
+    if value is None or isinstance(value, dict):
+        return value
+    return json.loads(value)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('device_configs',
+    sa.Column('hash', sa.String(length=64), nullable=False),
+    sa.Column('content', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('hash')
+    )
+    op.create_table('device_config_history',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('serial', sa.String(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('config_hash', sa.String(length=64), nullable=True),
+    sa.Column('changed_at', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['config_hash'], ['device_configs.hash'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_config_history_serial_kind', 'device_config_history', ['serial', 'kind', 'changed_at'], unique=False)
+
+    with op.batch_alter_table('devices') as batch_op:
+        for field in CONFIG_FIELDS:
+            batch_op.add_column(sa.Column(f'{field}_hash', sa.String(length=64), nullable=True))
+
+    # --- Chuyển dữ liệu JSON hiện có sang device_configs ---
+    conn = op.get_bind()
+    now = int(time.time())
+    configs = {}
+    rows = conn.execute(sa.text(
+        "SELECT serial, base_config, service_config, ntrip_status FROM devices"
+    )).mappings().all()
+    for row in rows:
+        hashes = {}
+        for field in CONFIG_FIELDS:
+            content = _load_json(row[field])
+            config_hash = _config_hash(content)
+            hashes[f'{field}_hash'] = config_hash
+            if config_hash:
+                configs[config_hash] = content
+                if field in HISTORY_FIELDS:
+                    conn.execute(
+                        sa.text("INSERT INTO device_config_history (serial, kind, config_hash, changed_at) "
+                                "VALUES (:serial, :kind, :hash, :now)"),
+                        {"serial": row['serial'], "kind": field, "hash": config_hash, "now": now}
+                    )
+        conn.execute(
+            sa.text("UPDATE devices SET base_config_hash = :base_config_hash, "
+                    "service_config_hash = :service_config_hash, ntrip_status_hash = :ntrip_status_hash "
+                    "WHERE serial = :serial"),
+            {**hashes, "serial": row['serial']}
+        )
+    for config_hash, content in configs.items():
+        conn.execute(
+            sa.text("INSERT INTO device_configs (hash, content, created_at) VALUES (:hash, :content, :now)"),
+            {"hash": config_hash, "content": json.dumps(content, ensure_ascii=False), "now": now}
+        )
+
+    with op.batch_alter_table('devices') as batch_op:
+        for field in CONFIG_FIELDS:
+            batch_op.create_foreign_key(f'fk_devices_{field}_hash', 'device_configs', [f'{field}_hash'], ['hash'])
+            batch_op.drop_column(field)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.add_column(sa.Column('base_config', sa.JSON(), nullable=True))
+        batch_op.add_column(sa.Column('service_config', sa.JSON(), nullable=True))
+        batch_op.add_column(sa.Column('ntrip_status', sa.JSON(), nullable=True))
+
+    conn = op.get_bind()
+    for field in CONFIG_FIELDS:
+        conn.execute(sa.text(
+            f"UPDATE devices SET {field} = (SELECT content FROM device_configs WHERE hash = devices.{field}_hash)"
+        ))
+
+    with op.batch_alter_table('devices') as batch_op:
+        for field in CONFIG_FIELDS:
+            batch_op.drop_constraint(f'fk_devices_{field}_hash', type_='foreignkey')
+            batch_op.drop_column(f'{field}_hash')
+
+    op.drop_index('ix_config_history_serial_kind', table_name='device_config_history')
+    op.drop_table('device_config_history')
+    op.drop_table('device_configs')
@@ -0,0 +1,79 @@
+"""Move ntrip_status back to a JSON column on devices
+
+Revision ID: b3f1c2d4e5a6
+Revises: 7ce9846638f2
+Create Date: 2026-10-19 11:02:17.514209
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3f1c2d4e5a6'
+down_revision: Union[str, Sequence[str], None] = '7ce9846638f2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Các dòng device_configs còn được tham chiếu sau khi bỏ ntrip_status_hash
+_UNREFERENCED = (
+    "DELETE FROM device_configs WHERE hash NOT IN ("
+    "SELECT base_config_hash FROM devices WHERE base_config_hash IS NOT NULL "
+    "UNION SELECT service_config_hash FROM devices WHERE service_config_hash IS NOT NULL "
+    "UNION SELECT config_hash FROM device_config_history WHERE config_hash IS NOT NULL)"
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # ntrip_status là trạng thái runtime: mỗi giá trị khác nhau từng tạo một dòng device_configs
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.add_column(sa.Column('ntrip_status', sa.JSON(), nullable=True))
+
+    conn = op.get_bind()
+    conn.execute(sa.text(
+        "UPDATE devices SET ntrip_status = (SELECT content FROM device_configs WHERE hash = devices.ntrip_status_hash)"
+    ))
+
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.drop_constraint('fk_devices_ntrip_status_hash', type_='foreignkey')
+        batch_op.drop_column('ntrip_status_hash')
+
+    conn.execute(sa.text(_UNREFERENCED))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.add_column(sa.Column('ntrip_status_hash', sa.String(length=64), nullable=True))
+
+    # Băm lại ntrip_status giống crud.compute_config_hash
+    import hashlib
+    import json
+    import time
+
+    conn = op.get_bind()
+    now = int(time.time())
+    rows = conn.execute(sa.text("SELECT serial, ntrip_status FROM devices")).mappings().all()
+    for row in rows:
+        content = row['ntrip_status']
+        if isinstance(content, str):
+            content = json.loads(content)
+        if not content:
+            continue
+        canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        config_hash = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+        conn.execute(
+            sa.text("INSERT OR IGNORE INTO device_configs (hash, content, created_at) VALUES (:hash, :content, :now)"),
+            {"hash": config_hash, "content": json.dumps(content, ensure_ascii=False), "now": now}
+        )
+        conn.execute(
+            sa.text("UPDATE devices SET ntrip_status_hash = :hash WHERE serial = :serial"),
+            {"hash": config_hash, "serial": row['serial']}
+        )
+
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.create_foreign_key('fk_devices_ntrip_status_hash', 'device_configs', ['ntrip_status_hash'], ['hash'])
+        batch_op.drop_column('ntrip_status')
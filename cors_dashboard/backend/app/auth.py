@@ -8,15 +8,18 @@ from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi.concurrency import run_in_threadpool
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import logging
 import os
+import time
 
 from . import models, crud
-from .database import get_auth_db
+from .database import AsyncAuthSession, settings
+from .shared_memory import SharedEpoch
+from .monitoring import RateLimiter
+from .metrics import PASSWORD_HASH_QUEUE_WAIT, PASSWORD_HASH_DURATION
 
 logger = logging.getLogger(__name__)
 
@@ -30,27 +33,75 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=12)
 security = HTTPBearer()
 
-class SimpleRateLimiter:
-    def __init__(self, max_requests: int = 5, window_seconds: int = 300):
-        self.max_requests = max_requests
-        self.window = timedelta(seconds=window_seconds)
-        self.requests = defaultdict(list)
-        self.lock = asyncio.Lock()
-    
-    async def is_rate_limited(self, identifier: str) -> bool:
-        async with self.lock:
-            now = datetime.now()
-            self.requests[identifier] = [t for t in self.requests[identifier] if now - t < self.window]
-            if len(self.requests[identifier]) >= self.max_requests:
-                return True
-            self.requests[identifier].append(now)
-            return False
-
-login_rate_limiter = SimpleRateLimiter(max_requests=5, window_seconds=300)
+class PasswordHasher:
+    """
+    Executor riêng cho bcrypt, tách khỏi threadpool mặc định của Starlette.
+    Khi số yêu cầu đang chờ + đang chạy vượt `max_pending`, yêu cầu mới bị từ chối
+    với 503 thay vì xếp hàng vô hạn (vd. khi bị credential stuffing).
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._pending = 0
+        self._dummy_hash = None
+        self.rejected = 0
+
+    async def run(self, func, *args, shed: bool = True):
+        if shed and self._pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Hệ thống đang bận xử lý xác thực. Vui lòng thử lại sau.",
+                headers={"Retry-After": "1"}
+            )
+
+        def timed_call():
+            started = time.perf_counter()
+            try:
+                return func(*args), None, started, time.perf_counter()
+            except Exception as e:
+                return None, e, started, time.perf_counter()
+
+        self._pending += 1
+        submitted = time.perf_counter()
+        try:
+            result, error, started, finished = await asyncio.get_running_loop().run_in_executor(self._executor, timed_call)
+        finally:
+            self._pending -= 1
+        PASSWORD_HASH_QUEUE_WAIT.observe(started - submitted)
+        PASSWORD_HASH_DURATION.observe(finished - started)
+        if error is not None:
+            raise error
+        return result
+
+    async def dummy_hash(self) -> str:
+        """Hash giả (tính một lần) để verify khi username không tồn tại, chống timing attack."""
+        if self._dummy_hash is None:
+            self._dummy_hash = await self.run(pwd_context.hash, "dummy-password-for-timing", shed=False)
+        return self._dummy_hash
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+password_hasher = PasswordHasher(
+    max_workers=settings.PASSWORD_HASH_WORKERS, max_pending=settings.PASSWORD_HASH_MAX_PENDING
+)
+
+login_rate_limiter = RateLimiter("login", max_requests=5, window_seconds=300)
 
 async def check_login_rate_limit(request: Request):
     client_ip = request.client.host
-    if await login_rate_limiter.is_rate_limited(client_ip):
+    if not login_rate_limiter.is_allowed(client_ip):
         logger.warning(f"Rate limit exceeded for IP: {client_ip}")
         raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Quá nhiều lần đăng nhập thất bại. Vui lòng thử lại sau 5 phút.")
 
@@ -64,7 +115,7 @@ class PasswordPolicy:
         return True, ""
 
 class Role: ADMIN, VIEWER, COORDINATOR = "admin", "viewer", "coordinator"
-class Permission: VIEW_DEVICES, VIEW_CONFIG, EDIT_DEVICE_NAME, EDIT_COORDINATES, EDIT_CHIP_CONFIG, EDIT_SERVICE_CONFIG, MANAGE_LICENSE, DELETE_DEVICE, MANAGE_USERS, EXPORT_DATA = "view:devices", "view:config", "edit:device_name", "edit:coordinates", "edit:chip_config", "edit:service_config", "manage:license", "delete:device", "manage:users", "export:data"
+class Permission: VIEW_DEVICES, VIEW_CONFIG, EDIT_DEVICE_NAME, EDIT_COORDINATES, EDIT_CHIP_CONFIG, EDIT_SERVICE_CONFIG, MANAGE_LICENSE, DELETE_DEVICE, MANAGE_USERS, EXPORT_DATA, VIEW_DIAGNOSTICS, MANAGE_DIAGNOSTICS = "view:devices", "view:config", "edit:device_name", "edit:coordinates", "edit:chip_config", "edit:service_config", "manage:license", "delete:device", "manage:users", "export:data", "view:diagnostics", "manage:diagnostics"
 
 ROLE_PERMISSIONS = {
     Role.ADMIN: [
@@ -73,6 +124,7 @@ ROLE_PERMISSIONS = {
         Permission.EDIT_CHIP_CONFIG, Permission.EDIT_SERVICE_CONFIG,
         Permission.MANAGE_LICENSE, Permission.DELETE_DEVICE,
         Permission.MANAGE_USERS, Permission.EXPORT_DATA,
+        Permission.VIEW_DIAGNOSTICS, Permission.MANAGE_DIAGNOSTICS,
     ],
     Role.COORDINATOR: [
         Permission.VIEW_DEVICES, Permission.VIEW_CONFIG,
@@ -82,14 +134,90 @@ ROLE_PERMISSIONS = {
         Permission.VIEW_DEVICES, Permission.VIEW_CONFIG,
     ],
 }
+ROLE_PERMISSION_SETS = {role: frozenset(perms) for role, perms in ROLE_PERMISSIONS.items()}
+
+class AuthenticatedUser:
+    """
+    Bản chụp (snapshot) của user đã xác thực, độc lập với session DB để có thể cache
+    và dùng chung giữa các request. Có cùng thuộc tính với models.User.
+    """
+    __slots__ = ("id", "username", "full_name", "role", "is_active", "created_at", "permissions")
+
+    def __init__(self, user: models.User):
+        self.id = user.id
+        self.username = user.username
+        self.full_name = user.full_name
+        self.role = user.role
+        self.is_active = user.is_active
+        self.created_at = user.created_at
+        self.permissions = ROLE_PERMISSION_SETS.get(user.role, frozenset())
+
+class PrincipalCache:
+    """
+    Cache LRU có TTL: token đã verify -> AuthenticatedUser.
+    Mục cache hết hạn sớm hơn giữa TTL và `exp` của token. Khi user bị sửa/xóa ở bất kỳ
+    worker nào, epoch dùng chung thay đổi và mọi worker xóa cache ở lần đọc kế tiếp.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int, epoch: SharedEpoch):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._epoch = epoch
+        self._seen_epoch = epoch.read()
+        self._entries: OrderedDict[str, tuple[float, AuthenticatedUser]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> AuthenticatedUser | None:
+        current_epoch = self._epoch.read()
+        if current_epoch != self._seen_epoch:
+            self._entries.clear()
+            self._seen_epoch = current_epoch
+
+        entry = self._entries.get(token)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self._entries[token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, token: str, principal: AuthenticatedUser, token_exp: float | None = None) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        self._entries[token] = (expires_at, principal)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate_all(self) -> None:
+        """Gọi sau khi sửa/xóa user: áp dụng cho mọi worker."""
+        self._entries.clear()
+        self._seen_epoch = self._epoch.bump()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+principal_cache = PrincipalCache(
+    ttl_seconds=settings.AUTH_CACHE_TTL_SECONDS,
+    max_entries=settings.AUTH_CACHE_MAX_ENTRIES,
+    epoch=SharedEpoch("auth_principals"),
+)
 
 async def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return await run_in_threadpool(pwd_context.verify, plain_password, hashed_password)
+    return await password_hasher.run(pwd_context.verify, plain_password, hashed_password)
 
-async def get_password_hash(password: str) -> str:
+async def verify_dummy_password(plain_password: str) -> None:
+    """Tốn thời gian tương đương verify thật, dùng khi user không tồn tại."""
+    await password_hasher.run(pwd_context.verify, plain_password, await password_hasher.dummy_hash())
+
+async def get_password_hash(password: str, shed: bool = True) -> str:
     is_valid, error_msg = PasswordPolicy.validate(password)
     if not is_valid: raise ValueError(error_msg)
-    return await run_in_threadpool(pwd_context.hash, password)
+    return await password_hasher.run(pwd_context.hash, password, shed=shed)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -104,26 +232,33 @@ def decode_token(token: str) -> dict:
         logger.warning(f"Token decode failed: {e}")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token không hợp lệ hoặc đã hết hạn", headers={"WWW-Authenticate": "Bearer"})
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_auth_db)) -> models.User:
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AuthenticatedUser:
     token = credentials.credentials
+    cached = principal_cache.get(token)
+    if cached is not None:
+        return cached
+
     payload = decode_token(token)
     username: str = payload.get("sub")
     if not username: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token không hợp lệ")
-    user = await crud.get_user_by_username(db, username=username)
+    # Chỉ mở session auth DB khi cache miss
+    async with AsyncAuthSession() as db:
+        user = await crud.get_user_by_username(db, username=username)
     if not user: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User không tồn tại")
-    return user
+    principal = AuthenticatedUser(user)
+    principal_cache.put(token, principal, token_exp=payload.get("exp"))
+    return principal
 
 def require_permission(permission: str):
-    async def permission_checker(current_user: models.User = Depends(get_current_user)) -> models.User:
-        user_permissions = ROLE_PERMISSIONS.get(current_user.role, [])
-        if permission not in user_permissions:
+    async def permission_checker(current_user: AuthenticatedUser = Depends(get_current_user)) -> AuthenticatedUser:
+        if permission not in current_user.permissions:
             logger.warning(f"Permission denied: User '{current_user.username}' (role: {current_user.role}) tried to access '{permission}'")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Bạn không có quyền '{permission}'.")
         return current_user
     return permission_checker
 
 def has_permission(user: models.User, permission: str) -> bool:
-    return permission in ROLE_PERMISSIONS.get(user.role, [])
+    return permission in ROLE_PERMISSION_SETS.get(user.role, frozenset())
 
 def get_user_permissions(user: models.User) -> list[str]:
     return ROLE_PERMISSIONS.get(user.role, [])
\ No newline at end of file
@@ -1,125 +1,338 @@
 # ==============================================================================
 # == backend/app/command_builder.py ==
 # ==============================================================================
+#
+# Biên dịch cấu hình base station thành byte lệnh cho chip GNSS.
+# - UBX (u-blox): frame = sync + class/id + length + payload + checksum Fletcher-8.
+#   Payload cố định mô tả bằng struct (UbxLayout); CFG-VALSET/VALGET gom nhiều
+#   key-value vào một frame (tối đa 64 key, nhiều hơn thì chia frame theo transaction).
+# - Unicore: lệnh ASCII, mỗi lệnh một dòng kết thúc bằng CRLF.
+# Mỗi loại chip là một SensorProtocol với cùng các thao tác (survey_in, fixed_lla,
+# rover, save_config...). compile_commands() cache byte đã biên dịch theo
+# (sensor, thao tác, tham số), nên cấu hình lại cả đội trạm dùng lại cùng bytes.
+
+import struct
+from functools import lru_cache
+from itertools import accumulate
+
+UBX_SYNC = b'\xb5\x62'
+UBX_HEADER = struct.Struct('<2sBBH')
+UBX_OVERHEAD = UBX_HEADER.size + 2
+
+# Bit 0-2 của `layers` trong CFG-VALSET: RAM, BBR, Flash
+LAYER_RAM, LAYER_BBR, LAYER_FLASH = 0x01, 0x02, 0x04
+LAYERS_ALL = LAYER_RAM | LAYER_BBR | LAYER_FLASH
+# Layer (một giá trị) khi đọc bằng CFG-VALGET
+VALGET_LAYER_RAM, VALGET_LAYER_BBR, VALGET_LAYER_FLASH, VALGET_LAYER_DEFAULT = 0, 1, 2, 7
+MAX_KEYS_PER_FRAME = 64
+
+CMD_CACHE_SIZE = 1024
+
+
+class UbxFrameError(ValueError):
+    """Frame UBX sai sync, độ dài hoặc checksum."""
+
+
+def ubx_checksum(data) -> tuple[int, int]:
+    """
+    Checksum Fletcher-8 của UBX trên class..hết payload.
+    CK_A là tổng các byte, CK_B là tổng các tổng tích lũy; accumulate chạy ở tầng C.
+    """
+    sums = list(accumulate(memoryview(data)))
+    if not sums:
+        return 0, 0
+    return sums[-1] & 0xff, sum(sums) & 0xff
+
+
+def ubx_frame(msg_class: int, msg_id: int, payload: bytes = b'') -> bytes:
+    """Đóng gói payload thành frame UBX hoàn chỉnh."""
+    frame = bytearray(UBX_HEADER.size + len(payload) + 2)
+    UBX_HEADER.pack_into(frame, 0, UBX_SYNC, msg_class, msg_id, len(payload))
+    frame[UBX_HEADER.size:-2] = payload
+    frame[-2], frame[-1] = ubx_checksum(memoryview(frame)[2:-2])
+    return bytes(frame)
+
+
+def parse_ubx_frame(data) -> tuple[int, int, memoryview]:
+    """Tách một frame UBX: trả về (class, id, payload) hoặc raise UbxFrameError."""
+    view = memoryview(data)
+    if len(view) < UBX_OVERHEAD:
+        raise UbxFrameError("Frame quá ngắn")
+    sync, msg_class, msg_id, length = UBX_HEADER.unpack_from(view)
+    if sync != UBX_SYNC:
+        raise UbxFrameError("Sai sync bytes")
+    if len(view) != UBX_OVERHEAD + length:
+        raise UbxFrameError(f"Độ dài {len(view)} không khớp payload {length}")
+    if ubx_checksum(view[2:-2]) != (view[-2], view[-1]):
+        raise UbxFrameError("Sai checksum")
+    return msg_class, msg_id, view[UBX_HEADER.size:-2]
+
+
+class UbxLayout:
+    """Message UBX có payload cố định, mô tả bằng một struct và danh sách tên trường."""
+
+    def __init__(self, name: str, msg_class: int, msg_id: int, fmt: str, fields: tuple[str, ...]):
+        self.name = name
+        self.msg_class = msg_class
+        self.msg_id = msg_id
+        self.struct = struct.Struct(fmt)
+        self.fields = fields
+
+    def encode(self, **values) -> bytes:
+        """Các trường không truyền vào mặc định là 0."""
+        unknown = values.keys() - set(self.fields)
+        if unknown:
+            raise KeyError(f"{self.name}: không có trường {sorted(unknown)}")
+        payload = self.struct.pack(*(values.get(field, 0) for field in self.fields))
+        return ubx_frame(self.msg_class, self.msg_id, payload)
+
+    def decode(self, frame) -> dict:
+        msg_class, msg_id, payload = parse_ubx_frame(frame)
+        if (msg_class, msg_id) != (self.msg_class, self.msg_id):
+            raise UbxFrameError(f"Không phải {self.name}: 0x{msg_class:02x} 0x{msg_id:02x}")
+        return dict(zip(self.fields, self.struct.unpack(payload)))
+
+
+# UBX-CFG-TMODE3 (40 byte): flags = mode (bit 0-7) | lla (bit 8)
+CFG_TMODE3 = UbxLayout(
+    "UBX-CFG-TMODE3", 0x06, 0x71, '<BBHiiibbbBIII8x',
+    ("version", "reserved0", "flags", "ecefXOrLat", "ecefYOrLon", "ecefZOrAlt",
+     "ecefXOrLatHP", "ecefYOrLonHP", "ecefZOrAltHP", "reserved1",
+     "fixedPosAcc", "svinMinDur", "svinAccLimit"),
+)
+# UBX-CFG-CFG: lưu/xóa/nạp cấu hình; deviceMask 0x03 = BBR + Flash
+CFG_CFG = UbxLayout(
+    "UBX-CFG-CFG", 0x06, 0x09, '<IIIB', ("clearMask", "saveMask", "loadMask", "deviceMask"),
+)
+TMODE_DISABLED, TMODE_SURVEY_IN, TMODE_FIXED = 0, 1, 2
+TMODE3_FLAG_LLA = 0x100
+
+CFG_VALSET_ID = (0x06, 0x8a)
+CFG_VALGET_ID = (0x06, 0x8b)
+
+# Kích thước giá trị theo bit 28-30 của key ID: 1 = bit (lưu 1 byte), 2 = 1, 3 = 2, 4 = 4, 5 = 8 byte
+_VALUE_SIZE_CODES = {1: 'B', 2: 'B', 3: 'H', 4: 'I', 5: 'Q'}
+
+# Các key cấu hình dùng trong file này: tên -> (key ID, định dạng struct của giá trị)
+CFG_KEYS = {
+    "CFG-TMODE-MODE": (0x20030001, 'B'),
+    "CFG-TMODE-POS_TYPE": (0x20030002, 'B'),
+    "CFG-TMODE-ECEF_X": (0x40030003, 'i'),
+    "CFG-TMODE-ECEF_Y": (0x40030004, 'i'),
+    "CFG-TMODE-ECEF_Z": (0x40030005, 'i'),
+    "CFG-TMODE-ECEF_X_HP": (0x20030006, 'b'),
+    "CFG-TMODE-ECEF_Y_HP": (0x20030007, 'b'),
+    "CFG-TMODE-ECEF_Z_HP": (0x20030008, 'b'),
+    "CFG-TMODE-LAT": (0x40030009, 'i'),
+    "CFG-TMODE-LON": (0x4003000a, 'i'),
+    "CFG-TMODE-HEIGHT": (0x4003000b, 'i'),
+    "CFG-TMODE-LAT_HP": (0x2003000c, 'b'),
+    "CFG-TMODE-LON_HP": (0x2003000d, 'b'),
+    "CFG-TMODE-HEIGHT_HP": (0x2003000e, 'b'),
+    "CFG-TMODE-FIXED_POS_ACC": (0x4003000f, 'I'),
+    "CFG-TMODE-SVIN_MIN_DUR": (0x40030010, 'I'),
+    "CFG-TMODE-SVIN_ACC_LIMIT": (0x40030011, 'I'),
+}
+_KEY_FORMATS = {key_id: fmt for key_id, fmt in CFG_KEYS.values()}
+
+
+def _resolve_key(key) -> tuple[int, str]:
+    if isinstance(key, str):
+        return CFG_KEYS[key]
+    return key, _KEY_FORMATS.get(key) or _VALUE_SIZE_CODES[(key >> 28) & 0x7]
+
+
+def encode_cfg_valset(items, layers: int = LAYERS_ALL) -> list[bytes]:
+    """
+    UBX-CFG-VALSET cho danh sách (key, value); key là tên trong CFG_KEYS hoặc key ID.
+    Tối đa 64 key mỗi frame; nhiều hơn thì dùng transaction (version 1) để chip
+    chỉ áp dụng khi nhận frame cuối.
+    """
+    items = list(items.items() if isinstance(items, dict) else items)
+    chunks = [items[i:i + MAX_KEYS_PER_FRAME] for i in range(0, len(items), MAX_KEYS_PER_FRAME)] or [[]]
+    frames = []
+    for index, chunk in enumerate(chunks):
+        if len(chunks) == 1:
+            header = struct.pack('<BBH', 0, layers, 0)
+        else:
+            # 1 = bắt đầu, 2 = tiếp tục, 3 = kết thúc và áp dụng
+            transaction = 1 if index == 0 else 3 if index == len(chunks) - 1 else 2
+            header = struct.pack('<BBBx', 1, layers, transaction)
+        body = bytearray(header)
+        for key, value in chunk:
+            key_id, fmt = _resolve_key(key)
+            body += struct.pack('<I' + fmt, key_id, value)
+        frames.append(ubx_frame(*CFG_VALSET_ID, bytes(body)))
+    return frames
+
+
+def encode_cfg_valget(keys, layer: int = VALGET_LAYER_RAM, position: int = 0) -> list[bytes]:
+    """UBX-CFG-VALGET (poll) cho danh sách key, tối đa 64 key mỗi frame."""
+    key_ids = [_resolve_key(key)[0] for key in keys]
+    return [
+        ubx_frame(*CFG_VALGET_ID, struct.pack(f'<BBH{len(chunk)}I', 0, layer, position, *chunk))
+        for chunk in (key_ids[i:i + MAX_KEYS_PER_FRAME] for i in range(0, len(key_ids), MAX_KEYS_PER_FRAME))
+    ]
+
+
+def decode_cfg_valget(frame) -> dict[int, int]:
+    """Giải mã phản hồi UBX-CFG-VALGET thành {key ID: giá trị}."""
+    msg_class, msg_id, payload = parse_ubx_frame(frame)
+    if (msg_class, msg_id) != CFG_VALGET_ID:
+        raise UbxFrameError(f"Không phải UBX-CFG-VALGET: 0x{msg_class:02x} 0x{msg_id:02x}")
+    values, offset = {}, 4
+    while offset < len(payload):
+        key_id, = struct.unpack_from('<I', payload, offset)
+        _, fmt = _resolve_key(key_id)
+        values[key_id], = struct.unpack_from('<' + fmt, payload, offset + 4)
+        offset += 4 + struct.calcsize('<' + fmt)
+    return values
+
+
+def _split_high_precision(value: float, scale: int) -> tuple[int, int]:
+    """Tách giá trị đã nhân `scale` thành phần chính và phần HP (x100), cùng dấu."""
+    scaled = value * scale
+    main = int(scaled)
+    return main, int((scaled - main) * 100)
+
+
+class SensorProtocol:
+    """Các thao tác cấu hình base station; mỗi thao tác trả về tuple các lệnh (bytes)."""
+
+    name = ""
+
+    def survey_in(self, duration: int, accuracy: float) -> tuple[bytes, ...]:
+        raise NotImplementedError
+
+    def fixed_lla(self, lat: float, lon: float, alt: float, accuracy: float) -> tuple[bytes, ...]:
+        raise NotImplementedError
+
+    def rover(self) -> tuple[bytes, ...]:
+        raise NotImplementedError
+
+    def save_config(self) -> tuple[bytes, ...]:
+        raise NotImplementedError
+
+
+class UbloxProtocol(SensorProtocol):
+    """u-blox: CFG-TMODE3 (tương thích cả M8 và F9) rồi lưu cấu hình bằng CFG-CFG."""
+
+    name = "Ublox"
+    SAVE_CONFIG = CFG_CFG.encode(saveMask=0xffff, deviceMask=0x03)
+
+    def save_config(self):
+        return (self.SAVE_CONFIG,)
+
+    def survey_in(self, duration, accuracy):
+        tmode = CFG_TMODE3.encode(
+            flags=TMODE_SURVEY_IN, svinMinDur=int(duration), svinAccLimit=int(accuracy * 10000)
+        )
+        return (tmode, self.SAVE_CONFIG)
+
+    def fixed_lla(self, lat, lon, alt, accuracy):
+        lat_main, lat_hp = _split_high_precision(lat, 10000000)
+        lon_main, lon_hp = _split_high_precision(lon, 10000000)
+        alt_main, alt_hp = _split_high_precision(alt, 100)
+        tmode = CFG_TMODE3.encode(
+            flags=TMODE_FIXED | TMODE3_FLAG_LLA,
+            ecefXOrLat=lat_main, ecefYOrLon=lon_main, ecefZOrAlt=alt_main,
+            ecefXOrLatHP=lat_hp, ecefYOrLonHP=lon_hp, ecefZOrAltHP=alt_hp,
+            fixedPosAcc=int(accuracy * 10000),
+        )
+        return (tmode, self.SAVE_CONFIG)
+
+    def rover(self):
+        return (CFG_TMODE3.encode(flags=TMODE_DISABLED), self.SAVE_CONFIG)
+
+    def valset(self, items: tuple, layers: int = LAYERS_ALL):
+        """Nhiều key cấu hình (F9 trở lên) trong ít frame nhất; đã ghi vào Flash nếu layers có Flash."""
+        return tuple(encode_cfg_valset(items, layers))
+
+    def valget(self, keys: tuple, layer: int = VALGET_LAYER_RAM):
+        return tuple(encode_cfg_valget(keys, layer))
+
+
+class UnicoreProtocol(SensorProtocol):
+    """Unicore (UM98x...): lệnh ASCII, mỗi lệnh một dòng."""
+
+    name = "Unicorecomm"
+
+    @staticmethod
+    def script(*lines: str) -> bytes:
+        """Ghép các lệnh thành một khối ASCII kết thúc bằng CRLF."""
+        return "".join(f"{line}\r\n" for line in lines).encode("ascii")
+
+    def save_config(self):
+        return (self.script("SAVECONFIG"),)
+
+    def survey_in(self, duration, accuracy):
+        if accuracy > 0:
+            return (self.script(f"MODE BASE TIME {duration} {accuracy}", "SAVECONFIG"),)
+        return (self.script(f"MODE BASE TIME {duration}", "SAVECONFIG"),)
+
+    def fixed_lla(self, lat, lon, alt, accuracy):
+        return (self.script(f"MODE BASE {lat} {lon} {alt}", "SAVECONFIG"),)
+
+    def rover(self):
+        return (self.script("MODE ROVER", "SAVECONFIG"),)
+
+    def commands(self, lines: tuple):
+        """Lệnh ASCII tùy ý (vd. 'CONFIG ...', 'RTCM1005 COM2 10'), gom trong một khối."""
+        return (self.script(*lines),)
+
+
+SENSORS: dict[str, SensorProtocol] = {protocol.name: protocol for protocol in (UbloxProtocol(), UnicoreProtocol())}
+
+
+def _typed(value):
+    """
+    Giá trị kèm kiểu để làm khóa cache: 60 == 60.0 và cùng hash nhưng text Unicore
+    khác nhau ("TIME 60" / "TIME 60.0"), nên kiểu phải nằm trong khóa (cả trong tuple lồng nhau).
+    """
+    if isinstance(value, tuple):
+        return tuple, tuple(_typed(item) for item in value)
+    return type(value), value
+
+
+def _untyped(typed):
+    kind, value = typed
+    return tuple(_untyped(item) for item in value) if kind is tuple else value
+
+
+@lru_cache(maxsize=CMD_CACHE_SIZE)
+def _compile(sensor_type: str, operation: str, params: tuple) -> tuple[bytes, ...]:
+    protocol = SENSORS.get(sensor_type)
+    if protocol is None:
+        return ()
+    return getattr(protocol, operation)(**{name: _untyped(typed) for name, typed in params})
+
+
+def compile_commands(sensor_type: str, operation: str, **params) -> tuple[bytes, ...]:
+    """
+    Byte lệnh cho `operation` (survey_in, fixed_lla, rover, save_config, valset...)
+    trên chip `sensor_type`, có cache LRU. Chip không hỗ trợ trả về tuple rỗng.
+    Tham số phải hashable (dùng tuple thay cho list/dict).
+    """
+    return _compile(sensor_type, operation, tuple(sorted((name, _typed(value)) for name, value in params.items())))
+
+
+def command_cache_info():
+    return _compile.cache_info()
+
 
 def build_base_survey_in_command(sensor_type: str, duration: int, accuracy: float) -> list[bytes]:
     """
     Xây dựng chuỗi lệnh cho chế độ Survey-In.
     """
-    commands = []
-    
-    if sensor_type == 'Ublox':
-        # Tạo message với cấu trúc chính xác
-        message = bytearray(b'\xb5\x62\x06\x71\x28\x00' + b'\x00' * 42)
-        
-        # Byte 8: Mode = 1 (Survey-In)
-        message[8] = 1
-        
-        # Chuyển đổi duration và accuracy
-        svinMinDur_bytes = int(duration).to_bytes(4, byteorder='little')
-        svinAccLimit_bytes = int(accuracy * 10000).to_bytes(4, byteorder='little')
-        
-        # Ghi vào vị trí đúng
-        for i in range(4):
-            message[30 + i] = svinMinDur_bytes[i]
-            message[34 + i] = svinAccLimit_bytes[i]
-        
-        # Tính checksum
-        CK_A, CK_B = 0, 0
-        for i in range(2, 46):
-            CK_A = (CK_A + message[i]) & 0xff
-            CK_B = (CK_B + CK_A) & 0xff
-        
-        message[46] = CK_A
-        message[47] = CK_B
-        
-        commands.append(bytes(message))
-        # Lệnh Save Config
-        commands.append(b'\xb5\x62\x06\x09\x0d\x00\x00\x00\x00\x00\xff\xff\x00\x00\x00\x00\x00\x00\x03\x1d\xab')
-        
-    elif sensor_type == 'Unicorecomm':
-        # QUAN TRỌNG: Format đúng như code gốc
-        if accuracy > 0:
-            cmd_str = f'MODE BASE TIME {duration} {accuracy}\r\nSAVECONFIG\r\n'
-        else:
-            cmd_str = f'MODE BASE TIME {duration}\r\nSAVECONFIG\r\n'
-        commands.append(cmd_str.encode())
-        
-    return commands
+    return list(compile_commands(sensor_type, "survey_in", duration=duration, accuracy=accuracy))
 
 
 def build_base_fixed_lla_command(sensor_type: str, lat: float, lon: float, alt: float, accuracy: float) -> list[bytes]:
     """
     Xây dựng chuỗi lệnh cho chế độ Fixed LLA.
-    
-    THAY ĐỔI:
-    - Sửa lỗi xử lý high precision bytes (HP)
-    - Đảm bảo signed integer conversion đúng
+    Phần high precision (HP) giữ cùng dấu với phần chính.
     """
-    commands = []
-    
-    if sensor_type == 'Ublox':
-        message = bytearray(b'\xb5\x62\x06\x71\x28\x00' + b'\x00' * 42)
-        
-        # Byte 8: Mode = 2 (Fixed)
-        message[8] = 2
-        # Byte 9: LLA mode = 1
-        message[9] = 1
-        
-        multiplier = 10000000  # LLA multiplier
-        
-        # === XỬ LÝ LATITUDE ===
-        XOrLat_int = int(lat * multiplier)
-        # Tính HP value với dấu
-        XOrLat_hp_value = int((lat * multiplier - XOrLat_int) * 100)
-        XOrLat_hp_bytes = XOrLat_hp_value.to_bytes(1, byteorder='little', signed=True)
-        XOrLat_bytes = XOrLat_int.to_bytes(4, byteorder='little', signed=True)
-        
-        # === XỬ LÝ LONGITUDE ===
-        YOrLon_int = int(lon * multiplier)
-        YOrLon_hp_value = int((lon * multiplier - YOrLon_int) * 100)
-        YOrLon_hp_bytes = YOrLon_hp_value.to_bytes(1, byteorder='little', signed=True)
-        YOrLon_bytes = YOrLon_int.to_bytes(4, byteorder='little', signed=True)
-        
-        # === XỬ LÝ ALTITUDE ===
-        ZOrAlt_int = int(alt * 100)
-        ZOrAlt_hp_value = int((alt * 100 - ZOrAlt_int) * 100)
-        ZOrAlt_hp_bytes = ZOrAlt_hp_value.to_bytes(1, byteorder='little', signed=True)
-        ZOrAlt_bytes = ZOrAlt_int.to_bytes(4, byteorder='little', signed=True)
-        
-        # Fixed Position Accuracy
-        fixedPosAcc_bytes = int(accuracy * 10000).to_bytes(4, byteorder='little')
-        
-        # Ghi vào message
-        for i in range(4):
-            message[10 + i] = XOrLat_bytes[i]
-            message[14 + i] = YOrLon_bytes[i]
-            message[18 + i] = ZOrAlt_bytes[i]
-            message[26 + i] = fixedPosAcc_bytes[i]
-        
-        # Ghi HP bytes
-        message[22] = XOrLat_hp_bytes[0]
-        message[23] = YOrLon_hp_bytes[0]
-        message[24] = ZOrAlt_hp_bytes[0]
-        
-        # Tính checksum
-        CK_A, CK_B = 0, 0
-        for i in range(2, 46):
-            CK_A = (CK_A + message[i]) & 0xff
-            CK_B = (CK_B + CK_A) & 0xff
-        
-        message[46] = CK_A
-        message[47] = CK_B
-        
-        commands.append(bytes(message))
-        # Lệnh Save Config
-        commands.append(b'\xb5\x62\x06\x09\x0d\x00\x00\x00\x00\x00\xff\xff\x00\x00\x00\x00\x00\x00\x03\x1d\xab')
-        
-    elif sensor_type == 'Unicorecomm':
-        cmd_str = f'MODE BASE {lat} {lon} {alt}\r\nSAVECONFIG\r\n'
-        commands.append(cmd_str.encode())
-        
-    return commands
+    return list(compile_commands(sensor_type, "fixed_lla", lat=lat, lon=lon, alt=alt, accuracy=accuracy))
 
 
 # === HÀM DEBUG  ===
@@ -134,8 +347,8 @@ if __name__ == "__main__":
     commands = build_base_survey_in_command('Ublox', 300, 0.01)
     for i, cmd in enumerate(commands):
         print(f"Command {i+1}: {debug_command(cmd)}")
-    
+
     print("\n=== TEST FIXED LLA ===")
     commands = build_base_fixed_lla_command('Ublox', 21.0285, 105.8542, 10.5, 10.0)
     for i, cmd in enumerate(commands):
-        print(f"Command {i+1}: {debug_command(cmd)}")
\ No newline at end of file
+        print(f"Command {i+1}: {debug_command(cmd)}")
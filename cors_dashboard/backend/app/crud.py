@@ -1,10 +1,17 @@
 # backend/app/crud.py
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import update, or_
 from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from . import models, schemas
+import hashlib
+import logging
+import json
 import time
 
+# Số phần tử tối đa trong một mệnh đề IN (giới hạn biến của SQLite)
+IN_CLAUSE_CHUNK = 500
+
 # --- DEVICE OPERATIONS ---
 async def get_device_by_serial(db: AsyncSession, serial: str):
     result = await db.execute(select(models.Device).filter(models.Device.serial == serial))
@@ -14,6 +21,63 @@ async def get_all_devices(db: AsyncSession):
     result = await db.execute(select(models.Device).order_by(models.Device.name))
     return result.scalars().all()
 
+async def stream_devices(
+    db: AsyncSession,
+    since: int | None = None,
+    until: int | None = None,
+    chunk_size: int = 500
+):
+    """
+    Đọc thiết bị qua server-side cursor và trả về từng partition `chunk_size` dòng.
+    `since`/`until` lọc theo timestamp (epoch giây) của lần cập nhật cuối.
+    """
+    stmt = select(models.Device).order_by(models.Device.name).execution_options(yield_per=chunk_size)
+    if since is not None:
+        stmt = stmt.filter(models.Device.timestamp >= since)
+    if until is not None:
+        stmt = stmt.filter(models.Device.timestamp <= until)
+
+    result = await db.stream_scalars(stmt)
+    async for partition in result.partitions(chunk_size):
+        yield partition
+
+# ntrip_status là trạng thái runtime nên nằm thẳng trên devices, không qua device_configs
+CONFIG_FIELDS = ("base_config", "service_config")
+
+def compute_config_hash(content: dict | None) -> str | None:
+    """SHA-256 của JSON chuẩn hóa (sort_keys). Cấu hình rỗng không có hash."""
+    if not content:
+        return None
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+async def _get_or_create_config(db: AsyncSession, config_hash: str, content: dict) -> models.DeviceConfig:
+    config = await db.get(models.DeviceConfig, config_hash)
+    if config is None:
+        await db.execute(
+            sqlite_insert(models.DeviceConfig)
+            .values(hash=config_hash, content=content, created_at=int(time.time()))
+            .on_conflict_do_nothing(index_elements=['hash'])
+        )
+        config = await db.get(models.DeviceConfig, config_hash)
+    return config
+
+async def _apply_device_configs(db: AsyncSession, device: models.Device, configs: dict) -> None:
+    """
+    So sánh hash cấu hình mới với hash đang lưu trên trạm.
+    Chỉ khi khác nhau mới ghi device_configs / device_config_history và đổi cột hash.
+    """
+    now = int(time.time())
+    for field in CONFIG_FIELDS:
+        content = configs.get(field) or {}
+        new_hash = compute_config_hash(content)
+        if new_hash == getattr(device, f"{field}_hash"):
+            continue
+
+        blob = await _get_or_create_config(db, new_hash, content) if new_hash else None
+        setattr(device, f"{field}_blob", blob)
+        db.add(models.DeviceConfigHistory(serial=device.serial, kind=field, config_hash=new_hash, changed_at=now))
+
 async def update_or_create_device(db: AsyncSession, device_data: dict) -> models.Device | None:
     """
     Cập nhật hoặc tạo thiết bị.
@@ -21,6 +85,8 @@ async def update_or_create_device(db: AsyncSession, device_data: dict) -> models
     LOGIC NÂNG CẤP:
     - Nếu nhận được is_provisioned: false từ một thiết bị đã tồn tại,
       coi đây là một tín hiệu RESET và xóa sạch cấu hình cũ của nó.
+    - Cấu hình được lưu theo hash: heartbeat bình thường chỉ UPDATE các cột
+      nóng đã thay đổi (status, timestamp, bps, ...), không ghi lại JSON.
     """
     serial = device_data.get("serial")
     if not serial:
@@ -31,23 +97,21 @@ async def update_or_create_device(db: AsyncSession, device_data: dict) -> models
 
     # --- Trường hợp 1: Thiết bị bị reset ---
     if is_being_reset:
-        print(f"DEBUG CRUD: Detected RESET for device '{serial}'. Wiping config.")
+        logging.info(f"Detected RESET for device '{serial}'. Wiping config.")
         existing_device.status = device_data.get("status", "unknown")
         existing_device.timestamp = device_data.get("timestamp", 0)
         existing_device.detected_chip_type = device_data.get("detected_chip_type", "UNKNOWN")
         
         # Xóa sạch dữ liệu cũ
         existing_device.name = device_data.get("name", f"Pi-{serial[-4:]}") # Cập nhật tên mặc định mới
-        existing_device.base_config = {}
-        existing_device.service_config = {}
+        await _apply_device_configs(db, existing_device, {})
+        existing_device.ntrip_status = {}
         existing_device.user_id = None # Hủy gán khỏi user
         existing_device.bps = 0
         existing_device.ntrip_connected = False
-        existing_device.ntrip_status = {}
         # is_locked giữ nguyên vì đây là hành động của admin
 
         await db.commit()
-        await db.refresh(existing_device)
         return existing_device
 
     # --- Trường hợp 2: Cập nhật thông thường hoặc tạo mới ---
@@ -55,44 +119,34 @@ async def update_or_create_device(db: AsyncSession, device_data: dict) -> models
         ntrip_stats = device_data.get('ntrip_stats', {})
         bps = sum(ntrip_stats.values()) if isinstance(ntrip_stats, dict) else 0
 
-        values_to_set = {
-            "name": device_data.get("name", f"Pi-{serial[-4:]}"),
-            "status": device_data.get("status", "unknown"),
-            "timestamp": device_data.get("timestamp", 0),
-            "bps": bps,
-            "detected_chip_type": device_data.get("detected_chip_type", "UNKNOWN"),
-            "base_config": device_data.get("base_config", {}),
-            "service_config": device_data.get("service_config", {}),
-            "ntrip_connected": device_data.get("ntrip_connected", False),
-            "ntrip_status": device_data.get("ntrip_status", {}),
-            "is_locked": device_data.get("is_locked", False)
-        }
-        
-        # Nếu thiết bị chưa tồn tại, thêm serial vào để tạo mới
-        if not existing_device:
-            values_to_set["serial"] = serial
-            stmt = sqlite_insert(models.Device).values(values_to_set)
-        else:
-            # Nếu đã tồn tại, dùng cú pháp update thông thường
-            stmt = (
-                sqlite_insert(models.Device)
-                .values(serial=serial) # Chỉ cần serial để tìm
-                .on_conflict_do_update(
-                    index_elements=['serial'],
-                    set_=values_to_set
-                )
-            )
+        device = existing_device
+        if not device:
+            device = models.Device(serial=serial)
+            db.add(device)
+
+        # ORM chỉ đưa các cột thực sự thay đổi vào câu UPDATE
+        device.name = device_data.get("name", f"Pi-{serial[-4:]}")
+        device.status = device_data.get("status", "unknown")
+        device.timestamp = device_data.get("timestamp", 0)
+        device.bps = bps
+        device.detected_chip_type = device_data.get("detected_chip_type", "UNKNOWN")
+        device.ntrip_connected = device_data.get("ntrip_connected", False)
+        device.is_locked = device_data.get("is_locked", False)
+        device.ntrip_status = device_data.get("ntrip_status") or {}
+        await _apply_device_configs(db, device, device_data)
 
-        # Thực thi và trả về đối tượng đã được cập nhật/tạo mới
-        result = await db.execute(stmt.returning(models.Device))
         await db.commit()
-        
-        scalar_result = result.scalar_one_or_none()
-        # Nếu dùng upsert mà không có returning, cần query lại
-        if not scalar_result:
-             scalar_result = await get_device_by_serial(db, serial)
-             
-        return scalar_result
+        return device
+
+async def get_device_config_history(db: AsyncSession, serial: str, limit: int = 100) -> list[tuple[models.DeviceConfigHistory, models.DeviceConfig | None]]:
+    result = await db.execute(
+        select(models.DeviceConfigHistory, models.DeviceConfig)
+        .outerjoin(models.DeviceConfig, models.DeviceConfig.hash == models.DeviceConfigHistory.config_hash)
+        .filter(models.DeviceConfigHistory.serial == serial)
+        .order_by(models.DeviceConfigHistory.changed_at.desc(), models.DeviceConfigHistory.id.desc())
+        .limit(limit)
+    )
+    return result.all()
 
 # --- USER OPERATIONS ---
 async def get_user_by_username(db: AsyncSession, username: str) -> models.User | None:
@@ -156,6 +210,116 @@ async def get_devices_by_user_id(db: AsyncSession, user_id: int) -> list[models.
     )
     return result.scalars().all()
 
+async def get_assigned_device_summaries(db: AsyncSession) -> dict[int, list]:
+    """
+    Một query duy nhất trên devices DB: lấy các cột tóm tắt của mọi trạm đã gán,
+    gom theo user_id trong bộ nhớ. Không load bảng cấu hình.
+    """
+    result = await db.execute(
+        select(
+            models.Device.user_id, models.Device.serial, models.Device.name,
+            models.Device.status, models.Device.ntrip_connected
+        )
+        .filter(models.Device.user_id.is_not(None))
+        .order_by(models.Device.user_id, models.Device.name)
+    )
+    grouped: dict[int, list] = {}
+    for row in result.all():
+        grouped.setdefault(row.user_id, []).append(row)
+    return grouped
+
+def _chunked(items: list, size: int = IN_CLAUSE_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+async def assign_devices_to_user(
+    db: AsyncSession,
+    user_id: int,
+    serials: list[str],
+    replace: bool = False,
+    commit: bool = True
+) -> dict:
+    """
+    Gán thiết bị cho user bằng UPDATE devices SET user_id=... WHERE serial IN (...).
+
+    - Chỉ gán các trạm chưa có chủ hoặc đã thuộc về chính user này.
+    - replace=True: bỏ gán các trạm hiện tại của user không có trong `serials`.
+    - Chỉ khi có trạm không được gán mới chạy thêm một SELECT để phân loại lỗi.
+    Trả về dict gồm `assigned`, `conflicts` (serial + owner) và `not_found`.
+    """
+    serials = list(dict.fromkeys(serials))
+
+    if replace:
+        stmt = update(models.Device).where(models.Device.user_id == user_id)
+        if serials:
+            stmt = stmt.where(models.Device.serial.not_in(serials))
+        await db.execute(stmt.values(user_id=None))
+
+    assigned: list[str] = []
+    for chunk in _chunked(serials):
+        result = await db.execute(
+            update(models.Device)
+            .where(
+                models.Device.serial.in_(chunk),
+                or_(models.Device.user_id.is_(None), models.Device.user_id == user_id)
+            )
+            .values(user_id=user_id)
+            .returning(models.Device.serial)
+        )
+        assigned.extend(result.scalars().all())
+
+    conflicts, not_found = [], []
+    assigned_set = set(assigned)
+    remaining = [s for s in serials if s not in assigned_set]
+    if remaining:
+        owners = {}
+        for chunk in _chunked(remaining):
+            result = await db.execute(
+                select(models.Device.serial, models.Device.user_id).filter(models.Device.serial.in_(chunk))
+            )
+            owners.update(result.all())
+        for serial in remaining:
+            if serial in owners:
+                conflicts.append({"serial": serial, "user_id": owners[serial]})
+            else:
+                not_found.append(serial)
+
+    if commit:
+        await db.commit()
+    return {"assigned": assigned, "conflicts": conflicts, "not_found": not_found}
+
+async def unassign_devices_from_user(db: AsyncSession, user_id: int, commit: bool = True) -> None:
+    await db.execute(
+        update(models.Device).where(models.Device.user_id == user_id).values(user_id=None)
+    )
+    if commit:
+        await db.commit()
+
+async def get_existing_usernames(db: AsyncSession, usernames: list[str]) -> dict[str, models.User]:
+    users = {}
+    for chunk in _chunked(list(dict.fromkeys(usernames))):
+        result = await db.execute(select(models.User).filter(models.User.username.in_(chunk)))
+        users.update({u.username: u for u in result.scalars().all()})
+    return users
+
+async def create_users_bulk(db: AsyncSession, users_data: list[dict]) -> list[models.User]:
+    """Tạo nhiều user trong một transaction. `users_data` gồm username, hashed_password, role, full_name."""
+    now = int(time.time())
+    db_users = [
+        models.User(
+            username=data["username"],
+            hashed_password=data["hashed_password"],
+            full_name=data.get("full_name"),
+            role=data["role"],
+            is_active=True,
+            created_at=now
+        )
+        for data in users_data
+    ]
+    db.add_all(db_users)
+    await db.commit()
+    return db_users
+
 async def delete_user(db: AsyncSession, user_id: int) -> bool:
     user = await get_user_by_id(db, user_id)
     if not user:
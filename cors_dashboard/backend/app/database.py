@@ -2,11 +2,14 @@
 # == backend/app/database.py - CẢI TIẾN CONNECTION POOLING                  ==
 # ==============================================================================
 
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
 from pydantic_settings import BaseSettings
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +20,58 @@ class Settings(BaseSettings):
     DB_POOL_SIZE: int = 5; DB_MAX_OVERFLOW: int = 10
     DB_POOL_TIMEOUT: int = 30; DB_POOL_RECYCLE: int = 3600
     DB_ECHO: bool = False
+    # Read replica (tùy chọn). Không đặt: đọc từ primary qua một engine/pool riêng
+    READ_DATABASE_URL: str | None = None
+    DB_READ_POOL_SIZE: int = 10; DB_READ_MAX_OVERFLOW: int = 20
+    DB_REPLICA_MAX_LAG_SECONDS: float = 10.0
+    DB_REPLICA_CHECK_INTERVAL: int = 15
+    # Thư mục chứa các file mmap dùng chung giữa các worker (mặc định: thư mục tạm)
+    SHARED_STATE_DIR: str | None = None
+    AUTH_CACHE_TTL_SECONDS: int = 60; AUTH_CACHE_MAX_ENTRIES: int = 10000
+    # Executor riêng cho bcrypt: số thread và số yêu cầu tối đa được chờ trước khi trả 503
+    PASSWORD_HASH_WORKERS: int = 2; PASSWORD_HASH_MAX_PENDING: int = 16
+    # Tỉ lệ request /api được ghi access log (request lỗi 5xx hoặc chậm luôn được ghi)
+    ACCESS_LOG_SAMPLE_RATE: float = 0.01; SLOW_REQUEST_MS: float = 1000.0
+    # Chu kỳ lấy mẫu CPU/RAM/disk và probe DB/MQTT cho các endpoint /health
+    HEALTH_SAMPLE_INTERVAL_SECONDS: float = 5.0
+    # Nếu đặt, /metrics yêu cầu header 'Authorization: Bearer <METRICS_TOKEN>'
+    METRICS_TOKEN: str | None = None
+    # Tỉ lệ trace ingest được ghi log đầy đủ; thêm server_ts (ms) vào frame gửi UI để trình duyệt báo độ trễ vẽ
+    INGEST_TRACE_SAMPLE_RATE: float = 0.01; WS_INCLUDE_SERVER_TS: bool = False
+    # Tick đo độ trễ event loop; bị chặn quá ngưỡng thì watchdog ghi lại stack
+    LOOP_LAG_INTERVAL_SECONDS: float = 0.5; LOOP_STALL_THRESHOLD_SECONDS: float = 0.2
+    # Log JSON ghi ở thread riêng, xoay file theo kích thước; queue đầy thì bỏ record
+    LOG_FILE: str = "app.log"; LOG_LEVEL: str = "INFO"
+    LOG_MAX_BYTES: int = 10 * 1024 * 1024; LOG_BACKUP_COUNT: int = 5; LOG_QUEUE_SIZE: int = 10000
+    # Tỉ lệ giữ lại theo category (hoặc tên logger) cho các log tần suất cao dưới WARNING
+    LOG_SAMPLE_RATES: dict[str, float] = {"mqtt.message": 0.01, "pi.message": 0.01}
+    # Số session DB đồng thời tối đa mỗi subsystem; hết slot thì chờ tối đa MAX_WAIT giây rồi trả lỗi
+    DB_BULKHEAD_INGEST: int = 8; DB_BULKHEAD_API: int = 10; DB_BULKHEAD_BACKGROUND: int = 2
+    DB_BULKHEAD_MAX_QUEUE: int = 100; DB_BULKHEAD_MAX_WAIT_SECONDS: float = 2.0
+    # Câu lệnh SQL chậm hơn ngưỡng này được ghi vào báo cáo slow query (/api/admin/db/queries)
+    DB_SLOW_QUERY_MS: float = 200.0
+    # Ring buffer GGA mỗi trạm (số điểm, ~1 giờ ở 1 Hz) cho biểu đồ vị trí; đặt DIR để lưu xuống đĩa mỗi PERSIST giây
+    POSITION_HISTORY_SIZE: int = 3600; POSITION_HISTORY_MAX_DEVICES: int = 500
+    POSITION_HISTORY_DIR: str | None = None; POSITION_HISTORY_PERSIST_SECONDS: float = 300.0
+    # Ước lượng tọa độ base từ GGA: bỏ fix có HDOP lớn hơn; coi là hội tụ khi đủ MIN_SAMPLES fix và
+    # MIN_BATCHES khối CHECKPOINT giây, mọi fix có hạng >= MIN_FIX_RANK (1 autonomous, 2 DGPS/PPS,
+    # 3 RTK float, 4 RTK fixed), độ chính xác (từ độ phân tán trung bình các khối) và độ dịch chuyển
+    # mỗi phút dưới TARGET mét. Chưa đạt MIN_FIX_RANK thì không áp dụng được kể cả với force
+    SURVEY_MAX_HDOP: float = 5.0; SURVEY_MIN_SAMPLES: int = 600; SURVEY_MIN_FIX_RANK: int = 4
+    SURVEY_CHECKPOINT_SECONDS: float = 60.0; SURVEY_MIN_BATCHES: int = 10; SURVEY_TARGET_ACCURACY_M: float = 0.1
+    # Cảnh báo khi trung bình trượt (hệ số SMOOTHING mỗi fix) độ lệch GGA so với FIXED_LLA vượt ngưỡng (mét);
+    # fix cũ hơn STALE giây không được tính. Chỉ fix có GGA quality trong FIX_QUALITIES (mặc định 4 = RTK fixed)
+    # được đánh giá: fix autonomous/DGPS/float sai hàng mét sẽ vượt ngưỡng dù tọa độ cố định đúng. Trạm không
+    # còn fix loại đó thì cảnh báo chuyển sang "stale" như khi mất GGA
+    DRIFT_CHECK_INTERVAL_SECONDS: float = 1.0; DRIFT_STALE_SECONDS: float = 10.0; DRIFT_SMOOTHING: float = 0.05
+    DRIFT_FIX_QUALITIES: tuple[int, ...] = (4,)
+    DRIFT_HORIZONTAL_THRESHOLD_M: float = 0.5; DRIFT_VERTICAL_THRESHOLD_M: float = 1.0
+    # Kích thước ô (độ) của lưới chỉ mục không gian cho /api/devices/nearest và /api/devices/within
+    SPATIAL_CELL_DEGREES: float = 0.25
+    # Cụm trạm cho /api/map/clusters: giữ sẵn tới zoom MAX_CLUSTER_ZOOM (mỗi zoom thêm ~1 cụm/trạm trong RAM
+    # mỗi worker; zoom sâu hơn tính trực tiếp từ chỉ mục), mỗi tile chia GRID x GRID ô (GRID là lũy thừa
+    # của 2); quét trạm quá hạn heartbeat mỗi SWEEP giây
+    MAP_MAX_CLUSTER_ZOOM: int = 12; MAP_CLUSTER_GRID: int = 8; MAP_CLUSTER_SWEEP_SECONDS: float = 30.0
     SECRET_KEY: str; ALGORITHM: str; ACCESS_TOKEN_EXPIRE_MINUTES: int
     
     class Config:
@@ -24,34 +79,144 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
-def create_optimized_engine(database_url: str):
+def _enable_sqlite_wal(async_engine):
+    """WAL cho phép reader đọc song song trong khi writer đang ghi."""
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+def create_optimized_engine(database_url: str, pool_size: int | None = None, max_overflow: int | None = None):
     if database_url.startswith("sqlite"):
         logger.info("Using SQLite with NullPool (no connection pooling)")
-        return create_async_engine(
+        sqlite_engine = create_async_engine(
             database_url, echo=settings.DB_ECHO, poolclass=NullPool,
             connect_args={"check_same_thread": False}
         )
+        if "mode=ro" not in database_url:
+            _enable_sqlite_wal(sqlite_engine)
+        return sqlite_engine
     
-    logger.info(f"Using connection pool: size={settings.DB_POOL_SIZE}, max_overflow={settings.DB_MAX_OVERFLOW}")
+    pool_size = pool_size if pool_size is not None else settings.DB_POOL_SIZE
+    max_overflow = max_overflow if max_overflow is not None else settings.DB_MAX_OVERFLOW
+    logger.info(f"Using connection pool: size={pool_size}, max_overflow={max_overflow}")
     return create_async_engine(
-        database_url, echo=settings.DB_ECHO, poolclass=QueuePool,
-        pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW,
+        database_url, echo=settings.DB_ECHO, poolclass=AsyncAdaptedQueuePool,
+        pool_size=pool_size, max_overflow=max_overflow,
         pool_timeout=settings.DB_POOL_TIMEOUT, pool_recycle=settings.DB_POOL_RECYCLE,
         pool_pre_ping=True,
     )
 
+def _sqlite_read_only_url(database_url: str) -> str:
+    """sqlite:///path.db -> sqlite:///file:path.db?mode=ro&uri=true"""
+    url = make_url(database_url)
+    if not url.database or url.database == ":memory:" or url.query.get("mode") == "ro":
+        return database_url
+    return url.set(
+        database=f"file:{url.database}", query={**url.query, "mode": "ro", "uri": "true"}
+    ).render_as_string(hide_password=False)
+
+def _read_database_url() -> str:
+    if settings.READ_DATABASE_URL:
+        return settings.READ_DATABASE_URL
+    if settings.DATABASE_URL.startswith("sqlite"):
+        return _sqlite_read_only_url(settings.DATABASE_URL)
+    return settings.DATABASE_URL
+
 # === DATABASE 1: Dữ liệu trạm (devices) ===
+# Ghi (ingest, CRUD) luôn qua `engine`; đọc (dashboard, export) qua `read_engine`
+# với pool riêng để không phải xếp hàng sau các writer.
 engine = create_optimized_engine(settings.DATABASE_URL)
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
+read_engine = create_optimized_engine(
+    _read_database_url(), pool_size=settings.DB_READ_POOL_SIZE, max_overflow=settings.DB_READ_MAX_OVERFLOW
+)
+AsyncReadSessionLocal = async_sessionmaker(read_engine, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
 
-async def get_db():
+class ReadRouter:
+    """
+    Chọn session factory cho các request chỉ đọc.
+    Dùng read engine khi nó phản hồi và độ trễ (lag) dưới ngưỡng, ngược lại quay về primary.
+    Lag được ước lượng bằng chênh lệch MAX(devices.timestamp) giữa primary và replica,
+    vì mọi trạm gửi heartbeat liên tục.
+    """
+
+    def __init__(self, has_replica: bool, max_lag_seconds: float):
+        self.has_replica = has_replica
+        self.max_lag_seconds = max_lag_seconds
+        self.healthy = True
+        self.lag_seconds = 0.0
+        self.last_check = None
+        self.last_error = None
+        self.fallback_count = 0
+
+    def session_factory(self) -> async_sessionmaker:
+        return AsyncReadSessionLocal if self.healthy else AsyncSessionLocal
+
+    async def check(self) -> None:
+        """Probe read engine và cập nhật trạng thái. Được gọi định kỳ từ lifespan."""
+        try:
+            async with read_engine.connect() as conn:
+                replica_max = (await conn.execute(text("SELECT MAX(timestamp) FROM devices"))).scalar() or 0
+            if self.has_replica:
+                async with engine.connect() as conn:
+                    primary_max = (await conn.execute(text("SELECT MAX(timestamp) FROM devices"))).scalar() or 0
+                self.lag_seconds = float(max(0, primary_max - replica_max))
+            else:
+                self.lag_seconds = 0.0
+            self.last_error = None
+            healthy = self.lag_seconds <= self.max_lag_seconds
+        except Exception as e:
+            self.last_error = str(e)
+            healthy = False
+
+        if self.healthy and not healthy:
+            self.fallback_count += 1
+            logger.warning(f"Read engine unhealthy (lag={self.lag_seconds:.1f}s, error={self.last_error}). Falling back to primary.")
+        elif not self.healthy and healthy:
+            logger.info("Read engine healthy again. Routing reads back to it.")
+        self.healthy = healthy
+        self.last_check = time.time()
+
+    def status(self) -> dict:
+        return {
+            "has_replica": self.has_replica,
+            "routing_to": "read_engine" if self.healthy else "primary",
+            "lag_seconds": self.lag_seconds,
+            "max_lag_seconds": self.max_lag_seconds,
+            "fallback_count": self.fallback_count,
+            "last_check": self.last_check,
+            "last_error": self.last_error,
+        }
+
+read_router = ReadRouter(
+    has_replica=bool(settings.READ_DATABASE_URL), max_lag_seconds=settings.DB_REPLICA_MAX_LAG_SECONDS
+)
+
+def read_session():
+    """Session chỉ đọc, dùng ngoài dependency injection (vd. trong generator streaming)."""
+    return read_router.session_factory()()
+
+async def get_write_db():
     async with AsyncSessionLocal() as session:
         try:
             yield session
         finally:
             await session.close()
 
+async def get_read_db():
+    async with read_session() as session:
+        try:
+            yield session
+        finally:
+            await session.close()
+
+# Giữ tên cũ: mặc định là session ghi
+get_db = get_write_db
+
 # === DATABASE 2: Authentication (users) ===
 auth_engine = create_optimized_engine(settings.AUTH_DATABASE_URL)
 AsyncAuthSession = async_sessionmaker(auth_engine, expire_on_commit=False, autoflush=False)
@@ -0,0 +1,272 @@
+# ==============================================================================
+# == backend/app/db_stats.py - Thời gian câu lệnh SQL và độ bão hòa pool     ==
+# ==============================================================================
+#
+# Gắn event của SQLAlchemy vào từng engine:
+#   before/after_cursor_execute -> thời gian theo "fingerprint" câu lệnh
+#     (literal -> ?, danh sách IN (?, ?, ...) -> IN (?...)), đếm lỗi qua handle_error
+#   checkout/checkin của pool  -> số kết nối đang dùng, đỉnh, overflow, số lần
+#     checkout làm pool chạm trần (request tiếp theo phải chờ kết nối rảnh)
+# Chỉ dùng event và API công khai của pool (checkedout/overflow/size), không bọc
+# method nội bộ của SQLAlchemy.
+# Số liệu đi vào histogram Prometheus (gộp mọi worker) và sketch phân vị trong
+# process, dùng cho báo cáo câu lệnh chậm ở endpoint admin. Báo cáo pool kèm gợi ý
+# để chỉnh DB_POOL_SIZE / DB_MAX_OVERFLOW theo số liệu thực.
+
+import hashlib
+import logging
+import re
+import time
+from collections import deque
+from typing import Any, Dict
+
+from sqlalchemy import event
+
+from .database import settings
+from .logging_setup import request_id_ctx
+from .metrics import Counter, Gauge, Histogram
+from .monitoring import QuantileSketch
+
+logger = logging.getLogger(__name__)
+
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Thời gian thực thi câu lệnh SQL theo fingerprint", ("db", "statement"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Số câu lệnh SQL bị lỗi", ("db",))
+DB_POOL_SATURATED = Counter(
+    "db_pool_saturated_checkouts_total", "Số lần checkout làm mọi kết nối của pool (kể cả overflow) đều bận", ("db",)
+)
+DB_POOL_IN_USE = Gauge("db_pool_connections_in_use", "Số kết nối đang được checkout", ("db",))
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow_connections", "Số kết nối overflow (ngoài pool_size) đang mở", ("db",))
+
+# Giới hạn số fingerprint (và số series Prometheus); câu lệnh mới sau đó gộp vào "other"
+MAX_STATEMENTS = 500
+MAX_FINGERPRINT_CACHE = 4096
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER = r"(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)"
+_IN_LIST = re.compile(r"\(\s*" + _PLACEHOLDER + r"(?:\s*,\s*" + _PLACEHOLDER + r")+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """Chuẩn hóa câu lệnh: bỏ literal, gộp danh sách tham số IN, gộp khoảng trắng."""
+    sql = _STRING_LITERAL.sub("?", statement)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _IN_LIST.sub("(?...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+class StatementStats:
+    __slots__ = ("statement_id", "fingerprint", "count", "errors", "total_ms", "max_ms", "sketch")
+
+    def __init__(self, statement_id: str, fingerprint: str):
+        self.statement_id = statement_id
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.sketch = QuantileSketch()
+
+    def to_dict(self, percentiles=(50, 95, 99)) -> Dict[str, Any]:
+        result = {
+            "statement_id": self.statement_id,
+            "statement": self.fingerprint,
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+        }
+        for p in percentiles:
+            value = self.sketch.quantile(p / 100)
+            result[f"p{p:g}_ms"] = round(value, 3) if value is not None else None
+        return result
+
+
+class QueryStats:
+    """Thống kê câu lệnh của mọi engine trong worker này, khóa theo (db, fingerprint)."""
+
+    ORDERINGS = {
+        "total": lambda s: s.total_ms,
+        "count": lambda s: s.count,
+        "max": lambda s: s.max_ms,
+        "p99": lambda s: s.sketch.quantile(0.99) or 0.0,
+    }
+
+    def __init__(self, slow_ms: float):
+        self.slow_ms = slow_ms
+        self.started_at = time.time()
+        self.statements: Dict[tuple[str, str], StatementStats] = {}
+        self.slow_recent = deque(maxlen=100)
+        # Chuỗi SQL của SQLAlchemy lặp lại (compiled cache) nên cache kết quả chuẩn hóa
+        self._fingerprints: Dict[str, tuple[str, str]] = {}
+
+    def _identify(self, statement: str) -> tuple[str, str]:
+        cached = self._fingerprints.get(statement)
+        if cached is None:
+            if len(self._fingerprints) >= MAX_FINGERPRINT_CACHE:
+                self._fingerprints.clear()
+            fp = fingerprint(statement)
+            cached = self._fingerprints[statement] = (hashlib.sha1(fp.encode("utf-8")).hexdigest()[:10], fp)
+        return cached
+
+    def _stats_for(self, db: str, statement: str) -> StatementStats:
+        statement_id, fp = self._identify(statement)
+        key = (db, statement_id)
+        stats = self.statements.get(key)
+        if stats is None:
+            if len(self.statements) >= MAX_STATEMENTS:
+                key, statement_id, fp = (db, "other"), "other", "(other statements)"
+                stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats(statement_id, fp)
+        return stats
+
+    def record(self, db: str, statement: str, seconds: float):
+        stats = self._stats_for(db, statement)
+        ms = seconds * 1000
+        stats.count += 1
+        stats.total_ms += ms
+        if ms > stats.max_ms:
+            stats.max_ms = ms
+        stats.sketch.add(ms)
+        DB_QUERY_DURATION.labels(db, stats.statement_id).observe(seconds)
+        if ms >= self.slow_ms:
+            self.slow_recent.append({
+                "ts": time.time(), "db": db, "statement_id": stats.statement_id,
+                "duration_ms": round(ms, 3), "request_id": request_id_ctx.get(),
+            })
+            logger.info(f"Slow query on {db} ({ms:.1f}ms): {stats.fingerprint[:500]}")
+
+    def record_error(self, db: str, statement: str | None):
+        if statement:
+            self._stats_for(db, statement).errors += 1
+        DB_QUERY_ERRORS.labels(db).inc()
+
+    def report(self, top: int = 20, order: str = "total", db: str | None = None) -> Dict[str, Any]:
+        candidates = [s for (name, _), s in self.statements.items() if db is None or name == db]
+        by_db = {id(s): name for (name, _), s in self.statements.items()}
+        ranked = sorted(candidates, key=self.ORDERINGS[order], reverse=True)[:top]
+        fingerprints = {s.statement_id: s.fingerprint for s in self.statements.values()}
+        return {
+            "since": self.started_at,
+            "slow_threshold_ms": self.slow_ms,
+            "statement_count": len(candidates),
+            "statements": [{"db": by_db[id(s)], **s.to_dict()} for s in ranked],
+            "slow_recent": [
+                {**entry, "statement": fingerprints.get(entry["statement_id"], "")[:500]}
+                for entry in reversed(self.slow_recent) if db is None or entry["db"] == db
+            ],
+        }
+
+    def reset(self):
+        self.statements.clear()
+        self.slow_recent.clear()
+        self.started_at = time.time()
+
+
+class PoolStats:
+    """Số kết nối đang dùng, đỉnh, overflow và số lần chạm trần của pool một engine."""
+
+    def __init__(self, db: str, pool, max_overflow: int | None):
+        self.db = db
+        self.pool = pool
+        # Pool có kích thước cố định (QueuePool): trần = pool_size + max_overflow; NullPool/StaticPool: None
+        self.capacity = pool.size() + max(max_overflow, 0) if hasattr(pool, "size") and max_overflow is not None else None
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.saturated = 0
+
+    def _overflow(self) -> int:
+        overflow = getattr(self.pool, "overflow", None)
+        return max(overflow(), 0) if overflow else 0
+
+    def on_checkout(self, *_):
+        self.checkouts += 1
+        self.in_use += 1
+        if self.in_use > self.peak_in_use:
+            self.peak_in_use = self.in_use
+        if self.capacity is not None and self.pool.checkedout() >= self.capacity:
+            self.saturated += 1
+            DB_POOL_SATURATED.labels(self.db).inc()
+        DB_POOL_IN_USE.labels(self.db).set(self.in_use)
+        DB_POOL_OVERFLOW.labels(self.db).set(self._overflow())
+
+    def on_checkin(self, *_):
+        self.in_use = max(self.in_use - 1, 0)
+        DB_POOL_IN_USE.labels(self.db).set(self.in_use)
+        DB_POOL_OVERFLOW.labels(self.db).set(self._overflow())
+
+    def status(self) -> Dict[str, Any]:
+        size = self.pool.size() if hasattr(self.pool, "size") else None
+        capacity = self.capacity
+
+        # Gợi ý dựa trên số liệu: pool nghẽn (chạm trần) hay dư thừa
+        if capacity is None:
+            hint = f"{type(self.pool).__name__}: không có pool cố định, mỗi checkout mở kết nối mới"
+        elif self.saturated:
+            hint = "Pool bão hòa: tăng DB_POOL_SIZE/DB_MAX_OVERFLOW hoặc giảm DB_BULKHEAD_* để xếp hàng trước khi vào DB"
+        elif self.checkouts and self.peak_in_use < size / 2:
+            hint = f"Pool dư: đỉnh chỉ {self.peak_in_use}/{size} kết nối, có thể giảm DB_POOL_SIZE"
+        else:
+            hint = "OK"
+
+        return {
+            "pool_class": type(self.pool).__name__,
+            "pool_size": size,
+            "capacity": capacity,
+            "in_use": self.in_use,
+            "peak_in_use": self.peak_in_use,
+            "overflow": self._overflow(),
+            "checkouts": self.checkouts,
+            "saturated_checkouts": self.saturated,
+            "pool_status": self.pool.status(),
+            "hint": hint,
+        }
+
+
+query_stats = QueryStats(slow_ms=settings.DB_SLOW_QUERY_MS)
+pool_stats: Dict[str, PoolStats] = {}
+
+
+def instrument_engine(async_engine, db: str, max_overflow: int | None = None):
+    """
+    Gắn event đo thời gian câu lệnh và trạng thái pool vào một AsyncEngine.
+    `max_overflow` là giá trị đã truyền cho create_engine (pool không công khai giá trị này).
+    """
+    sync_engine = async_engine.sync_engine
+    if db in pool_stats:
+        return
+    stats = pool_stats[db] = PoolStats(db, sync_engine.pool, max_overflow)
+    event.listen(sync_engine, "checkout", stats.on_checkout)
+    event.listen(sync_engine, "checkin", stats.on_checkin)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if starts:
+            query_stats.record(db, statement, time.perf_counter() - starts.pop())
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context):
+        conn = context.connection
+        starts = conn.info.get("query_start") if conn is not None else None
+        if starts:
+            starts.pop()
+        query_stats.record_error(db, context.statement)
+
+
+def report(top: int = 20, order: str = "total", db: str | None = None) -> Dict[str, Any]:
+    return {
+        **query_stats.report(top, order, db),
+        "pools": {name: stats.status() for name, stats in pool_stats.items()},
+    }
@@ -0,0 +1,330 @@
+# ==============================================================================
+# == backend/app/drift.py - Giám sát lệch tọa độ base so với FIXED_LLA       ==
+# ==============================================================================
+#
+# Trạm chạy FIXED_LLA với tọa độ sai làm hỏng RTK của mọi rover dùng trạm đó.
+# Module này giữ fix GGA mới nhất và tọa độ cố định (base_config) của mọi trạm
+# trong các mảng NumPy theo slot; mỗi giây một lượt tính vector hóa cho cả đội
+# trạm: LLA -> ECEF, độ lệch ECEF -> ENU, độ lệch ngang/đứng, trung bình trượt
+# (EWMA) và trạng thái cảnh báo. Chỉ các trạm đổi trạng thái mới được lặp trong
+# Python để broadcast "drift_alert" đến UI.
+#
+# Cao độ so sánh là cao độ ellipsoid: GGA altitude + geoid_separation đối chiếu
+# với coords.alt của base_config (cùng quy ước với tọa độ đề xuất của survey).
+
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from .database import settings
+from .geodesy import WGS84_A, WGS84_E2
+from .websocket import manager
+
+logger = logging.getLogger(__name__)
+
+_INITIAL_CAPACITY = 256
+
+
+def _lla_to_ecef(lat_deg: np.ndarray, lon_deg: np.ndarray, height: np.ndarray) -> np.ndarray:
+    """Phiên bản vector của geodesy.lla_to_ecef: mảng (n,) -> (n, 3)."""
+    phi = np.radians(lat_deg)
+    lam = np.radians(lon_deg)
+    sin_phi = np.sin(phi)
+    cos_phi = np.cos(phi)
+    n = WGS84_A / np.sqrt(1 - WGS84_E2 * sin_phi * sin_phi)
+    return np.stack((
+        (n + height) * cos_phi * np.cos(lam),
+        (n + height) * cos_phi * np.sin(lam),
+        (n * (1 - WGS84_E2) + height) * sin_phi,
+    ), axis=-1)
+
+
+def _enu_rotations(lat_deg: np.ndarray, lon_deg: np.ndarray) -> np.ndarray:
+    """Phiên bản vector của geodesy.enu_rotation: mảng (n,) -> (n, 3, 3)."""
+    phi = np.radians(lat_deg)
+    lam = np.radians(lon_deg)
+    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+    sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+    zero = np.zeros_like(phi)
+    return np.stack((
+        np.stack((-sin_lam, cos_lam, zero), axis=-1),
+        np.stack((-sin_phi * cos_lam, -sin_phi * sin_lam, cos_phi), axis=-1),
+        np.stack((cos_phi * cos_lam, cos_phi * sin_lam, sin_phi), axis=-1),
+    ), axis=-2)
+
+
+def fixed_reference(base_config: dict) -> Optional[tuple[float, float, float]]:
+    """(lat, lon, alt) nếu base_config là FIXED_LLA có đủ tọa độ, ngược lại None."""
+    if not base_config or base_config.get("base_setup_method") != "FIXED_LLA":
+        return None
+    coords = base_config.get("coords") or {}
+    try:
+        return float(coords["lat"]), float(coords["lon"]), float(coords["alt"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class DriftMonitor:
+    """
+    Mỗi trạm một slot trong các mảng cột. Ghi GGA chỉ là vài phép gán phần tử;
+    evaluate() xử lý toàn bộ slot bằng phép toán mảng.
+    """
+
+    def __init__(self, horizontal_threshold: float, vertical_threshold: float,
+                 smoothing: float, stale_seconds: float, fix_qualities: Iterable[int] = (4,)):
+        self.horizontal_threshold = horizontal_threshold
+        self.vertical_threshold = vertical_threshold
+        self.smoothing = smoothing
+        self.stale_seconds = stale_seconds
+        # GGA fix quality được đánh giá (mặc định chỉ RTK fixed); fix khác chỉ được đếm
+        self.fix_qualities = frozenset(fix_qualities)
+        self.slots: Dict[str, int] = {}
+        self.serials: list[Optional[str]] = []
+        self._used = 0  # số slot đã cấp (kể cả slot đã trả về _free)
+        self._free: list[int] = []
+        self.evaluations = 0
+        self.last_evaluation_ms = 0.0
+        self._allocate(_INITIAL_CAPACITY)
+
+    def _allocate(self, capacity: int):
+        old = getattr(self, "_capacity", 0)
+
+        def grow(name, shape, dtype, fill):
+            array = np.full((capacity, *shape), fill, dtype=dtype)
+            if old:
+                array[:old] = getattr(self, name)
+            setattr(self, name, array)
+
+        # Tham chiếu FIXED_LLA (ECEF và ma trận xoay ENU tính sẵn khi base_config đổi)
+        grow("has_ref", (), bool, False)
+        grow("ref_ecef", (3,), np.float64, 0.0)
+        grow("ref_rotation", (3, 3), np.float64, 0.0)
+        # Fix mới nhất (LLA, cao độ ellipsoid) và thời điểm nhận
+        grow("fix_lat", (), np.float64, np.nan)
+        grow("fix_lon", (), np.float64, np.nan)
+        grow("fix_height", (), np.float64, np.nan)
+        grow("fix_time", (), np.float64, 0.0)
+        grow("ignored_fixes", (), np.int64, 0)
+        # Kết quả lượt đánh giá
+        grow("evaluated_time", (), np.float64, 0.0)
+        grow("offset_enu", (3,), np.float64, np.nan)
+        grow("horizontal", (), np.float64, np.nan)
+        grow("vertical", (), np.float64, np.nan)
+        grow("ewma_horizontal", (), np.float64, np.nan)
+        grow("ewma_vertical", (), np.float64, np.nan)
+        grow("max_horizontal", (), np.float64, 0.0)
+        grow("max_vertical", (), np.float64, 0.0)
+        grow("samples", (), np.int64, 0)
+        grow("exceedances", (), np.int64, 0)
+        grow("alerting", (), bool, False)
+        grow("alert_since", (), np.float64, 0.0)
+        self.serials.extend([None] * (capacity - old))
+        self._capacity = capacity
+
+    def _slot(self, serial: str) -> int:
+        slot = self.slots.get(serial)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = self._used
+                self._used += 1
+                if slot >= self._capacity:
+                    self._allocate(self._capacity * 2)
+            self.slots[serial] = slot
+            self.serials[slot] = serial
+        return slot
+
+    def _reset_stats(self, slot: int):
+        for name in ("horizontal", "vertical", "ewma_horizontal", "ewma_vertical"):
+            getattr(self, name)[slot] = np.nan
+        self.offset_enu[slot] = np.nan
+        self.max_horizontal[slot] = self.max_vertical[slot] = 0.0
+        self.samples[slot] = self.exceedances[slot] = 0
+
+    def remove(self, serial: str):
+        """Bỏ trạm (vd. thiết bị bị xóa); slot được dùng lại cho trạm mới."""
+        slot = self.slots.pop(serial, None)
+        if slot is None:
+            return
+        self.has_ref[slot] = False
+        self.alerting[slot] = False
+        self.alert_since[slot] = 0.0
+        self.fix_lat[slot] = self.fix_lon[slot] = self.fix_height[slot] = np.nan
+        self.fix_time[slot] = self.evaluated_time[slot] = 0.0
+        self.ignored_fixes[slot] = 0
+        self._reset_stats(slot)
+        self.serials[slot] = None
+        self._free.append(slot)
+
+    def set_reference(self, serial: str, base_config: dict):
+        """Cập nhật tọa độ cố định từ base_config; trạm không ở FIXED_LLA thì bỏ tham chiếu."""
+        reference = fixed_reference(base_config)
+        slot = self.slots.get(serial)
+        if reference is None:
+            if slot is not None and self.has_ref[slot]:
+                self.has_ref[slot] = False
+                self.alerting[slot] = False
+                self._reset_stats(slot)
+            return
+        slot = self._slot(serial)
+        lat, lon, alt = reference
+        ecef = _lla_to_ecef(np.array([lat]), np.array([lon]), np.array([alt]))[0]
+        if self.has_ref[slot] and np.array_equal(self.ref_ecef[slot], ecef):
+            return
+        self.ref_ecef[slot] = ecef
+        self.ref_rotation[slot] = _enu_rotations(np.array([lat]), np.array([lon]))[0]
+        self.has_ref[slot] = True
+        self._reset_stats(slot)
+
+    def record_gga(self, serial: str, gga: dict, now: Optional[float] = None):
+        lat = gga.get("latitude")
+        lon = gga.get("longitude")
+        alt = gga.get("altitude")
+        if lat is None or lon is None or alt is None:
+            return
+        slot = self._slot(serial)
+        if gga.get("fix_quality") not in self.fix_qualities:
+            # Không ghi đè fix_time: trạm chỉ còn fix kém sẽ hết hạn và cảnh báo chuyển "stale"
+            self.ignored_fixes[slot] += 1
+            return
+        self.fix_lat[slot] = lat
+        self.fix_lon[slot] = lon
+        self.fix_height[slot] = alt + (gga.get("geoid_separation") or 0.0)
+        self.fix_time[slot] = time.time() if now is None else now
+
+    def evaluate(self, now: Optional[float] = None) -> list[dict]:
+        """Một lượt tính cho cả đội trạm; trả về các cảnh báo mới bật/tắt."""
+        started = time.perf_counter()
+        now = time.time() if now is None else now
+        used = self._used
+        if not used:
+            return []
+        # Chỉ xét fix mới kể từ lượt trước (record_gga chỉ giữ fix đạt chất lượng), còn hạn, của trạm có tham chiếu
+        fresh = (
+            self.has_ref[:used]
+            & (self.fix_time[:used] > self.evaluated_time[:used])
+            & (now - self.fix_time[:used] <= self.stale_seconds)
+        )
+        idx = np.flatnonzero(fresh)
+        if idx.size:
+            fix = _lla_to_ecef(self.fix_lat[idx], self.fix_lon[idx], self.fix_height[idx])
+            enu = np.einsum("nij,nj->ni", self.ref_rotation[idx], fix - self.ref_ecef[idx])
+            horizontal = np.hypot(enu[:, 0], enu[:, 1])
+            vertical = enu[:, 2]
+
+            self.offset_enu[idx] = enu
+            self.horizontal[idx] = horizontal
+            self.vertical[idx] = vertical
+            self.evaluated_time[idx] = self.fix_time[idx]
+            alpha = self.smoothing
+            ewma_h = self.ewma_horizontal[idx]
+            ewma_v = self.ewma_vertical[idx]
+            ewma_h = np.where(np.isnan(ewma_h), horizontal, ewma_h + alpha * (horizontal - ewma_h))
+            ewma_v = np.where(np.isnan(ewma_v), vertical, ewma_v + alpha * (vertical - ewma_v))
+            self.ewma_horizontal[idx] = ewma_h
+            self.ewma_vertical[idx] = ewma_v
+            self.max_horizontal[idx] = np.maximum(self.max_horizontal[idx], horizontal)
+            self.max_vertical[idx] = np.maximum(self.max_vertical[idx], np.abs(vertical))
+            self.samples[idx] += 1
+            over = (horizontal > self.horizontal_threshold) | (np.abs(vertical) > self.vertical_threshold)
+            self.exceedances[idx] += over
+
+            # Bật theo EWMA vượt ngưỡng, tắt khi xuống dưới 80% ngưỡng (tránh bật/tắt liên tục)
+            alerting = self.alerting[idx]
+            raise_mask = (ewma_h > self.horizontal_threshold) | (np.abs(ewma_v) > self.vertical_threshold)
+            clear_mask = (ewma_h < 0.8 * self.horizontal_threshold) & (np.abs(ewma_v) < 0.8 * self.vertical_threshold)
+            new_state = np.where(alerting, ~clear_mask, raise_mask)
+            changed = idx[new_state != alerting]
+            self.alerting[idx] = new_state
+            self.alert_since[changed] = now
+        else:
+            changed = idx
+        # Trạm đang cảnh báo nhưng không còn fix mới thì không đánh giá được nữa: bỏ cảnh báo ("stale")
+        stale = np.flatnonzero(self.alerting[:used] & (now - self.fix_time[:used] > self.stale_seconds))
+        self.alerting[stale] = False
+        self.alert_since[stale] = now
+
+        events = [self._event(slot, "raised" if self.alerting[slot] else "cleared") for slot in changed.tolist()]
+        events += [self._event(slot, "stale") for slot in stale.tolist()]
+        # EWMA cũ không còn ý nghĩa khi fix trở lại sau một quãng gián đoạn: tính lại từ đầu
+        self.ewma_horizontal[stale] = np.nan
+        self.ewma_vertical[stale] = np.nan
+        self.evaluations += 1
+        self.last_evaluation_ms = (time.perf_counter() - started) * 1000
+        return events
+
+    def _event(self, slot: int, state: str) -> dict:
+        return {
+            "type": "drift_alert",
+            "serial": self.serials[slot],
+            "state": state,
+            "horizontal": round(float(self.ewma_horizontal[slot]), 4),
+            "vertical": round(float(self.ewma_vertical[slot]), 4),
+            "horizontal_threshold": self.horizontal_threshold,
+            "vertical_threshold": self.vertical_threshold,
+        }
+
+    def _stats(self, slot: int, now: float) -> dict:
+        def value(array):
+            v = float(array[slot])
+            return None if np.isnan(v) else round(v, 4)
+
+        east, north, up = (None if np.isnan(v) else round(float(v), 4) for v in self.offset_enu[slot])
+        return {
+            "serial": self.serials[slot],
+            "monitored": bool(self.has_ref[slot]),
+            "alerting": bool(self.alerting[slot]),
+            "alert_since": float(self.alert_since[slot]) if self.alerting[slot] else None,
+            "offset_enu": {"east": east, "north": north, "up": up},
+            "horizontal": value(self.horizontal),
+            "vertical": value(self.vertical),
+            "ewma_horizontal": value(self.ewma_horizontal),
+            "ewma_vertical": value(self.ewma_vertical),
+            "max_horizontal": round(float(self.max_horizontal[slot]), 4),
+            "max_vertical": round(float(self.max_vertical[slot]), 4),
+            "samples": int(self.samples[slot]),
+            "exceedances": int(self.exceedances[slot]),
+            "ignored_fixes": int(self.ignored_fixes[slot]),
+            "last_fix_seconds_ago": round(now - float(self.fix_time[slot]), 1) if self.fix_time[slot] else None,
+        }
+
+    def station(self, serial: str) -> Optional[dict]:
+        slot = self.slots.get(serial)
+        return self._stats(slot, time.time()) if slot is not None else None
+
+    def report(self, alerting_only: bool = False) -> dict:
+        now = time.time()
+        used = self._used
+        mask = self.has_ref[:used] & (self.alerting[:used] if alerting_only else True)
+        return {
+            "horizontal_threshold": self.horizontal_threshold,
+            "vertical_threshold": self.vertical_threshold,
+            "fix_qualities": sorted(self.fix_qualities),
+            "monitored": int(self.has_ref[:used].sum()),
+            "alerting": int(self.alerting[:used].sum()),
+            "last_evaluation_ms": round(self.last_evaluation_ms, 3),
+            "stations": [self._stats(slot, now) for slot in np.flatnonzero(mask).tolist()],
+        }
+
+    async def run(self, interval: float):
+        """Task nền: mỗi `interval` giây một lượt evaluate() và broadcast cảnh báo thay đổi."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                for event in self.evaluate():
+                    log = logger.warning if event["state"] == "raised" else logger.info
+                    log(f"Drift {event['state']} for '{event['serial']}': "
+                        f"horizontal={event['horizontal']} m, vertical={event['vertical']} m")
+                    await manager.broadcast(event)
+            except Exception as e:
+                logger.error(f"Lỗi khi kiểm tra lệch tọa độ base: {e}", exc_info=True)
+
+
+drift_monitor = DriftMonitor(
+    settings.DRIFT_HORIZONTAL_THRESHOLD_M, settings.DRIFT_VERTICAL_THRESHOLD_M,
+    settings.DRIFT_SMOOTHING, settings.DRIFT_STALE_SECONDS, settings.DRIFT_FIX_QUALITIES,
+)
@@ -0,0 +1,133 @@
+# ==============================================================================
+# == backend/app/export.py - Xuất dữ liệu trạm dạng streaming                ==
+# ==============================================================================
+#
+# Các hàm ở đây nhận một async iterator trả về từng "partition" (list thiết bị)
+# lấy từ server-side cursor và sinh ra các chunk bytes/str để đưa thẳng vào
+# StreamingResponse. Bộ nhớ chỉ phụ thuộc vào kích thước chunk, không phụ thuộc
+# vào số lượng trạm.
+
+import csv
+import io
+import json
+import time
+from typing import AsyncIterator, Iterable
+
+from . import models
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+EXPORT_COLUMNS = [
+    "serial", "name", "status", "timestamp", "human_readable_time",
+    "bps", "detected_chip_type", "user_id", "ntrip_connected",
+]
+
+
+def device_to_row(device: models.Device) -> list:
+    """Chuyển một thiết bị thành một dòng theo thứ tự EXPORT_COLUMNS."""
+    human_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(device.timestamp)) if device.timestamp else "N/A"
+    return [
+        device.serial, device.name, device.status, device.timestamp, human_time,
+        device.bps, device.detected_chip_type, device.user_id, device.ntrip_connected,
+    ]
+
+
+async def iter_csv(partitions: AsyncIterator[Iterable[models.Device]]) -> AsyncIterator[str]:
+    """Sinh CSV theo từng partition, dùng lại một buffer duy nhất."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+
+    async for partition in partitions:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(device_to_row(device) for device in partition)
+        yield buffer.getvalue()
+
+
+async def iter_ndjson(partitions: AsyncIterator[Iterable[models.Device]]) -> AsyncIterator[str]:
+    """Sinh NDJSON, mỗi thiết bị một dòng JSON."""
+    async for partition in partitions:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, device_to_row(device))), ensure_ascii=False) + "\n"
+            for device in partition
+        )
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    File-like object cho ParquetWriter: giữ lại bytes đã ghi để xả ra từng chunk,
+    nhưng tell() vẫn trả về vị trí tuyệt đối để offset trong footer Parquet đúng.
+    """
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def iter_parquet(partitions: AsyncIterator[Iterable[models.Device]]) -> AsyncIterator[bytes]:
+    """Sinh file Parquet, mỗi partition là một row group."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("serial", pa.string()), ("name", pa.string()), ("status", pa.string()),
+        ("timestamp", pa.int64()), ("human_readable_time", pa.string()),
+        ("bps", pa.int64()), ("detected_chip_type", pa.string()),
+        ("user_id", pa.int64()), ("ntrip_connected", pa.bool_()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    try:
+        async for partition in partitions:
+            columns = list(zip(*(device_to_row(device) for device in partition)))
+            if not columns:
+                continue
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                schema=schema,
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def is_format_available(fmt: str) -> bool:
+    """Parquet cần pyarrow (tùy chọn), các định dạng khác luôn có sẵn."""
+    if fmt != "parquet":
+        return fmt in EXPORT_FORMATS
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+ITERATORS = {
+    "csv": iter_csv,
+    "ndjson": iter_ndjson,
+    "parquet": iter_parquet,
+}
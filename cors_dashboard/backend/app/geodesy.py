@@ -0,0 +1,63 @@
+# ==============================================================================
+# == backend/app/geodesy.py - Chuyển đổi tọa độ WGS84 (ECEF <-> LLA)         ==
+# ==============================================================================
+#
+# Trạm base báo tọa độ theo ECEF (RTCM 1005/1006, UBX TMODE3 ECEF) trong khi
+# UI và cấu hình dùng vĩ độ/kinh độ/độ cao ellipsoid. Góc tính bằng độ, độ dài bằng mét.
+
+import math
+
+WGS84_A = 6378137.0                     # Bán trục lớn (m)
+WGS84_F = 1 / 298.257223563             # Độ dẹt
+WGS84_B = WGS84_A * (1 - WGS84_F)       # Bán trục nhỏ (m)
+WGS84_E2 = WGS84_F * (2 - WGS84_F)      # Bình phương tâm sai thứ nhất
+WGS84_EP2 = WGS84_E2 / (1 - WGS84_E2)   # Bình phương tâm sai thứ hai
+
+
+def lla_to_ecef(lat: float, lon: float, alt: float) -> tuple[float, float, float]:
+    """(độ, độ, m) -> (x, y, z) mét."""
+    phi = math.radians(lat)
+    lam = math.radians(lon)
+    sin_phi = math.sin(phi)
+    cos_phi = math.cos(phi)
+    n = WGS84_A / math.sqrt(1 - WGS84_E2 * sin_phi * sin_phi)
+    return (
+        (n + alt) * cos_phi * math.cos(lam),
+        (n + alt) * cos_phi * math.sin(lam),
+        (n * (1 - WGS84_E2) + alt) * sin_phi,
+    )
+
+
+def ecef_to_lla(x: float, y: float, z: float) -> tuple[float, float, float]:
+    """(x, y, z) mét -> (độ, độ, m). Công thức Bowring, sai số dưới 1 mm trên mặt đất."""
+    lon = math.atan2(y, x)
+    p = math.hypot(x, y)
+    if p < 1e-9:
+        # Trên trục cực
+        return (90.0 if z >= 0 else -90.0), math.degrees(lon), abs(z) - WGS84_B
+    theta = math.atan2(z * WGS84_A, p * WGS84_B)
+    sin_t = math.sin(theta)
+    cos_t = math.cos(theta)
+    phi = math.atan2(z + WGS84_EP2 * WGS84_B * sin_t ** 3, p - WGS84_E2 * WGS84_A * cos_t ** 3)
+    sin_phi = math.sin(phi)
+    n = WGS84_A / math.sqrt(1 - WGS84_E2 * sin_phi * sin_phi)
+    alt = p / math.cos(phi) - n
+    return math.degrees(phi), math.degrees(lon), alt
+
+
+def enu_rotation(lat: float, lon: float) -> tuple[tuple[float, float, float], ...]:
+    """Ma trận xoay 3x3 (theo hàng E, N, U) từ vector ECEF sang ENU tại (lat, lon)."""
+    phi = math.radians(lat)
+    lam = math.radians(lon)
+    sin_phi, cos_phi = math.sin(phi), math.cos(phi)
+    sin_lam, cos_lam = math.sin(lam), math.cos(lam)
+    return (
+        (-sin_lam, cos_lam, 0.0),
+        (-sin_phi * cos_lam, -sin_phi * sin_lam, cos_phi),
+        (cos_phi * cos_lam, cos_phi * sin_lam, sin_phi),
+    )
+
+
+def ecef_to_enu(dx: float, dy: float, dz: float, lat: float, lon: float) -> tuple[float, float, float]:
+    """Độ lệch ECEF (m) so với điểm gốc (lat, lon) -> (east, north, up) mét."""
+    return tuple(r[0] * dx + r[1] * dy + r[2] * dz for r in enu_rotation(lat, lon))
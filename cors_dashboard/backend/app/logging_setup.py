@@ -0,0 +1,185 @@
+# ==============================================================================
+# == backend/app/logging_setup.py - Log bất đồng bộ, JSON, có lấy mẫu       ==
+# ==============================================================================
+#
+# Code gọi logging (event loop, thread paho...) chỉ làm phần rẻ:
+#   gắn request_id/serial từ contextvar -> lấy mẫu theo category -> đẩy vào queue.
+# Một QueueListener ở thread riêng format JSON và ghi file (xoay theo kích thước)
+# cùng console, nên I/O đĩa và json.dumps không chạy trên hot path.
+#
+# Category của record là `extra={"category": ...}` nếu có, ngược lại là tên logger.
+# Record từ WARNING trở lên luôn được ghi, không bị lấy mẫu.
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: không khóa khi xoay file giữa các worker
+    fcntl = None
+
+from .database import settings
+
+# Request ID của request đang xử lý (đặt bởi InstrumentationMiddleware)
+request_id_ctx: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="N/A")
+# Serial trạm đang được xử lý (tin MQTT, WebSocket của Pi)
+serial_ctx: contextvars.ContextVar[str | None] = contextvars.ContextVar("serial", default=None)
+
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Một dòng JSON cho mỗi record: ts, level, logger, msg, pid, request_id, serial, category, exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id and request_id != "N/A":
+            entry["request_id"] = request_id
+        for field in ("serial", "category"):
+            value = getattr(record, field, None)
+            if value:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Handler gắn vào root logger. Chạy trong thread gọi log nên chỉ đọc contextvar,
+    lấy mẫu và put_nowait; queue đầy thì bỏ record và đếm thay vì chặn event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue, sample_rates: dict[str, float]):
+        super().__init__(log_queue)
+        self.sample_rates = dict(sample_rates)
+        self.listener: logging.handlers.QueueListener | None = None
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord):
+        if record.levelno < logging.WARNING and self.sample_rates:
+            rate = self.sample_rates.get(getattr(record, "category", None) or record.name)
+            if rate is not None and random.random() >= rate:
+                self.sampled_out += 1
+                return False
+        return super().filter(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Ghép args ngay (đối tượng có thể bị sửa trước khi listener ghi); exc_info để listener format
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_ctx.get()
+        if getattr(record, "serial", None) is None:
+            record.serial = serial_ctx.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "sample_rates": self.sample_rates,
+        }
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler cho nhiều worker cùng ghi một file.
+    Việc xoay file giữ flock trên `<file>.lock`; worker khác nhận ra file đã bị đổi
+    tên (inode khác) và mở file mới thay vì tiếp tục ghi vào file backup.
+    """
+
+    CHECK_INTERVAL_SECONDS = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._last_check = time.monotonic()
+
+    def _rotated_elsewhere(self) -> bool:
+        if self.stream is None:
+            return False
+        try:
+            on_disk = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        own = os.fstat(self.stream.fileno())
+        return (on_disk.st_dev, on_disk.st_ino) != (own.st_dev, own.st_ino)
+
+    def _reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record):
+        now = time.monotonic()
+        if now - self._last_check >= self.CHECK_INTERVAL_SECONDS:
+            self._last_check = now
+            if self._rotated_elsewhere():
+                self._reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if fcntl is None:
+            super().doRollover()
+            return
+        with open(self.baseFilename + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self._rotated_elsewhere():
+                    # Worker khác vừa xoay xong: chỉ cần mở file mới
+                    self._reopen()
+                else:
+                    super().doRollover()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def configure_logging() -> ContextQueueHandler:
+    """Cấu hình root logger với queue handler và khởi động thread ghi log."""
+    file_handler = SharedRotatingFileHandler(
+        settings.LOG_FILE, maxBytes=settings.LOG_MAX_BYTES,
+        backupCount=settings.LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    queue_handler = ContextQueueHandler(queue.Queue(settings.LOG_QUEUE_SIZE), settings.LOG_SAMPLE_RATES)
+    logging.basicConfig(level=settings.LOG_LEVEL, handlers=[queue_handler])
+
+    listener = logging.handlers.QueueListener(
+        queue_handler.queue, file_handler, console_handler, respect_handler_level=True
+    )
+    listener.start()
+    queue_handler.listener = listener
+    # stop() ghi nốt các record còn trong queue trước khi thoát
+    atexit.register(listener.stop)
+    return queue_handler
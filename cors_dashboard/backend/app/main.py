@@ -3,13 +3,12 @@
 # ==============================================================================
 
 import logging
-import uuid
 import json
 import asyncio
 import sys
 import traceback
 import base64
-import io
+import os
 import time
 import csv
 from contextlib import asynccontextmanager
@@ -17,19 +16,33 @@ from typing import Optional
 
 from fastapi import (
     FastAPI, WebSocket, WebSocketDisconnect, Depends, 
-    HTTPException, Request, Query, status
+    HTTPException, Request, Query, status, UploadFile, File
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse, JSONResponse 
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response, PlainTextResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text, select
-from starlette.middleware.base import BaseHTTPMiddleware
-from .monitoring import health_monitor, CircuitBreaker, global_rate_limiter
-from . import crud, models, schemas, command_builder, auth
+from .monitoring import (
+    health_monitor, loop_monitor, CircuitBreaker, CircuitBreakerOpen, BulkheadFull,
+    ingest_db_bulkhead, api_db_bulkhead, background_db_bulkhead
+)
+from .middleware import InstrumentationMiddleware
+from .logging_setup import configure_logging, serial_ctx
+from . import metrics
+from .tracing import ingest_tracer
+from .profiler import profiler, ProfilerBusy
+from . import db_stats
+from .rtcm import rtcm_monitor
+from .position_history import position_history, downsample
+from .survey import survey_monitor
+from .drift import drift_monitor
+from .spatial import station_index
+from .map_clusters import map_clusters, MAX_TILE_ZOOM
+from . import crud, models, schemas, command_builder, auth, export, user_import
 from .database import (
-    engine, auth_engine, get_db, get_auth_db, 
-    AuthBase, AsyncAuthSession, AsyncSessionLocal
+    engine, read_engine, auth_engine, get_db, get_read_db, get_auth_db, 
+    AuthBase, AsyncAuthSession, AsyncSessionLocal, read_router, read_session, settings
 )
 
 from .websocket import manager as ui_manager
@@ -44,47 +57,24 @@ if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log', encoding='utf-8'), 
-        logging.StreamHandler()
-    ]
-)
+# Ghi log qua queue: file JSON (xoay theo kích thước) và console ở thread riêng
+log_handler = configure_logging()
 
-mqtt_circuit_breaker = CircuitBreaker(failure_threshold=5, recovery_timeout=60)
-db_circuit_breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30)
+mqtt_circuit_breaker = CircuitBreaker(failure_threshold=5, recovery_timeout=60, name="mqtt_publish")
+db_circuit_breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30, name="db_heartbeat")
+
+# Thời gian câu lệnh SQL theo fingerprint và trạng thái pool của từng engine
+db_stats.instrument_engine(engine, "devices", settings.DB_MAX_OVERFLOW)
+db_stats.instrument_engine(read_engine, "devices_read", settings.DB_READ_MAX_OVERFLOW)
+db_stats.instrument_engine(auth_engine, "auth", settings.DB_MAX_OVERFLOW)
+
+# Session devices DB của request API chiếm một slot bulkhead "db_api" cho tới khi response xong
+get_db = api_db_bulkhead.wrap_dependency(get_db)
+get_read_db = api_db_bulkhead.wrap_dependency(get_read_db)
 
 logger = logging.getLogger(__name__)
 
-class RequestIDFilter(logging.Filter):
-    """Filter thêm request_id vào mọi log"""
-    def filter(self, record):
-        record.request_id = getattr(record, 'request_id', 'N/A')
-        return True
-
-# Thêm filter vào root logger
-for handler in logging.root.handlers:
-    handler.addFilter(RequestIDFilter())
-
-# --- CẢI TIẾN 2: REQUEST ID MIDDLEWARE ---
-class RequestIDMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        request_id = str(uuid.uuid4())
-        request.state.request_id = request_id
-        
-        # Ghi log mà không cần extra, vì filter sẽ tự thêm vào
-        logger.info(f"--> {request.method} {request.url.path}")
-        
-        start_time = time.time()
-        response = await call_next(request)
-        process_time = (time.time() - start_time) * 1000
-        
-        response.headers['X-Request-ID'] = request_id
-        logger.info(f"<-- {request.method} {request.url.path} - Completed in {process_time:.2f}ms, Status: {response.status_code}")
-        
-        return response
+_PI_MESSAGE_LOG = {"category": "pi.message"}
 
 # === HEARTBEAT CHECKER (FIXED) ===
 async def check_device_heartbeats_with_retry():
@@ -97,13 +87,18 @@ async def check_device_heartbeats_with_retry():
         
         for attempt in range(max_retries):
             try:
-                async with AsyncSessionLocal() as db:
-                    # Sử dụng circuit breaker
+                async with background_db_bulkhead, AsyncSessionLocal() as db:
+                    # Sử dụng circuit breaker (lỗi của coroutine được tính khi await xong)
                     await db_circuit_breaker.call(
                         _do_heartbeat_check, db, HEARTBEAT_TIMEOUT
                     )
                 break  # Success, thoát retry loop
             
+            except CircuitBreakerOpen as e:
+                # DB đang lỗi liên tục: bỏ qua lượt này, không retry
+                logger.warning(f"Heartbeat check skipped: {e}")
+                break
+            
             except Exception as e:
                 logger.error(f"Heartbeat check failed (attempt {attempt+1}/{max_retries}): {e}")
                 if attempt < max_retries - 1:
@@ -133,6 +128,9 @@ async def _do_heartbeat_check(db, timeout_threshold):
             device.ntrip_connected = False
         
         await db.commit()
+        metrics.HEARTBEAT_EXPIRIES.inc(len(timed_out_devices))
+        for device in timed_out_devices:
+            station_index.update_device(device)
         logger.info(f"Set {len(timed_out_devices)} devices to offline")
 
 async def check_device_heartbeats():
@@ -168,6 +166,7 @@ async def check_device_heartbeats():
                     device.ntrip_connected = False
                 
                 await db.commit()
+                metrics.HEARTBEAT_EXPIRIES.inc(len(timed_out_devices))
                 
                 logging.info(f"Set {len(timed_out_devices)} devices to offline due to timeout")
                 
@@ -181,12 +180,20 @@ async def check_device_heartbeats():
         except Exception as e:
             logging.error(f"Error in heartbeat check: {e}", exc_info=True)
 
-async def cleanup_rate_limiter():
-    """Dọn dẹp rate limiter định kỳ"""
+async def run_health_sampler():
+    """Cập nhật snapshot sức khỏe (system metrics + health_check) định kỳ"""
     while True:
-        await asyncio.sleep(300)  # Mỗi 5 phút
-        global_rate_limiter.cleanup()
-        logger.debug("Rate limiter cleanup completed")
+        try:
+            await health_monitor.refresh(probe=health_check)
+        except Exception as e:
+            logger.error(f"Health sampler failed: {e}", exc_info=True)
+        await asyncio.sleep(settings.HEALTH_SAMPLE_INTERVAL_SECONDS)
+
+async def monitor_read_replica():
+    """Kiểm tra định kỳ read engine (lag, kết nối) để quyết định route đọc"""
+    while True:
+        await read_router.check()
+        await asyncio.sleep(settings.DB_REPLICA_CHECK_INTERVAL)
 
 # === LIFESPAN ===
 @asynccontextmanager
@@ -228,13 +235,36 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"Failed to create default admin: {e}")
 
+    # Tính sẵn hash giả dùng cho timing equalisation khi login
+    await auth.password_hasher.dummy_hash()
+
+    # Tọa độ FIXED_LLA hiện có để giám sát lệch và tìm trạm gần nhất ngay từ đầu
+    try:
+        async with AsyncSessionLocal() as db_session:
+            for device in await crud.get_all_devices(db_session):
+                drift_monitor.set_reference(device.serial, device.base_config)
+                station_index.update_device(device, now=device.timestamp or 0)
+    except Exception as e:
+        logger.error(f"Failed to load fixed positions for drift monitor / spatial index: {e}")
+
+    loaded = position_history.load()
+    if loaded:
+        logger.info(f"✓ Loaded position history for {loaded} devices")
+
     mqtt_handler.start_mqtt_loop()
     
     # Start background tasks
     tasks = []
     try:
         tasks.append(asyncio.create_task(check_device_heartbeats_with_retry()))
-        tasks.append(asyncio.create_task(cleanup_rate_limiter()))
+        tasks.append(asyncio.create_task(monitor_read_replica()))
+        tasks.append(asyncio.create_task(run_health_sampler()))
+        tasks.append(asyncio.create_task(loop_monitor.run(
+            settings.LOOP_LAG_INTERVAL_SECONDS, settings.LOOP_STALL_THRESHOLD_SECONDS
+        )))
+        tasks.append(asyncio.create_task(position_history.run_persistence(settings.POSITION_HISTORY_PERSIST_SECONDS)))
+        tasks.append(asyncio.create_task(drift_monitor.run(settings.DRIFT_CHECK_INTERVAL_SECONDS)))
+        tasks.append(asyncio.create_task(map_clusters.run(settings.MAP_CLUSTER_SWEEP_SECONDS)))
         logger.info("✓ Background tasks started")
         
         yield
@@ -243,30 +273,45 @@ async def lifespan(app: FastAPI):
         logger.info("🛑 Application shutting down...")
         
         mqtt_handler.stop_mqtt_loop()
+        auth.password_hasher.shutdown()
         
         # Cancel all background tasks
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            await position_history.save()
+        except Exception as e:
+            logger.error(f"Failed to save position history: {e}")
         
         logger.info("✓ Shutdown complete")
 
 app = FastAPI(title="CORS Geodetic Backend", lifespan=lifespan)
-app.add_middleware(RequestIDMiddleware)
 
 # === COMMAND DISPATCHER ===
 async def send_command_to_pi(serial: str, command: dict) -> dict:
     if mqtt_client and mqtt_client.is_connected():
         topic = f"pi/devices/{serial}/command"
         message = json.dumps(command)
-        mqtt_handler.publish_message(topic, message)
-        return {"status": "command_sent", "channel": "mqtt", "command": command.get('command')}
+        try:
+            async with mqtt_circuit_breaker:
+                if not mqtt_handler.publish_message(topic, message):
+                    raise ConnectionError(f"MQTT publish to '{topic}' failed")
+            metrics.COMMANDS_DISPATCHED.labels("mqtt", "sent").inc()
+            return {"status": "command_sent", "channel": "mqtt", "command": command.get('command')}
+        except CircuitBreakerOpen:
+            metrics.COMMANDS_DISPATCHED.labels("mqtt", "circuit_open").inc()
+        except ConnectionError:
+            metrics.COMMANDS_DISPATCHED.labels("mqtt", "publish_failed").inc()
 
-    logging.warning(f"MQTT down. Trying WebSocket for '{serial}'.")
+    logging.warning(f"MQTT unavailable. Trying WebSocket for '{serial}'.")
     success = await pi_manager.send_personal_message(serial, command)
     if success:
+        metrics.COMMANDS_DISPATCHED.labels("websocket", "sent").inc()
         return {"status": "command_sent", "channel": "websocket", "command": command.get('command')}
 
+    metrics.COMMANDS_DISPATCHED.labels("none", "unavailable").inc()
     raise HTTPException(status_code=503, detail=f"Cannot send command to '{serial}'. Both MQTT and WebSocket are unavailable.")
 
 # === AUTHENTICATION ===
@@ -286,7 +331,7 @@ async def login(
     # Timing attack prevention
     # Luôn verify password kể cả khi user không tồn tại
     if not user:
-        await auth.verify_password(login_data.password, auth.pwd_context.hash("dummy"))
+        await auth.verify_dummy_password(login_data.password)
         logging.warning(f"Login attempt with non-existent username: {login_data.username}")
         raise HTTPException(
             status_code=401, 
@@ -334,6 +379,29 @@ async def get_users(db: AsyncSession = Depends(get_auth_db),
         response_list.append(user_resp)
     return response_list
 
+@app.get("/api/users/overview", response_model=list[schemas.UserWithDevices])
+async def get_users_with_devices(auth_db: AsyncSession = Depends(get_auth_db),
+                                 devices_db: AsyncSession = Depends(get_read_db),
+                                 current_user: models.User = Depends(auth.require_permission(auth.Permission.MANAGE_USERS))):
+    """
+    Danh sách user kèm tóm tắt các trạm được gán, trong một request.
+    Users và devices nằm ở hai database khác nhau: mỗi bên một query, ghép trong bộ nhớ.
+    """
+    users, devices_by_user = await asyncio.gather(
+        crud.get_all_users(auth_db),
+        crud.get_assigned_device_summaries(devices_db)
+    )
+    response_list = []
+    for u in users:
+        devices = devices_by_user.get(u.id, [])
+        user_resp = schemas.UserWithDevices.from_orm(u)
+        user_resp.permissions = auth.get_user_permissions(u)
+        user_resp.devices = [schemas.DeviceSummary.from_orm(d) for d in devices]
+        user_resp.device_count = len(devices)
+        user_resp.online_count = sum(1 for d in devices if d.status == 'online')
+        response_list.append(user_resp)
+    return response_list
+
 @app.get("/api/users/{user_id}", response_model=schemas.UserResponse)
 async def get_user_details(user_id: int, db: AsyncSession = Depends(get_auth_db),
                            current_user: models.User = Depends(auth.require_permission(auth.Permission.MANAGE_USERS))):
@@ -360,16 +428,15 @@ async def create_user(user_data: schemas.UserCreate,
         role=user_data.role, full_name=user_data.full_name
     )
     
+    assignment = None
     if user_data.assigned_devices and new_user.role == 'coordinator':
-        for serial in user_data.assigned_devices:
-            device = await crud.get_device_by_serial(devices_db, serial)
-            if device:
-                device.user_id = new_user.id
-        await devices_db.commit()
+        assignment = await crud.assign_devices_to_user(devices_db, new_user.id, user_data.assigned_devices)
     
     permissions = auth.get_user_permissions(new_user)
     user_response = schemas.UserResponse.from_orm(new_user)
     user_response.permissions = permissions
+    if assignment is not None:
+        user_response.device_assignment = schemas.DeviceAssignmentResult(**assignment)
     return user_response
 
 @app.put("/api/users/{user_id}", response_model=schemas.UserResponse)
@@ -383,29 +450,50 @@ async def update_user(user_id: int, user_data: schemas.UserUpdate,
 
     update_dict = user_data.dict(exclude_unset=True)
     
+    assignment = None
     assigned_serials = update_dict.pop("assigned_devices", None)
     if assigned_serials is not None:
-        current_devices = await crud.get_devices_by_user_id(devices_db, user_id)
-        for dev in current_devices:
-            dev.user_id = None
-        
-        if user_to_update.role == 'coordinator':
-            for serial in assigned_serials:
-                device = await crud.get_device_by_serial(devices_db, serial)
-                if device and (device.user_id is None or device.user_id == user_id):
-                    device.user_id = user_id
-        await devices_db.commit()
+        if update_dict.get('role', user_to_update.role) == 'coordinator':
+            assignment = await crud.assign_devices_to_user(devices_db, user_id, assigned_serials, replace=True)
+        else:
+            await crud.unassign_devices_from_user(devices_db, user_id)
 
     if 'password' in update_dict and update_dict['password']:
         update_dict['hashed_password'] = await auth.get_password_hash(update_dict.pop('password'))
     
     updated_user = await crud.update_user(auth_db, user_id, update_dict)
+    auth.principal_cache.invalidate_all()
     
     permissions = auth.get_user_permissions(updated_user)
     user_response = schemas.UserResponse.from_orm(updated_user)
     user_response.permissions = permissions
+    if assignment is not None:
+        user_response.device_assignment = schemas.DeviceAssignmentResult(**assignment)
     return user_response
 
+@app.post("/api/users/import", response_model=schemas.UserImportReport)
+async def import_users(file: UploadFile = File(...),
+                       auth_db: AsyncSession = Depends(get_auth_db),
+                       devices_db: AsyncSession = Depends(get_db),
+                       current_user: models.User = Depends(auth.require_permission(auth.Permission.MANAGE_USERS))):
+    """
+    Import hàng loạt user và gán trạm từ file CSV hoặc JSON.
+    Áp dụng theo batch và trả về kết quả cho từng dòng.
+    """
+    content = await file.read(user_import.MAX_IMPORT_BYTES + 1)
+    if len(content) > user_import.MAX_IMPORT_BYTES:
+        raise HTTPException(status_code=413, detail="Import file too large")
+    try:
+        rows = user_import.parse_import_file(content, file.filename, file.content_type)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid import file: {e}")
+    if not rows:
+        raise HTTPException(status_code=400, detail="Import file contains no rows")
+
+    report = await user_import.apply_import(rows, auth_db, devices_db)
+    logging.info(f"User '{current_user.username}' imported users: {report.created} created, {report.updated} updated, {report.failed} failed")
+    return report
+
 @app.delete("/api/users/{user_id}")
 async def delete_user(user_id: int, db: AsyncSession = Depends(get_auth_db),
                       current_user: models.User = Depends(auth.require_permission(auth.Permission.MANAGE_USERS))):
@@ -415,6 +503,7 @@ async def delete_user(user_id: int, db: AsyncSession = Depends(get_auth_db),
     success = await crud.delete_user(db, user_id)
     if not success:
         raise HTTPException(status_code=404, detail="User not found")
+    auth.principal_cache.invalidate_all()
     
     return {"status": "deleted", "user_id": user_id}
 
@@ -444,7 +533,7 @@ async def generate_pi_license(
 @app.get("/api/devices", response_model=list[schemas.Device])
 async def get_initial_devices(
     user_id: Optional[int] = Query(None),
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
     # Dùng `require_permission` thay vì kiểm tra thủ công
     current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES)) 
 ):
@@ -462,6 +551,179 @@ async def get_initial_devices(
     # Mặc định (Admin, Viewer) sẽ lấy tất cả
     return await crud.get_all_devices(db)
 
+def _station_filter(status: Optional[str], own: Optional[set]):
+    """Predicate cho truy vấn chỉ mục không gian: lọc theo trạng thái và trạm được phép xem."""
+    if status is None and own is None:
+        return None
+    now = time.time()
+    return lambda station: (
+        (status is None or station.effective_status(now) == status)
+        and (own is None or station.serial in own)
+    )
+
+async def _own_serials(db: AsyncSession, current_user: models.User) -> Optional[set]:
+    if current_user.role != auth.Role.COORDINATOR:
+        return None
+    return {device.serial for device in await crud.get_devices_by_user_id(db, user_id=current_user.id)}
+
+@app.get("/api/devices/nearest")
+async def get_nearest_devices(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    k: int = Query(5, ge=1, le=100),
+    status: Optional[str] = Query(None, description="vd. online"),
+    max_distance_km: Optional[float] = Query(None, gt=0),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    """k trạm gần điểm (lat, lon) nhất, theo tọa độ FIXED_LLA hoặc fix GGA gần nhất của trạm."""
+    predicate = _station_filter(status, await _own_serials(db, current_user))
+    now = time.time()
+    results = station_index.nearest(
+        lat, lon, k, predicate, max_distance_km * 1000 if max_distance_km else None
+    )
+    return [{**station.to_dict(now), "distance_m": round(distance, 1)} for distance, station in results]
+
+@app.get("/api/devices/within")
+async def get_devices_within(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    status: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    """Trạm trong khung tọa độ; min_lon > max_lon cho khung vắt qua kinh tuyến 180."""
+    if min_lat > max_lat:
+        raise HTTPException(status_code=400, detail="min_lat phải nhỏ hơn hoặc bằng max_lat")
+    predicate = _station_filter(status, await _own_serials(db, current_user))
+    now = time.time()
+    return [station.to_dict(now) for station in station_index.within(min_lat, min_lon, max_lat, max_lon, predicate)]
+
+@app.get("/api/map/clusters/{z}/{x}/{y}")
+async def get_map_clusters(
+    z: int, x: int, y: int,
+    request: Request,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    """
+    Cụm trạm (GeoJSON) của tile bản đồ z/x/y, kèm số trạm online/offline/ntrip_down mỗi cụm.
+    Gửi lại ETag trong If-None-Match để nhận 304 khi tile chưa đổi.
+    """
+    if not 0 <= z <= MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Tile z/x/y không hợp lệ")
+    own = await _own_serials(db, current_user)
+    if own is None and z <= map_clusters.max_zoom:
+        etag, body = map_clusters.tile(z, x, y)
+    else:
+        etag, body = map_clusters.tile_for(z, x, y, _station_filter(None, own))
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/geo+json", headers=headers)
+
+@app.get("/api/devices/{serial}/config-history", response_model=list[schemas.DeviceConfigHistoryEntry])
+async def get_device_config_history(
+    serial: str,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_CONFIG))
+):
+    """Lịch sử thay đổi base_config / service_config của một trạm, mới nhất trước."""
+    if current_user.role == auth.Role.COORDINATOR:
+        device = await crud.get_device_by_serial(db, serial)
+        if not device or device.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="Bạn chỉ có thể xem trạm được gán cho mình")
+
+    rows = await crud.get_device_config_history(db, serial, limit=limit)
+    return [
+        schemas.DeviceConfigHistoryEntry(
+            kind=entry.kind, config_hash=entry.config_hash, changed_at=entry.changed_at,
+            content=config.content if config else {}
+        )
+        for entry, config in rows
+    ]
+
+@app.get("/api/rtcm/stations")
+async def get_rtcm_stations(
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    """Tần suất từng loại tin RTCM3 và tọa độ ARP (1005/1006) của các trạm đang phát RTCM."""
+    report = rtcm_monitor.report()
+    if current_user.role == auth.Role.COORDINATOR:
+        own = {device.serial for device in await crud.get_devices_by_user_id(db, user_id=current_user.id)}
+        report = [station for station in report if station["serial"] in own]
+    return report
+
+@app.get("/api/devices/{serial}/rtcm")
+async def get_device_rtcm(
+    serial: str,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    if current_user.role == auth.Role.COORDINATOR:
+        device = await crud.get_device_by_serial(db, serial)
+        if not device or device.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="Bạn chỉ có thể xem trạm được gán cho mình")
+    status = rtcm_monitor.status(serial)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Chưa nhận được dữ liệu RTCM từ trạm này")
+    return status
+
+@app.get("/api/devices/{serial}/positions")
+async def get_device_positions(
+    serial: str,
+    start: Optional[float] = Query(None, description="Epoch giây; mặc định: điểm cũ nhất còn giữ"),
+    end: Optional[float] = Query(None, description="Epoch giây; mặc định: hiện tại"),
+    points: int = Query(500, ge=3, le=5000),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    """
+    Lịch sử GGA (t, lat, lon, alt, hdop, fix) của trạm trong [start, end], giảm mẫu LTTB
+    còn tối đa `points` điểm để vẽ biểu đồ vị trí/độ cao.
+    """
+    if current_user.role == auth.Role.COORDINATOR:
+        device = await crud.get_device_by_serial(db, serial)
+        if not device or device.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="Bạn chỉ có thể xem trạm được gán cho mình")
+    window = position_history.window(serial, start, end)
+    if window is None:
+        raise HTTPException(status_code=404, detail="Chưa có lịch sử vị trí của trạm này")
+    # window là bản sao nên LTTB chạy trong thread, không chặn event loop
+    return await asyncio.to_thread(downsample, window, points)
+
+@app.get("/api/drift")
+async def get_drift_report(
+    alerting_only: bool = Query(False),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    """Độ lệch GGA so với tọa độ FIXED_LLA của các trạm đang được giám sát."""
+    report = drift_monitor.report(alerting_only)
+    if current_user.role == auth.Role.COORDINATOR:
+        own = {device.serial for device in await crud.get_devices_by_user_id(db, user_id=current_user.id)}
+        report["stations"] = [station for station in report["stations"] if station["serial"] in own]
+    return report
+
+@app.get("/api/devices/{serial}/drift")
+async def get_device_drift(
+    serial: str,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    if current_user.role == auth.Role.COORDINATOR:
+        device = await crud.get_device_by_serial(db, serial)
+        if not device or device.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="Bạn chỉ có thể xem trạm được gán cho mình")
+    stats = drift_monitor.station(serial)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Trạm chưa có tọa độ FIXED_LLA hoặc chưa gửi GGA")
+    return stats
+
 @app.post("/api/devices/{serial}/command")
 async def send_generic_command(serial: str, command: schemas.Command,
                                current_user: models.User = Depends(auth.get_current_user)):
@@ -472,6 +734,38 @@ async def send_generic_command(serial: str, command: schemas.Command,
     
     return await send_command_to_pi(serial, command.model_dump())
 
+async def dispatch_chip_config(serial: str, payload: dict) -> dict:
+    """Biên dịch cấu hình chip (payload dạng configure-chip: sensor_type, mode, params) và gửi xuống Pi."""
+    mode = payload.get("mode")
+    method = payload.get("params", {}).get("base_setup_method")
+    sensor_type = payload.get("sensor_type")
+    params = payload.get("params", {})
+    commands_to_send = []
+
+    # Byte lệnh được cache theo (chip, thao tác, tham số) nên cấu hình nhiều trạm giống nhau không phải biên dịch lại
+    if mode == "BASE":
+        if method == "SURVEY_IN":
+            commands_to_send = command_builder.compile_commands(
+                sensor_type, "survey_in", duration=params['survey_in_duration'], accuracy=params['survey_in_accuracy'])
+        elif method == "FIXED_LLA":
+            coords = params['coords']
+            commands_to_send = command_builder.compile_commands(
+                sensor_type, "fixed_lla", lat=coords['lat'], lon=coords['lon'], alt=coords['alt'], accuracy=params.get('accuracy', 10.0))
+    elif mode == "ROVER":
+        commands_to_send = command_builder.compile_commands(sensor_type, "rover")
+    
+    if not commands_to_send:
+        raise HTTPException(status_code=400, detail="Invalid configuration parameters.")
+
+    encoded_commands = [base64.b64encode(cmd).decode('ascii') for cmd in commands_to_send if cmd]
+    
+    pi_command = {"command": "EXECUTE_RAW_COMMANDS", "payload": {"commands_b64": encoded_commands},  "original_config": payload}
+    
+    response = await send_command_to_pi(serial, pi_command)
+    
+    logging.info(f"✓ Sent {len(commands_to_send)} commands to {serial} via {response['channel']}")
+    return {"status": "chip_config_sent", "channel": response['channel'], "commands_sent": len(commands_to_send)}
+
 @app.post("/api/devices/{serial}/configure-chip")
 async def configure_chip_endpoint(serial: str, config_request: schemas.Command,
                                   current_user: models.User = Depends(auth.get_current_user)):
@@ -487,33 +781,88 @@ async def configure_chip_endpoint(serial: str, config_request: schemas.Command,
          raise HTTPException(status_code=403, detail="Permission denied.")
     
     try:
-        sensor_type = payload.get("sensor_type")
-        params = payload.get("params", {})
-        commands_to_send = []
-
-        if mode == "BASE":
-            if method == "SURVEY_IN":
-                commands_to_send = command_builder.build_base_survey_in_command(sensor_type, params['survey_in_duration'], params['survey_in_accuracy'])
-            elif method == "FIXED_LLA":
-                coords = params['coords']
-                commands_to_send = command_builder.build_base_fixed_lla_command(sensor_type, coords['lat'], coords['lon'], coords['alt'], params.get('accuracy', 10.0))
-        
-        if not commands_to_send:
-            raise HTTPException(status_code=400, detail="Invalid configuration parameters.")
-
-        encoded_commands = [base64.b64encode(cmd).decode('ascii') for cmd in commands_to_send if cmd]
-        
-        pi_command = {"command": "EXECUTE_RAW_COMMANDS", "payload": {"commands_b64": encoded_commands},  "original_config": config_request.payload}
-        
-        response = await send_command_to_pi(serial, pi_command)
-        
-        logging.info(f"✓ Sent {len(commands_to_send)} commands to {serial} via {response['channel']}")
-        return {"status": "chip_config_sent", "channel": response['channel'], "commands_sent": len(commands_to_send)}
+        return await dispatch_chip_config(serial, payload)
 
     except Exception as e:
         logging.error(f"Error configuring chip for {serial}: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/devices/{serial}/survey")
+async def get_device_survey(
+    serial: str,
+    target_accuracy: Optional[float] = Query(None, gt=0, description="Mét; mặc định SURVEY_TARGET_ACCURACY_M"),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DEVICES))
+):
+    """Trạng thái ước lượng tọa độ base từ GGA: độ lệch chuẩn, tốc độ hội tụ và tọa độ FIXED_LLA đề xuất."""
+    if current_user.role == auth.Role.COORDINATOR:
+        device = await crud.get_device_by_serial(db, serial)
+        if not device or device.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="Bạn chỉ có thể xem trạm được gán cho mình")
+    report = survey_monitor.report(serial, target_accuracy)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Chưa nhận được GGA từ trạm này")
+    return report
+
+@app.delete("/api/devices/{serial}/survey")
+async def reset_device_survey(
+    serial: str,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.EDIT_COORDINATES))
+):
+    """Bắt đầu ước lượng lại từ đầu (vd. sau khi di chuyển anten)."""
+    if current_user.role == auth.Role.COORDINATOR:
+        device = await crud.get_device_by_serial(db, serial)
+        if not device or device.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="Bạn chỉ có thể cấu hình trạm được gán cho mình")
+    return {"status": "survey_reset" if survey_monitor.reset(serial) else "no_survey"}
+
+@app.post("/api/devices/{serial}/survey/apply")
+async def apply_device_survey(
+    serial: str,
+    force: bool = Query(False, description="Đẩy tọa độ kể cả khi chưa hội tụ"),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.EDIT_COORDINATES))
+):
+    """Đặt trạm sang BASE / FIXED_LLA với tọa độ đề xuất của bộ ước lượng (cùng đường với configure-chip)."""
+    device = await crud.get_device_by_serial(db, serial)
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+    if current_user.role == auth.Role.COORDINATOR and device.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Bạn chỉ có thể cấu hình trạm được gán cho mình")
+
+    report = survey_monitor.report(serial)
+    if report is None or report["recommended"] is None:
+        raise HTTPException(status_code=404, detail="Chưa nhận được GGA từ trạm này")
+    if not report["fix_rank_ok"]:
+        # Tọa độ từ fix autonomous/DGPS/float sai hàng mét: không đẩy làm tọa độ base kể cả khi force
+        raise HTTPException(
+            status_code=409,
+            detail=f"Chưa có fix đạt hạng {report['min_fix_rank']}; không thể áp dụng tọa độ"
+        )
+    if not report["converged"] and not force:
+        raise HTTPException(status_code=409, detail="Ước lượng chưa hội tụ; dùng force=true để vẫn áp dụng")
+
+    recommended = report["recommended"]
+    payload = {
+        "sensor_type": device.detected_chip_type,
+        "mode": "BASE",
+        "params": {
+            "base_setup_method": "FIXED_LLA",
+            "coords": {"lat": recommended["lat"], "lon": recommended["lon"], "alt": recommended["alt"]},
+            "accuracy": recommended["accuracy"],
+        },
+    }
+    try:
+        result = await dispatch_chip_config(serial, payload)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error applying survey for {serial}: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=str(e))
+    logging.info(f"User '{current_user.username}' applied surveyed position to {serial}: {recommended}")
+    return {**result, "applied": payload["params"], "survey": report}
+
 @app.post("/api/devices/{serial}/reset")
 async def reset_pi_device(
     serial: str,
@@ -564,6 +913,8 @@ async def delete_device_from_list(
     # Xóa khỏi database
     await db.delete(device)
     await db.commit()
+    station_index.remove(serial)
+    drift_monitor.remove(serial)
     
     logging.info(f"User '{current_user.username}' deleted device '{serial}' from list (not reset)")
     
@@ -601,30 +952,59 @@ async def unlock_device(serial: str,
         logging.error(f"Error in unlock_device endpoint: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
-@app.get("/api/devices/export/csv")
-async def export_devices_to_csv(db: AsyncSession = Depends(get_db),
-                                current_user: models.User = Depends(auth.require_permission(auth.Permission.EXPORT_DATA))):
-    stream = io.StringIO()
-    writer = csv.writer(stream)
-    headers = ["serial", "name", "status", "timestamp", "human_readable_time", "bps", "detected_chip_type", "user_id", "ntrip_connected"]
-    writer.writerow(headers)
-    devices = await crud.get_all_devices(db)
-    for device in devices:
-        human_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(device.timestamp)) if device.timestamp else "N/A"
-        writer.writerow([device.serial, device.name, device.status, device.timestamp, human_time, device.bps, device.detected_chip_type, device.user_id, device.ntrip_connected])
-    
-    response = StreamingResponse(iter([stream.getvalue()]), media_type="text/csv")
-    response.headers["Content-Disposition"] = f"attachment; filename=cors_devices_{time.strftime('%Y%m%d')}.csv"
+@app.get("/api/devices/export/{export_format}")
+async def export_devices(export_format: str,
+                         since: Optional[int] = Query(None, description="Chỉ xuất trạm cập nhật từ thời điểm này (epoch giây)"),
+                         until: Optional[int] = Query(None, description="Chỉ xuất trạm cập nhật đến thời điểm này (epoch giây)"),
+                         chunk_size: int = Query(500, ge=50, le=5000),
+                         current_user: models.User = Depends(auth.require_permission(auth.Permission.EXPORT_DATA))):
+    """
+    Xuất danh sách trạm dạng streaming (csv, ndjson, parquet).
+    Dữ liệu được đọc qua server-side cursor theo từng chunk nên bộ nhớ không tăng
+    theo số trạm và client bắt đầu nhận dữ liệu ngay.
+    """
+    if export_format not in export.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format. Use one of: {list(export.EXPORT_FORMATS)}")
+    if not export.is_format_available(export_format):
+        raise HTTPException(status_code=501, detail="Parquet export requires 'pyarrow' to be installed.")
+    if since is not None and until is not None and since > until:
+        raise HTTPException(status_code=400, detail="'since' must be before 'until'")
+
+    async def partitions():
+        # Session riêng cho generator: session của Depends đã đóng trước khi body được stream
+        async with read_session() as db:
+            async for partition in crud.stream_devices(db, since=since, until=until, chunk_size=chunk_size):
+                yield partition
+
+    media_type, extension = export.EXPORT_FORMATS[export_format]
+    response = StreamingResponse(export.ITERATORS[export_format](partitions()), media_type=media_type)
+    response.headers["Content-Disposition"] = f"attachment; filename=cors_devices_{time.strftime('%Y%m%d')}.{extension}"
     return response
 
 # === WEBSOCKETS ===
+def _handle_ui_message(message: str):
+    """Tin nhắn từ trình duyệt: hiện chỉ có báo cáo độ trễ vẽ frame (render_lag)."""
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return
+    if not isinstance(data, dict) or data.get("type") != "render_lag":
+        return
+    samples = data.get("samples")
+    if not isinstance(samples, list):
+        return
+    for sample in samples[:100]:
+        if isinstance(sample, dict):
+            ingest_tracer.record_browser(sample.get("render_ms"), sample.get("delivery_ms"))
+
 @app.websocket("/ws/updates")
 async def ui_websocket_endpoint(websocket: WebSocket):
     await ui_manager.connect(websocket)
     logging.info("New UI client connected.")
     try:
         while True: 
-            await websocket.receive_text()
+            message = await websocket.receive_text()
+            _handle_ui_message(message)
     except WebSocketDisconnect:
         ui_manager.disconnect(websocket)
         logging.info("UI client disconnected.")
@@ -635,39 +1015,64 @@ async def pi_websocket_endpoint(
     serial: str
 ):
     await pi_manager.connect(serial, websocket)
-    print(f"\n✅ DEBUG 0: Pi '{serial}' CONNECTED to WebSocket.")
+    serial_ctx.set(serial)
+    logging.info(f"Pi '{serial}' connected to WebSocket.")
     try:
         # Vòng lặp nhận tin nhắn từ Pi
         while True:
-            # Dùng AsyncSessionLocal để tạo một session database mới và an toàn cho mỗi tin nhắn
-            async with AsyncSessionLocal() as db:
-                data = await websocket.receive_json()
-                
-                message_type = data.get("type")
-                payload = data.get("payload")
+            data = await websocket.receive_json()
+            
+            message_type = data.get("type")
+            payload = data.get("payload")
 
-                logging.debug(f"Received from Pi '{serial}', type: {message_type}")
+            logging.debug("Received from Pi '%s', type: %s", serial, message_type, extra=_PI_MESSAGE_LOG)
 
+            # Session database mới cho mỗi tin nhắn, mở sau khi đã nhận tin từ Pi
+            async with AsyncSessionLocal() as db:
                 if message_type == "status_update" and payload:
-                    device_obj = await crud.update_or_create_device(db, device_data=payload)
+                    trace = ingest_tracer.start("status", serial, "websocket")
+                    trace.set_device_timestamp(payload.get("timestamp"))
+                    start = time.perf_counter()
+                    try:
+                        async with ingest_db_bulkhead:
+                            device_obj = await crud.update_or_create_device(db, device_data=payload)
+                    except BulkheadFull as e:
+                        logging.warning(f"Dropped status from Pi '{serial}': {e}")
+                        continue
+                    trace.mark_db_commit()
+                    elapsed = time.perf_counter() - start
+                    metrics.DB_UPSERT_DURATION.labels("websocket").observe(elapsed)
+                    health_monitor.record_latency('db', elapsed * 1000)
 
                     if device_obj:
+                        drift_monitor.set_reference(device_obj.serial, device_obj.base_config)
+                        station_index.update_device(device_obj)
                         device_schema = schemas.Device.from_orm(device_obj)
                         await ui_manager.broadcast({
                             "type": "status_update", 
                             "data": device_schema.model_dump()
                         })
+                        trace.mark_broadcast()
+                        ingest_tracer.finish(trace)
                     else:
                         logging.error(f"Failed to update or create device for serial '{serial}' in DB. Payload received: {payload}")
 
                 elif message_type == "nmea_update" and payload: 
+                    trace = ingest_tracer.start("nmea", serial, "websocket")
                     parsed_data = nmea_parser.parse(payload)
                     if parsed_data:
+                        if parsed_data.get("type") == "GGA":
+                            position_history.record_gga(serial, parsed_data)
+                            survey_monitor.record_gga(serial, parsed_data)
+                            drift_monitor.record_gga(serial, parsed_data)
+                            station_index.update_fix(serial, parsed_data)
                         await ui_manager.broadcast({
                             "type": "nmea_update",
                             "serial": serial,
                             "data": parsed_data
                         })
+                        trace.mark_broadcast()
+                        ingest_tracer.finish(trace)
                 else:
                     logging.warning(f"Unknown message type from Pi '{serial}': {message_type}")
 
@@ -686,6 +1091,7 @@ async def pi_websocket_endpoint(
                     
                     await db.commit()
                     await db.refresh(device_to_update)
+                    station_index.update_device(device_to_update)
                     
                     await ui_manager.broadcast({
                         "type": "status_update",
@@ -696,11 +1102,20 @@ async def pi_websocket_endpoint(
             logging.error(f"Error updating device status to offline for '{serial}': {e}", exc_info=True)
     
     except Exception as e:
-        print(f"\n❌ DEBUG ERROR: An exception occurred in pi_websocket_endpoint for '{serial}': {e}")
         logging.error(f"An unexpected error occurred in WebSocket for Pi '{serial}': {e}", exc_info=True)
         pi_manager.disconnect(serial)
 
 # === GLOBAL EXCEPTION HANDLER ===
+@app.exception_handler(BulkheadFull)
+@app.exception_handler(CircuitBreakerOpen)
+async def overload_exception_handler(request: Request, exc: Exception):
+    """DB quá tải/đang lỗi: trả 503 ngay để client thử lại sau"""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Service temporarily overloaded, please retry"},
+        headers={"Retry-After": "1"}
+    )
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Bắt mọi unhandled exceptions"""
@@ -723,46 +1138,9 @@ async def global_exception_handler(request: Request, exc: Exception):
             "timestamp": time.time()
         }
     )
-# === STATIC FILES ===
-app.mount("/img", StaticFiles(directory="../frontend/img"), name="images")
-app.mount("/", StaticFiles(directory="../frontend", html=True), name="static")
 
-class MonitoringMiddleware(BaseHTTPMiddleware):
-    """Middleware để ghi nhận metrics"""
-    
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        
-        # Rate limiting
-        client_ip = request.client.host
-        if not global_rate_limiter.is_allowed(client_ip):
-            health_monitor.record_error('rate_limit', f'IP: {client_ip}')
-            return JSONResponse(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                content={"detail": "Too many requests"}
-            )
-        
-        try:
-            response = await call_next(request)
-            duration_ms = (time.time() - start_time) * 1000
-            
-            # Ghi nhận metrics
-            health_monitor.record_request(duration_ms)
-            
-            # Cảnh báo nếu response chậm
-            if duration_ms > 1000:
-                logger.warning(f"Slow request: {request.url.path} took {duration_ms:.2f}ms")
-            
-            return response
-        
-        except Exception as e:
-            health_monitor.record_error('request_error', str(e))
-            logger.error(f"Request error: {e}", exc_info=True)
-            raise
-
-# Global monitoring middleware
-
-app.add_middleware(MonitoringMiddleware)
+# Request ID, rate limit, đo thời gian và access log (ASGI thuần, bỏ qua file tĩnh/WebSocket)
+app.add_middleware(InstrumentationMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://aitogy.click"],  # ⚠️ Trong production, hãy chỉ định origins cụ thể
@@ -771,11 +1149,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Enhanced Health Check Endpoint
+# === HEALTH CHECKS ===
+# Các endpoint health chỉ đọc snapshot do run_health_sampler cập nhật, không chờ CPU/DB.
 @app.get("/health/detailed")
 async def detailed_health_check():
     """Health check chi tiết với system metrics"""
-    return health_monitor.get_health_status()
+    health = health_monitor.get_health_status()
+    health['read_replica'] = read_router.status()
+    health['password_hashing'] = auth.password_hasher.stats()
+    health['event_loop'] = loop_monitor.status()
+    health['logging'] = log_handler.stats()
+    health['circuit_breakers'] = [mqtt_circuit_breaker.status(), db_circuit_breaker.status()]
+    health['bulkheads'] = [b.status() for b in (ingest_db_bulkhead, api_db_bulkhead, background_db_bulkhead)]
+    return health
 
 @app.get("/health/errors")
 async def recent_errors():
@@ -785,18 +1171,122 @@ async def recent_errors():
         "total_errors": health_monitor.error_count
     }
 
-@app.get("health")
+@app.get("/health")
 async def simple_health_check():
     """Simple health check cho load balancer"""
-    status = health_monitor.get_health_status()
+    health = health_monitor.get_health_status()
     
-    if status['status'] == 'healthy':
+    if health['status'] == 'healthy':
         return {"status": "ok"}
     
     return JSONResponse(
         status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-        content={"status": "degraded", "details": status}
+        content={"status": "degraded", "details": health}
+    )
+
+@app.get("/health/latency")
+async def latency_percentiles(
+    percentiles: str = Query("50,90,95,99", description="Danh sách phân vị, cách nhau bởi dấu phẩy"),
+    routes: bool = Query(False, description="Thêm phân vị theo từng route"),
+    cluster: bool = Query(True, description="Gộp sketch của mọi worker")
+):
+    """Phân vị độ trễ (ms) cho request, MQTT -> UI và DB trong các cửa sổ 1m/5m/1h"""
+    try:
+        wanted = tuple(float(p) for p in percentiles.split(",") if p.strip())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="percentiles phải là các số, ví dụ 50,95,99.9")
+    if not wanted or any(not 0 <= p <= 100 for p in wanted):
+        raise HTTPException(status_code=400, detail="percentiles phải nằm trong khoảng 0..100")
+    if cluster:
+        # Đọc và merge file của các worker khác ngoài event loop
+        own_payload = health_monitor.serialize_sketches()
+        return await asyncio.to_thread(health_monitor.cluster_latency_summary, own_payload, wanted, routes)
+    return health_monitor.latency_summary(wanted, routes)
+
+@app.get("/health/ingest")
+async def ingest_latency(limit: int = Query(20, ge=0, le=200)):
+    """Độ trễ từng chặng (trạm -> nhận -> hàng đợi -> DB -> gửi UI -> trình duyệt) và các trace mẫu gần nhất"""
+    return {
+        "stages_ms": ingest_tracer.summary(),
+        "recent_traces": list(ingest_tracer.recent)[-limit:] if limit else [],
+    }
+
+@app.get("/health/live")
+async def liveness_check():
+    """Liveness: process và event loop còn phản hồi"""
+    return {"status": "ok", "uptime_seconds": int(time.time() - health_monitor.start_time)}
+
+@app.get("/health/ready")
+async def readiness_check():
+    """Readiness: snapshot còn mới và database kết nối được"""
+    age = health_monitor.snapshot_age()
+    probe = health_monitor.get_health_status().get('probe', {})
+    ready = (
+        age is not None
+        and age <= settings.HEALTH_SAMPLE_INTERVAL_SECONDS * 3
+        and probe.get("database_connected", False)
     )
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "snapshot_age_seconds": round(age, 3) if age is not None else None,
+        "database_connected": probe.get("database_connected", False),
+        "mqtt_connected": probe.get("mqtt_connected", False),
+    }
+    if ready:
+        return body
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=body)
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """Metrics định dạng Prometheus, đã cộng dồn từ mọi worker"""
+    if settings.METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {settings.METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    # Đọc file của mọi worker nên chạy ngoài event loop
+    body = await asyncio.to_thread(metrics.generate_latest)
+    return Response(content=body, media_type=metrics.CONTENT_TYPE_LATEST)
+
+@app.post("/api/admin/profile")
+async def profile_worker(
+    seconds: float = Query(10.0, gt=0, le=60),
+    interval_ms: float = Query(10.0, ge=1, le=1000),
+    top: int = Query(30, ge=1, le=500),
+    format: str = Query("json", pattern="^(json|collapsed)$"),
+    include_idle: bool = Query(False, description="Giữ cả các mẫu thread chỉ đang chờ (select/wait)"),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DIAGNOSTICS))
+):
+    """
+    Lấy mẫu stack mọi thread của worker đang xử lý request này trong `seconds` giây.
+    format=collapsed trả về text cho flamegraph; json trả thêm top hàm theo self time.
+    """
+    if profiler.running:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A profile is already running in this worker")
+    logger.info(f"Profiling worker for {seconds}s requested by {current_user.username}")
+    try:
+        report = await asyncio.to_thread(profiler.run, seconds, interval_ms / 1000, include_idle)
+    except ProfilerBusy:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A profile is already running in this worker")
+    if format == "collapsed":
+        return PlainTextResponse(report["collapsed"] + "\n", headers={"X-Profile-PID": str(report["pid"])})
+    report["functions"] = report["functions"][:top]
+    return report
+
+@app.get("/api/admin/db/queries")
+async def db_query_report(
+    top: int = Query(20, ge=1, le=500),
+    order: str = Query("total", pattern="^(total|count|max|p99)$"),
+    db: Optional[str] = Query(None, description="devices, devices_read hoặc auth"),
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.VIEW_DIAGNOSTICS))
+):
+    """Top câu lệnh SQL theo tổng thời gian/số lần/max/p99, câu lệnh chậm gần đây và trạng thái pool (worker hiện tại)"""
+    return {"pid": os.getpid(), **db_stats.report(top, order, db)}
+
+@app.delete("/api/admin/db/queries")
+async def reset_db_query_report(
+    current_user: models.User = Depends(auth.require_permission(auth.Permission.MANAGE_DIAGNOSTICS))
+):
+    """Xóa thống kê câu lệnh của worker hiện tại (vd. trước khi đo lại sau khi đổi cấu hình pool)"""
+    db_stats.query_stats.reset()
+    return {"status": "reset", "pid": os.getpid()}
 
 async def health_check():
     """Enhanced health check với database status"""
@@ -814,7 +1304,7 @@ async def health_check():
     
     # CẢI TIẾN: Check database connectivity
     try:
-        async with AsyncSessionLocal() as db:
+        async with background_db_bulkhead, AsyncSessionLocal() as db:
             await db.execute(text("SELECT 1"))
         health["database_connected"] = True
     except Exception as e:
@@ -823,3 +1313,7 @@ async def health_check():
         health["status"] = "degraded"
     
     return health
+
+# === STATIC FILES ===
+app.mount("/img", StaticFiles(directory="../frontend/img"), name="images")
+app.mount("/", StaticFiles(directory="../frontend", html=True), name="static")
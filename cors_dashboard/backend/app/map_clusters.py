@@ -0,0 +1,284 @@
+# ==============================================================================
+# == backend/app/map_clusters.py - Cụm trạm cho bản đồ theo zoom/tile        ==
+# ==============================================================================
+#
+# Với hàng nghìn trạm, gửi mọi marker rồi gom cụm trong trình duyệt rất chậm
+# trên laptop hiện trường. Server giữ sẵn các cụm theo lưới Web Mercator: ở mỗi
+# zoom z, một tile 256px được chia thành GRID x GRID ô; mỗi ô là một cụm với số
+# trạm, tọa độ trung bình và số trạm theo trạng thái (online/offline/ntrip_down).
+#
+# Ở zoom sâu gần như mỗi trạm là một cụm, nên cụm giữ tối thiểu: tổng, số trạm
+# theo trạng thái và XOR id các trạm (đủ để biết trạm duy nhất của cụm một trạm)
+# thay cho tập serial.
+#
+# Cụm được cập nhật tăng dần qua StationIndex.subscribe: trạm đổi ô, trạng thái
+# hoặc tên thì chỉ sửa các ô liên quan ở mỗi zoom và bỏ cache của tile chứa
+# chúng. Tile được render GeoJSON khi có request, ETag là hash nội dung nên mọi
+# worker cho cùng ETag với cùng dữ liệu và client revalidate rẻ (304).
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from .database import settings
+from .spatial import IndexedStation, StationIndex, station_index
+
+logger = logging.getLogger(__name__)
+
+MAX_TILE_ZOOM = 22
+MAX_MERCATOR_LAT = 85.05112878
+CATEGORIES = ("online", "offline", "ntrip_down")
+CATEGORY_INDEX = {category: i for i, category in enumerate(CATEGORIES)}
+
+
+def station_category(station: IndexedStation, now: float) -> str:
+    if station.effective_status(now) != "online":
+        return "offline"
+    return "online" if station.ntrip_connected else "ntrip_down"
+
+
+def _mercator(lat: float, lon: float) -> tuple[float, float]:
+    """(lat, lon) -> (x, y) chuẩn hóa trong [0, 1), y tăng về phía nam như tile XYZ."""
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    phi = math.radians(lat)
+    x = (lon + 180) / 360 % 1.0
+    y = (1 - math.log(math.tan(phi) + 1 / math.cos(phi)) / math.pi) / 2
+    return x, min(max(y, 0.0), math.nextafter(1.0, 0.0))
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """(min_lat, min_lon, max_lat, max_lon) của tile z/x/y; hàng tile đầu/cuối kéo tới cực."""
+    n = 2 ** z
+
+    def lat(row: float) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    min_lat = -90.0 if y == n - 1 else lat(y + 1)
+    max_lat = 90.0 if y == 0 else lat(y)
+    return min_lat, x / n * 360 - 180, max_lat, (x + 1) / n * 360 - 180
+
+
+class _Cluster:
+    __slots__ = ("count", "sum_lat", "sum_lon", "counts", "member_xor")
+
+    def __init__(self):
+        self.count = 0
+        self.sum_lat = 0.0
+        self.sum_lon = 0.0
+        self.counts = [0] * len(CATEGORIES)
+        # XOR id các trạm trong cụm: khi count == 1 chính là id của trạm đó
+        self.member_xor = 0
+
+    def add(self, member: int, lat: float, lon: float, category: str, sign: int = 1):
+        self.count += sign
+        self.sum_lat += sign * lat
+        self.sum_lon += sign * lon
+        self.counts[CATEGORY_INDEX[category]] += sign
+        self.member_xor ^= member
+
+
+# describe(id) -> (serial, name, category) của trạm duy nhất trong cụm
+Describe = Callable[[int], tuple[str, Optional[str], str]]
+
+
+def _feature(cluster: _Cluster, describe: Describe) -> dict:
+    properties = {"count": cluster.count, **dict(zip(CATEGORIES, cluster.counts))}
+    if cluster.count == 1:
+        serial, name, category = describe(cluster.member_xor)
+        properties.update(serial=serial, name=name, category=category)
+    else:
+        properties["cluster"] = True
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [round(cluster.sum_lon / cluster.count, 6), round(cluster.sum_lat / cluster.count, 6)],
+        },
+        "properties": properties,
+    }
+
+
+def _render(z: int, x: int, y: int, clusters: Iterable[tuple[tuple[int, int], _Cluster]], describe: Describe) -> bytes:
+    features = [_feature(cluster, describe) for _, cluster in sorted(clusters, key=lambda item: item[0])]
+    total = dict.fromkeys(CATEGORIES, 0)
+    for feature in features:
+        for category in CATEGORIES:
+            total[category] += feature["properties"][category]
+    return json.dumps(
+        {"type": "FeatureCollection", "tile": [z, x, y], "totals": total, "features": features},
+        ensure_ascii=False, separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+class MapClusters:
+    """
+    Cụm theo ô (z, bx, by) cho z = 0..max_zoom. `grid` là lũy thừa của 2 nên ô ở zoom z
+    suy ra từ ô ở max_zoom bằng dịch bit, và một trạm nằm yên trong ô max_zoom
+    (GGA dao động vài cm) không làm thay đổi gì.
+    """
+
+    def __init__(self, index: StationIndex, max_zoom: int, grid: int):
+        if grid <= 0 or grid & (grid - 1):
+            raise ValueError("MAP_CLUSTER_GRID phải là lũy thừa của 2")
+        self.index = index
+        self.max_zoom = max_zoom
+        self.grid = grid
+        self._grid_shift = grid.bit_length() - 1
+        self._scale = 2 ** max_zoom * grid
+        # serial -> (lat, lon, category, ô ở max_zoom, name) đang được cộng vào các cụm. Tile cache
+        # chỉ render từ đây (không đọc IndexedStation), nên mọi thay đổi nội dung đều đi qua on_station
+        self.placed: Dict[str, tuple[float, float, str, tuple[int, int], Optional[str]]] = {}
+        # id (số nguyên, cấp tăng dần) của trạm đang được cộng vào các cụm, dùng cho _Cluster.member_xor
+        self._ids: Dict[str, int] = {}
+        self._serials: Dict[int, str] = {}
+        self._next_id = 1
+        self.clusters: Dict[tuple[int, int, int], _Cluster] = {}
+        self.tile_clusters: Dict[tuple[int, int, int], set[tuple[int, int]]] = {}
+        self._cache: Dict[tuple[int, int, int], tuple[str, bytes]] = {}
+        self.renders = 0
+        index.subscribe(self.on_station)
+
+    def _max_zoom_bin(self, lat: float, lon: float) -> tuple[int, int]:
+        x, y = _mercator(lat, lon)
+        return int(x * self._scale), int(y * self._scale)
+
+    def _apply(self, serial: str, lat: float, lon: float, category: str, top_bin: tuple[int, int], sign: int):
+        member = self._ids.get(serial)
+        if member is None:
+            member = self._ids[serial] = self._next_id
+            self._serials[member] = serial
+            self._next_id += 1
+        bx, by = top_bin
+        for z in range(self.max_zoom, -1, -1):
+            key = (z, bx, by)
+            tile = (z, bx >> self._grid_shift, by >> self._grid_shift)
+            cluster = self.clusters.get(key)
+            if cluster is None:
+                cluster = self.clusters[key] = _Cluster()
+                self.tile_clusters.setdefault(tile, set()).add((bx, by))
+            cluster.add(member, lat, lon, category, sign)
+            if cluster.count == 0:
+                del self.clusters[key]
+                bins = self.tile_clusters[tile]
+                bins.discard((bx, by))
+                if not bins:
+                    del self.tile_clusters[tile]
+            self._cache.pop(tile, None)
+            bx >>= 1
+            by >>= 1
+
+    def _invalidate(self, top_bin: tuple[int, int]):
+        """Bỏ cache mọi tile chứa ô `top_bin` (ở mọi zoom) mà không đổi các cụm."""
+        bx, by = top_bin
+        shift = self._grid_shift
+        for z in range(self.max_zoom, -1, -1):
+            self._cache.pop((z, bx >> shift, by >> shift), None)
+            bx >>= 1
+            by >>= 1
+
+    def _describe(self, member: int) -> tuple[str, Optional[str], str]:
+        serial = self._serials[member]
+        entry = self.placed[serial]
+        return serial, entry[4], entry[2]
+
+    def on_station(self, station: IndexedStation, removed: bool = False, now: Optional[float] = None):
+        """Callback của StationIndex: đưa trạm vào/ra/đổi cụm nếu ô hoặc trạng thái thay đổi."""
+        old = self.placed.get(station.serial)
+        if removed or station.cell is None:
+            if old is not None:
+                self._apply(station.serial, old[0], old[1], old[2], old[3], -1)
+                del self.placed[station.serial]
+                del self._serials[self._ids.pop(station.serial)]
+            return
+        category = station_category(station, time.time() if now is None else now)
+        top_bin = self._max_zoom_bin(station.lat, station.lon)
+        if old is not None:
+            if old[2] == category and old[3] == top_bin:
+                if station.source == "fixed" and (old[0], old[1]) != (station.lat, station.lon):
+                    # Tọa độ cố định được sửa trong cùng ô: cập nhật tâm cụm cho đúng
+                    self._apply(station.serial, old[0], old[1], old[2], old[3], -1)
+                    self._apply(station.serial, station.lat, station.lon, category, top_bin, 1)
+                    self.placed[station.serial] = (station.lat, station.lon, category, top_bin, station.name)
+                elif old[4] != station.name:
+                    # Đổi tên: cụm giữ nguyên, chỉ bỏ cache các tile đang hiển thị tên cũ
+                    self.placed[station.serial] = (*old[:4], station.name)
+                    self._invalidate(top_bin)
+                return
+            self._apply(station.serial, old[0], old[1], old[2], old[3], -1)
+        self._apply(station.serial, station.lat, station.lon, category, top_bin, 1)
+        self.placed[station.serial] = (station.lat, station.lon, category, top_bin, station.name)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Trạm 'online' quá hạn heartbeat đổi sang offline mà không có sự kiện nào: quét định kỳ."""
+        now = time.time() if now is None else now
+        changed = 0
+        for serial, (_, _, category, _, _) in list(self.placed.items()):
+            station = self.index.stations.get(serial)
+            if station is not None and station_category(station, now) != category:
+                self.on_station(station, now=now)
+                changed += 1
+        return changed
+
+    async def run(self, interval: float):
+        """Task nền: sweep() mỗi `interval` giây."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Lỗi khi cập nhật cụm bản đồ: {e}", exc_info=True)
+
+    def tile(self, z: int, x: int, y: int) -> tuple[str, bytes]:
+        """(ETag, GeoJSON) của tile z/x/y (z <= max_zoom), render lại chỉ khi tile đã đổi."""
+        key = (z, x, y)
+        cached = self._cache.get(key)
+        if cached is None:
+            bins = self.tile_clusters.get(key, ())
+            body = _render(z, x, y, ((b, self.clusters[(z, *b)]) for b in bins), self._describe)
+            cached = self._cache[key] = (_etag(body), body)
+            self.renders += 1
+        return cached
+
+    def tile_for(self, z: int, x: int, y: int, predicate) -> tuple[str, bytes]:
+        """
+        Tile tính trực tiếp (không cache) cho một tập trạm đã lọc (coordinator) hoặc zoom
+        lớn hơn max_zoom: lấy trạm trong khung tile từ chỉ mục rồi gom theo cùng lưới.
+        """
+        min_lat, min_lon, max_lat, max_lon = tile_bounds(z, x, y)
+        now = time.time()
+        scale = 2 ** z * self.grid
+        clusters: Dict[tuple[int, int], _Cluster] = {}
+        details: Dict[int, tuple[str, Optional[str], str]] = {}
+        for station in self.index.within(min_lat, min_lon, max_lat, max_lon, predicate):
+            mx, my = _mercator(station.lat, station.lon)
+            b = (int(mx * scale), int(my * scale))
+            if (b[0] >> self._grid_shift, b[1] >> self._grid_shift) != (x, y):
+                continue  # nằm trên cạnh tile: thuộc tile bên cạnh
+            category = station_category(station, now)
+            member = len(details) + 1
+            clusters.setdefault(b, _Cluster()).add(member, station.lat, station.lon, category)
+            details[member] = (station.serial, station.name, category)
+        body = _render(z, x, y, clusters.items(), details.__getitem__)
+        return _etag(body), body
+
+    def status(self) -> dict:
+        return {
+            "stations": len(self.placed),
+            "clusters": len(self.clusters),
+            "tiles": len(self.tile_clusters),
+            "cached_tiles": len(self._cache),
+            "renders": self.renders,
+            "max_zoom": self.max_zoom,
+            "grid": self.grid,
+        }
+
+
+map_clusters = MapClusters(station_index, settings.MAP_MAX_CLUSTER_ZOOM, settings.MAP_CLUSTER_GRID)
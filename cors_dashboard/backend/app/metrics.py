@@ -0,0 +1,106 @@
+# ==============================================================================
+# == backend/app/metrics.py - Metrics theo chuẩn Prometheus (đa worker)      ==
+# ==============================================================================
+#
+# Counter / Gauge / Histogram của prometheus_client ở chế độ multiprocess, xuất
+# qua endpoint /metrics.
+#
+# Mỗi worker uvicorn ghi giá trị vào các file mmap riêng trong
+# PROMETHEUS_MULTIPROC_DIR (mặc định SHARED_STATE_DIR/prometheus); khi scrape,
+# MultiProcessCollector đọc và cộng file của mọi worker:
+# - Counter/Histogram: cộng mọi file, kể cả của worker đã chết (counter không giảm).
+# - Gauge: mặc định 'livesum', chỉ cộng các worker còn sống (vd. số WebSocket
+#   đang kết nối); file gauge của worker đã chết được xóa khi scrape.
+
+import logging
+import os
+import re
+
+import psutil
+
+from .shared_memory import SHARED_STATE_DIR
+
+# prometheus_client chọn kiểu lưu giá trị (mmap hay bộ nhớ) lúc import: phải đặt biến môi trường trước
+MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(SHARED_STATE_DIR, "prometheus"))
+os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+import prometheus_client  # noqa: E402
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, multiprocess  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+_LIVE_GAUGE_FILE = re.compile(r"^gauge_live\w+_(\d+)\.db$")
+
+# File gauge 'live*' cùng pid còn sót từ lần chạy trước (pid được cấp lại) không được cộng vào worker này
+multiprocess.mark_process_dead(os.getpid(), MULTIPROC_DIR)
+
+
+class Gauge(prometheus_client.Gauge):
+    """Gauge cộng dồn các worker còn sống (multiprocess_mode mặc định 'livesum')."""
+
+    def __init__(self, *args, multiprocess_mode: str = "livesum", **kwargs):
+        super().__init__(*args, multiprocess_mode=multiprocess_mode, **kwargs)
+
+
+def _remove_dead_workers():
+    pids = set()
+    for name in os.listdir(MULTIPROC_DIR):
+        match = _LIVE_GAUGE_FILE.match(name)
+        if match:
+            pids.add(int(match.group(1)))
+    for pid in pids:
+        if not psutil.pid_exists(pid):
+            multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+
+
+def generate_latest() -> bytes:
+    """Xuất metric của mọi worker theo định dạng text exposition (đọc file: gọi ngoài event loop)."""
+    _remove_dead_workers()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, MULTIPROC_DIR)
+    return prometheus_client.generate_latest(registry)
+
+
+# --- Metrics của ứng dụng ---
+HTTP_REQUESTS = Counter("http_requests_total", "Số request HTTP theo route và mã trạng thái", ("method", "route", "status"))
+HTTP_REQUEST_DURATION = Histogram("http_request_duration_seconds", "Thời gian xử lý request HTTP", ("method", "route"))
+MQTT_MESSAGES = Counter("mqtt_messages_total", "Số tin nhắn MQTT nhận được theo loại topic", ("topic_type",))
+NMEA_SENTENCES = Counter("nmea_sentences_total", "Số câu NMEA theo loại và kết quả phân tích", ("sentence", "result"))
+DB_UPSERT_DURATION = Histogram("db_device_upsert_duration_seconds", "Thời gian update_or_create_device (gồm commit)", ("source",))
+UI_BROADCAST_DURATION = Histogram("ui_broadcast_duration_seconds", "Thời gian gửi một tin broadcast đến mọi UI client")
+UI_BROADCAST_RECIPIENTS = Histogram(
+    "ui_broadcast_recipients", "Số UI client nhận mỗi tin broadcast",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250)
+)
+WEBSOCKET_CONNECTIONS = Gauge("websocket_connections", "Số WebSocket đang kết nối", ("kind",))
+COMMANDS_DISPATCHED = Counter("device_commands_total", "Lệnh gửi đến Pi theo kênh và kết quả", ("channel", "outcome"))
+HEARTBEAT_EXPIRIES = Counter("device_heartbeat_expiries_total", "Số lần trạm bị chuyển offline do quá hạn heartbeat")
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "Độ trễ của tick định kỳ so với lịch (event loop bị chặn)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+EVENT_LOOP_STALLS = Counter("event_loop_stalls_total", "Số lần watchdog phát hiện event loop bị chặn quá ngưỡng")
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "circuit_breaker_transitions_total", "Số lần circuit breaker chuyển trạng thái", ("breaker", "state")
+)
+CIRCUIT_BREAKER_REJECTIONS = Counter(
+    "circuit_breaker_rejections_total", "Số lời gọi bị từ chối ngay vì circuit breaker đang OPEN", ("breaker",)
+)
+BULKHEAD_QUEUE_DURATION = Histogram(
+    "bulkhead_queue_duration_seconds", "Thời gian chờ slot của bulkhead", ("bulkhead",),
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+PASSWORD_HASH_QUEUE_WAIT = Histogram(
+    "password_hash_queue_wait_seconds", "Thời gian chờ thread bcrypt trong executor riêng",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds", "Thời gian một lần hash/verify bcrypt",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+BULKHEAD_REJECTIONS = Counter(
+    "bulkhead_rejections_total", "Số lần bị từ chối vì bulkhead đầy (queue_full) hoặc chờ quá lâu (timeout)",
+    ("bulkhead", "reason")
+)
+RTCM_FRAMES = Counter("rtcm_frames_total", "Số khung RTCM3 hợp lệ nhận từ raw_data theo loại tin", ("message_type",))
+RTCM_CRC_ERRORS = Counter("rtcm_crc_errors_total", "Số khung RTCM3 sai CRC-24Q (bị bỏ và dò lại preamble)")
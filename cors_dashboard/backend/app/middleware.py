@@ -0,0 +1,115 @@
+# ==============================================================================
+# == backend/app/middleware.py - ASGI middleware đo lường request            ==
+# ==============================================================================
+#
+# Một middleware ASGI thuần thay cho RequestIDMiddleware + MonitoringMiddleware
+# (BaseHTTPMiddleware). Mỗi request chỉ đi qua một lớp:
+#   request ID -> rate limit -> đo thời gian (perf_counter_ns) -> access log có lấy mẫu.
+# File tĩnh và WebSocket được chuyển thẳng cho app mà không làm gì thêm.
+
+import logging
+import random
+import time
+import uuid
+
+from .database import settings
+from .monitoring import health_monitor, global_rate_limiter
+from .metrics import HTTP_REQUESTS, HTTP_REQUEST_DURATION
+from .logging_setup import request_id_ctx
+
+logger = logging.getLogger("app.access")
+
+REQUEST_ID_HEADER = b"x-request-id"
+MAX_REQUEST_ID_LENGTH = 64
+# Chỉ các đường dẫn này được đo lường; còn lại là file tĩnh của frontend
+INSTRUMENTED_PREFIXES = ("/api/", "/health")
+
+_TOO_MANY_REQUESTS_BODY = b'{"detail":"Too many requests"}'
+
+
+def _incoming_request_id(headers) -> str | None:
+    for name, value in headers:
+        if name == REQUEST_ID_HEADER:
+            if 0 < len(value) <= MAX_REQUEST_ID_LENGTH and value.isascii():
+                return value.decode("ascii")
+            return None
+    return None
+
+
+class InstrumentationMiddleware:
+    """
+    Request ID, rate limit toàn cục, thời gian xử lý và access log trong một lượt.
+
+    - Dùng lại X-Request-ID từ client/proxy nếu hợp lệ, ngược lại sinh mới;
+      luôn trả về trong header response và đặt vào request.state.request_id.
+    - Access log chỉ ghi ngẫu nhiên `sample_rate` request; request lỗi 5xx
+      hoặc chậm hơn `slow_request_ms` thì luôn được ghi.
+    """
+
+    def __init__(self, app, sample_rate: float | None = None, slow_request_ms: float | None = None,
+                 prefixes: tuple[str, ...] = INSTRUMENTED_PREFIXES):
+        self.app = app
+        self.sample_rate = settings.ACCESS_LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.slow_request_ms = settings.SLOW_REQUEST_MS if slow_request_ms is None else slow_request_ms
+        self.prefixes = prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        if not global_rate_limiter.is_allowed(client_ip):
+            health_monitor.record_error('rate_limit', f'IP: {client_ip}')
+            await self._reject(send)
+            return
+
+        request_id = _incoming_request_id(scope["headers"]) or uuid.uuid4().hex
+        scope.setdefault("state", {})["request_id"] = request_id
+        token = request_id_ctx.set(request_id)
+        request_id_header = (REQUEST_ID_HEADER, request_id.encode("ascii"))
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", ()), request_id_header]
+            await send(message)
+
+        start = time.perf_counter_ns()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            health_monitor.record_error('request_error', str(e))
+            logger.error(f"Request error: {scope['method']} {scope['path']}: {e}", exc_info=True)
+            raise
+        finally:
+            duration_ms = (time.perf_counter_ns() - start) / 1_000_000
+            # Dùng mẫu route (/api/devices/{serial}) làm label để số series không tăng theo serial
+            route = scope.get("route")
+            route_label = getattr(route, "path", "unmatched")
+            health_monitor.record_request(duration_ms, route_label)
+            HTTP_REQUESTS.labels(scope["method"], route_label, status_code).inc()
+            HTTP_REQUEST_DURATION.labels(scope["method"], route_label).observe(duration_ms / 1000)
+            self._log(scope, status_code, duration_ms)
+            request_id_ctx.reset(token)
+
+    def _log(self, scope, status_code: int, duration_ms: float):
+        if duration_ms > self.slow_request_ms:
+            logger.warning(f"Slow request: {scope['method']} {scope['path']} took {duration_ms:.2f}ms, Status: {status_code}")
+        elif status_code >= 500 or random.random() < self.sample_rate:
+            logger.info(f"{scope['method']} {scope['path']} - {status_code} in {duration_ms:.2f}ms")
+
+    @staticmethod
+    async def _reject(send):
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(_TOO_MANY_REQUESTS_BODY)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": _TOO_MANY_REQUESTS_BODY})
@@ -2,9 +2,38 @@
 # == backend/app/models.py - CẢI TIẾN VỚI DATABASE INDEXES                  ==
 # ==============================================================================
 
-from sqlalchemy import Column, String, Integer, BigInteger, Boolean, JSON, Index
+from sqlalchemy import Column, String, Integer, BigInteger, Boolean, JSON, Index, ForeignKey
+from sqlalchemy.orm import relationship
 from .database import Base, AuthBase 
 
+
+class DeviceConfig(Base):
+    """
+    Nội dung cấu hình dạng content-addressed: khóa chính là SHA-256 của JSON chuẩn hóa.
+    Nhiều trạm có cùng cấu hình dùng chung một dòng.
+    """
+    __tablename__ = "device_configs"
+
+    hash = Column(String(64), primary_key=True)
+    content = Column(JSON, nullable=False)
+    created_at = Column(BigInteger, nullable=False)
+
+
+class DeviceConfigHistory(Base):
+    """Lịch sử thay đổi cấu hình của từng trạm (chỉ ghi khi hash thay đổi)."""
+    __tablename__ = "device_config_history"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    serial = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+    config_hash = Column(String(64), ForeignKey("device_configs.hash"), nullable=True)
+    changed_at = Column(BigInteger, nullable=False)
+
+    __table_args__ = (
+        Index('ix_config_history_serial_kind', 'serial', 'kind', 'changed_at'),
+    )
+
+
 class Device(Base):
     __tablename__ = "devices"
 
@@ -15,11 +44,25 @@ class Device(Base):
     bps = Column(Integer, default=0)
     detected_chip_type = Column(String, default="UNKNOWN")
     user_id = Column(Integer, nullable=True, index=True)
-    base_config = Column(JSON, nullable=True)
-    service_config = Column(JSON, nullable=True)
     ntrip_connected = Column(Boolean, default=False)
-    ntrip_status = Column(JSON, nullable=True)
     is_locked = Column(Boolean, default=False)
+    # Trạng thái runtime, đổi liên tục nên để JSON ngay trên hàng (không đưa vào device_configs)
+    ntrip_status = Column(JSON, default=dict)
+
+    # Cấu hình (ít thay đổi) nằm ở bảng device_configs, hàng devices chỉ giữ hash
+    base_config_hash = Column(String(64), ForeignKey("device_configs.hash"), nullable=True)
+    service_config_hash = Column(String(64), ForeignKey("device_configs.hash"), nullable=True)
+
+    base_config_blob = relationship(DeviceConfig, foreign_keys=[base_config_hash], lazy="joined")
+    service_config_blob = relationship(DeviceConfig, foreign_keys=[service_config_hash], lazy="joined")
+
+    @property
+    def base_config(self) -> dict:
+        return self.base_config_blob.content if self.base_config_blob else {}
+
+    @property
+    def service_config(self) -> dict:
+        return self.service_config_blob.content if self.service_config_blob else {}
     
     __table_args__ = (
         Index('ix_user_status', 'user_id', 'status'),
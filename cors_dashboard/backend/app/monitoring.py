@@ -3,16 +3,220 @@
 # ==============================================================================
 
 import time
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+import hashlib
+import inspect
+import json
+import math
+import os
+import re
+import struct
+import sys
+import threading
+import traceback
 import psutil
 import logging
 from typing import Dict, Any
 from datetime import datetime, timedelta
 from collections import deque
 
+from .database import settings
+from .shared_memory import SHARED_STATE_DIR, open_shared_file
+from .metrics import (
+    EVENT_LOOP_LAG, EVENT_LOOP_STALLS, CIRCUIT_BREAKER_TRANSITIONS, CIRCUIT_BREAKER_REJECTIONS,
+    BULKHEAD_QUEUE_DURATION, BULKHEAD_REJECTIONS
+)
+
 logger = logging.getLogger(__name__)
 
+class QuantileSketch:
+    """
+    Sketch phân vị kiểu DDSketch: giá trị được đếm vào bin theo log cơ số gamma,
+    nên mọi phân vị có sai số tương đối <= relative_accuracy.
+    Bộ nhớ giới hạn bởi max_bins (gộp các bin nhỏ nhất khi vượt), và hai sketch
+    cùng tham số có thể merge (giữa các cửa sổ thời gian hoặc giữa các worker).
+    """
+    
+    MIN_INDEXABLE = 1e-9  # Giá trị nhỏ hơn được đếm vào zero_count
+    
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+    
+    def add(self, value: float):
+        if value > self.MIN_INDEXABLE:
+            key = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[key] = self.bins.get(key, 0) + 1
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+    
+    def _collapse(self):
+        """Gộp các bin thấp nhất: giữ chính xác cho phân vị cao (p95, p99)."""
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            self.bins[target] += self.bins.pop(key)
+    
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Chỉ merge được các sketch cùng relative_accuracy")
+        for key, n in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + n
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+    
+    def quantile(self, q: float) -> float | None:
+        """Giá trị tại phân vị q (0..1), None nếu chưa có dữ liệu."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0.0)
+        running = self.zero_count
+        for key in sorted(self.bins):
+            running += self.bins[key]
+            if running > rank:
+                # Bin `key` chứa (gamma^(key-1), gamma^key]; trả điểm giữa theo sai số tương đối
+                estimate = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(estimate, self.min), self.max)
+        return self.max
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'relative_accuracy': self.relative_accuracy, 'bins': self.bins,
+            'zero_count': self.zero_count, 'count': self.count, 'sum': self.sum,
+            'min': self.min if self.count else None, 'max': self.max if self.count else None
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], max_bins: int = 2048) -> "QuantileSketch":
+        sketch = cls(data['relative_accuracy'], max_bins)
+        sketch.bins = {int(key): n for key, n in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        if sketch.count:
+            sketch.min, sketch.max = data['min'], data['max']
+        return sketch
+
+class WindowedQuantiles:
+    """
+    Phân vị theo các cửa sổ thời gian trượt (mặc định 1 phút, 5 phút, 1 giờ).
+    Mỗi cửa sổ là một vòng `slots` sketch con; slot cũ được xóa khi vòng quay lại,
+    nên bộ nhớ không đổi và dữ liệu quá cửa sổ tự bị loại (độ trễ tối đa 1 slot).
+    """
+    
+    DEFAULT_WINDOWS = {'1m': 60, '5m': 300, '1h': 3600}
+    
+    def __init__(self, windows: Dict[str, int] | None = None, slots: int = 6, relative_accuracy: float = 0.01):
+        self.windows = dict(windows or self.DEFAULT_WINDOWS)
+        self.slots = slots
+        self.relative_accuracy = relative_accuracy
+        # window -> list[(epoch của slot, sketch)]
+        self._rings: Dict[str, list] = {
+            name: [(-1, QuantileSketch(relative_accuracy)) for _ in range(slots)]
+            for name in self.windows
+        }
+    
+    def _slot_seconds(self, name: str) -> float:
+        return self.windows[name] / self.slots
+    
+    def observe(self, value: float, now: float | None = None):
+        now = time.time() if now is None else now
+        for name, ring in self._rings.items():
+            epoch = int(now // self._slot_seconds(name))
+            pos = epoch % self.slots
+            slot_epoch, sketch = ring[pos]
+            if slot_epoch != epoch:
+                sketch = QuantileSketch(self.relative_accuracy)
+                ring[pos] = (epoch, sketch)
+            sketch.add(value)
+    
+    def window(self, name: str, now: float | None = None) -> QuantileSketch:
+        """Sketch đã merge của các slot còn nằm trong cửa sổ `name`."""
+        now = time.time() if now is None else now
+        current = int(now // self._slot_seconds(name))
+        merged = QuantileSketch(self.relative_accuracy)
+        for epoch, sketch in self._rings[name]:
+            if current - self.slots < epoch <= current:
+                merged.merge(sketch)
+        return merged
+    
+    def merge(self, other: "WindowedQuantiles"):
+        """Merge slot-theo-slot (cùng cấu hình cửa sổ), ví dụ từ snapshot của worker khác."""
+        for name, ring in other._rings.items():
+            own = self._rings[name]
+            for epoch, sketch in ring:
+                if epoch < 0:
+                    continue
+                pos = epoch % self.slots
+                own_epoch, own_sketch = own[pos]
+                if own_epoch == epoch:
+                    own_sketch.merge(sketch)
+                elif own_epoch < epoch:
+                    copy = QuantileSketch(self.relative_accuracy)
+                    copy.merge(sketch)
+                    own[pos] = (epoch, copy)
+    
+    def summary(self, percentiles=(50, 90, 95, 99), now: float | None = None) -> Dict[str, Any]:
+        """{window: {'count', 'avg', 'p50', ...}} với giá trị làm tròn 3 chữ số."""
+        result = {}
+        for name in self.windows:
+            sketch = self.window(name, now)
+            entry = {'count': sketch.count, 'avg': round(sketch.sum / sketch.count, 3) if sketch.count else None}
+            for p in percentiles:
+                value = sketch.quantile(p / 100)
+                entry[f"p{p:g}"] = round(value, 3) if value is not None else None
+            result[name] = entry
+        return result
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'windows': self.windows, 'slots': self.slots, 'relative_accuracy': self.relative_accuracy,
+            'rings': {name: [[epoch, sketch.to_dict()] for epoch, sketch in ring if epoch >= 0]
+                      for name, ring in self._rings.items()}
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "WindowedQuantiles":
+        windowed = cls(data['windows'], data['slots'], data['relative_accuracy'])
+        for name, entries in data['rings'].items():
+            for epoch, sketch in entries:
+                windowed._rings[name][epoch % windowed.slots] = (epoch, QuantileSketch.from_dict(sketch))
+        return windowed
+
 class HealthMonitor:
-    """Theo dõi sức khỏe hệ thống"""
+    """
+    Theo dõi sức khỏe hệ thống.
+
+    CPU/RAM/disk, thống kê thời gian phản hồi và kết quả probe (DB, MQTT...)
+    được tính lại trong background bởi refresh(); các endpoint health chỉ đọc
+    snapshot đã cache nên không chặn event loop.
+    """
     
     def __init__(self):
         self.start_time = time.time()
@@ -21,14 +225,36 @@ class HealthMonitor:
         self.websocket_connections = 0
         self.mqtt_reconnect_count = 0
         
-        # Circular buffers để lưu metrics theo thời gian
-        self.response_times = deque(maxlen=1000)
+        # Phân vị độ trễ (ms) theo cửa sổ thời gian, bộ nhớ cố định
+        self.latency: Dict[str, WindowedQuantiles] = {
+            'request': WindowedQuantiles(),
+            'mqtt_to_ui': WindowedQuantiles(),
+            'db': WindowedQuantiles(),
+            'event_loop_lag': WindowedQuantiles(),
+        }
+        self.route_latency: Dict[str, WindowedQuantiles] = {}
         self.error_log = deque(maxlen=100)
+        
+        # Snapshot do background sampler cập nhật
+        self._snapshot: Dict[str, Any] | None = None
+        self.snapshot_monotonic = 0.0
+        # Lần gọi đầu của cpu_percent(interval=None) luôn trả 0.0, gọi trước để mốc tính bắt đầu từ đây
+        psutil.cpu_percent(interval=None)
     
-    def record_request(self, duration_ms: float):
-        """Ghi nhận một request"""
+    def record_request(self, duration_ms: float, route: str | None = None):
+        """Ghi nhận một request (route: mẫu đường dẫn, để có phân vị theo route)"""
         self.request_count += 1
-        self.response_times.append(duration_ms)
+        now = time.time()
+        self.latency['request'].observe(duration_ms, now)
+        if route is not None:
+            sketch = self.route_latency.get(route)
+            if sketch is None:
+                sketch = self.route_latency[route] = WindowedQuantiles()
+            sketch.observe(duration_ms, now)
+    
+    def record_latency(self, kind: str, duration_ms: float):
+        """Ghi nhận độ trễ cho một loại đã khai báo trong self.latency ('mqtt_to_ui', 'db'...)"""
+        self.latency[kind].observe(duration_ms)
     
     def record_error(self, error_type: str, details: str):
         """Ghi nhận một lỗi"""
@@ -39,38 +265,112 @@ class HealthMonitor:
             'details': details
         })
     
-    def get_health_status(self) -> Dict[str, Any]:
-        """Trả về trạng thái sức khỏe chi tiết"""
-        uptime = time.time() - self.start_time
-        
-        # CPU & Memory
-        cpu_percent = psutil.cpu_percent(interval=0.1)
+    @staticmethod
+    def _sample_system() -> Dict[str, Any]:
+        """Đọc CPU/RAM/disk. cpu_percent không chờ: tính theo khoảng từ lần gọi trước."""
         memory = psutil.virtual_memory()
         disk = psutil.disk_usage('/')
-        
-        # Response time stats
-        avg_response_time = 0
-        p95_response_time = 0
-        if self.response_times:
-            avg_response_time = sum(self.response_times) / len(self.response_times)
-            sorted_times = sorted(self.response_times)
-            p95_index = int(len(sorted_times) * 0.95)
-            p95_response_time = sorted_times[p95_index] if p95_index < len(sorted_times) else 0
-        
-        # Error rate
+        return {
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'memory_percent': memory.percent,
+            'memory_available_mb': memory.available // (1024 * 1024),
+            'disk_percent': disk.percent,
+            'disk_free_gb': disk.free // (1024 ** 3)
+        }
+    
+    def _response_time_stats(self) -> tuple[float, float]:
+        sketch = self.latency['request'].window('5m')
+        if not sketch.count:
+            return 0.0, 0.0
+        return sketch.sum / sketch.count, sketch.quantile(0.95)
+    
+    def latency_summary(self, percentiles=(50, 90, 95, 99), include_routes: bool = False,
+                        sketches: tuple | None = None) -> Dict[str, Any]:
+        """Phân vị độ trễ (ms) theo cửa sổ của worker này, hoặc của `sketches` (latency, routes) cho trước."""
+        latency, routes = sketches or (self.latency, self.route_latency)
+        summary = {kind: windowed.summary(percentiles) for kind, windowed in latency.items()}
+        if include_routes:
+            summary['routes'] = {route: windowed.summary(percentiles) for route, windowed in sorted(routes.items())}
+        return summary
+    
+    # --- Trao đổi sketch giữa các worker qua SHARED_STATE_DIR ---
+    _SKETCH_FILE = re.compile(r"^latency_(\d+)\.json$")
+    
+    def serialize_sketches(self) -> str:
+        """JSON các sketch của worker này. Gọi trong event loop (sketch chỉ đổi trong loop)."""
+        return json.dumps({
+            'latency': {kind: w.to_dict() for kind, w in self.latency.items()},
+            'routes': {route: w.to_dict() for route, w in self.route_latency.items()},
+        }, separators=(',', ':'))
+    
+    @staticmethod
+    def write_sketches(payload: str):
+        """Ghi payload ra latency_<pid>.json (thay thế nguyên tử) để worker khác merge."""
+        os.makedirs(SHARED_STATE_DIR, exist_ok=True)
+        path = os.path.join(SHARED_STATE_DIR, f"latency_{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    
+    def cluster_latency_summary(self, own_payload: str, percentiles=(50, 90, 95, 99),
+                                include_routes: bool = False) -> Dict[str, Any]:
+        """
+        Như latency_summary nhưng gộp mọi worker. `own_payload` là serialize_sketches()
+        lấy trong event loop; phần đọc file còn lại an toàn để chạy trong thread.
+        """
+        return self.latency_summary(percentiles, include_routes, self._merge_worker_sketches(own_payload))
+    
+    def _merge_worker_sketches(self, own_payload: str):
+        own = json.loads(own_payload)
+        latency = {kind: WindowedQuantiles.from_dict(w) for kind, w in own['latency'].items()}
+        routes = {route: WindowedQuantiles.from_dict(w) for route, w in own['routes'].items()}
+        own_pid = os.getpid()
+        try:
+            names = os.listdir(SHARED_STATE_DIR)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            match = self._SKETCH_FILE.match(name)
+            if not match or int(match.group(1)) == own_pid:
+                continue
+            path = os.path.join(SHARED_STATE_DIR, name)
+            if not psutil.pid_exists(int(match.group(1))):
+                # Worker đã dừng: snapshot của nó chỉ còn là dữ liệu cũ
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for kind, w in data.get('latency', {}).items():
+                if kind in latency:
+                    latency[kind].merge(WindowedQuantiles.from_dict(w))
+            for route, w in data.get('routes', {}).items():
+                other = WindowedQuantiles.from_dict(w)
+                if route in routes:
+                    routes[route].merge(other)
+                else:
+                    routes[route] = other
+        return latency, routes
+    
+    def _build_status(self, system: Dict[str, Any], probe: Dict[str, Any]) -> Dict[str, Any]:
+        uptime = time.time() - self.start_time
+        avg_response_time, p95_response_time = self._response_time_stats()
         error_rate = (self.error_count / self.request_count * 100) if self.request_count > 0 else 0
+        healthy = error_rate < 5 and system['cpu_percent'] < 80 and probe.get('status', 'healthy') == 'healthy'
         
         return {
-            'status': 'healthy' if error_rate < 5 and cpu_percent < 80 else 'degraded',
+            'status': 'healthy' if healthy else 'degraded',
             'uptime_seconds': int(uptime),
             'uptime_human': str(timedelta(seconds=int(uptime))),
-            'system': {
-                'cpu_percent': cpu_percent,
-                'memory_percent': memory.percent,
-                'memory_available_mb': memory.available // (1024 * 1024),
-                'disk_percent': disk.percent,
-                'disk_free_gb': disk.free // (1024 ** 3)
-            },
+            'system': system,
+            'probe': probe,
+            'latency_ms': self.latency_summary(),
             'application': {
                 'total_requests': self.request_count,
                 'total_errors': self.error_count,
@@ -83,6 +383,34 @@ class HealthMonitor:
             'timestamp': datetime.now().isoformat()
         }
     
+    async def refresh(self, probe=None) -> Dict[str, Any]:
+        """
+        Lấy mẫu hệ thống (trong thread vì psutil có thể đọc /proc, đĩa) và chạy
+        coroutine `probe` (trả dict có 'status'), rồi thay snapshot đã cache.
+        """
+        system = await asyncio.to_thread(self._sample_system)
+        probe_result = await probe() if probe else {}
+        try:
+            await asyncio.to_thread(self.write_sketches, self.serialize_sketches())
+        except OSError as e:
+            logger.warning(f"Could not publish latency sketches: {e}")
+        self._snapshot = self._build_status(system, probe_result)
+        self.snapshot_monotonic = time.monotonic()
+        return self._snapshot
+    
+    def snapshot_age(self) -> float | None:
+        """Số giây từ lần refresh() gần nhất, None nếu chưa có snapshot."""
+        if self._snapshot is None:
+            return None
+        return time.monotonic() - self.snapshot_monotonic
+    
+    def get_health_status(self) -> Dict[str, Any]:
+        """Trả về snapshot sức khỏe gần nhất (không chặn, không sắp xếp lại dữ liệu)"""
+        if self._snapshot is None:
+            # Sampler chưa chạy lần nào: tính nhanh một lần, không có kết quả probe
+            return self._build_status(self._sample_system(), {})
+        return {**self._snapshot, 'snapshot_age_seconds': round(self.snapshot_age(), 3)}
+    
     def get_recent_errors(self, limit: int = 10) -> list:
         """Lấy danh sách lỗi gần đây"""
         return list(self.error_log)[-limit:]
@@ -91,85 +419,340 @@ class HealthMonitor:
 health_monitor = HealthMonitor()
 
 
+class EventLoopMonitor:
+    """
+    Đo độ trễ của event loop và bắt stack khi loop bị chặn.
+
+    - run(): task tick mỗi `interval` giây, độ trễ so với lịch được ghi vào
+      health_monitor (latency 'event_loop_lag') và histogram Prometheus.
+    - Một thread watchdog theo dõi mốc tick cuối: nếu loop không tick quá
+      `interval + stall_threshold`, lấy stack hiện tại của thread event loop
+      (chính đoạn code đang chặn) và giữ trong `recent_stalls`. Mỗi lần bị chặn
+      chỉ ghi một stack. Stall không tính vào error_count của health_monitor
+      (tỉ lệ lỗi request của /health), chỉ vào stall_count và counter Prometheus.
+    """
+    
+    def __init__(self, monitor: HealthMonitor, interval: float = 0.5, stall_threshold: float = 0.2):
+        self.monitor = monitor
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.stall_count = 0
+        self.last_stall_ms = 0.0
+        self.recent_stalls: deque = deque(maxlen=10)
+        self._last_tick = time.perf_counter()
+        self._captured_tick: float | None = None
+        self._loop_thread_id: int | None = None
+        self._stop: threading.Event | None = None
+        self._watchdog: threading.Thread | None = None
+    
+    async def run(self, interval: float | None = None, stall_threshold: float | None = None):
+        if interval is not None:
+            self.interval = interval
+        if stall_threshold is not None:
+            self.stall_threshold = stall_threshold
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.perf_counter()
+        self._stop = stop = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch, args=(stop,), name="event-loop-watchdog", daemon=True)
+        self._watchdog.start()
+        try:
+            while True:
+                expected = time.perf_counter() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.perf_counter()
+                lag = max(now - expected, 0.0)
+                self._last_tick = now
+                self.monitor.record_latency('event_loop_lag', lag * 1000)
+                EVENT_LOOP_LAG.observe(lag)
+        finally:
+            stop.set()
+    
+    def _watch(self, stop: threading.Event):
+        poll = max(self.stall_threshold / 4, 0.01)
+        while not stop.wait(poll):
+            last_tick = self._last_tick
+            stalled_for = time.perf_counter() - last_tick - self.interval
+            if stalled_for > self.stall_threshold and self._captured_tick != last_tick:
+                self._captured_tick = last_tick
+                self._capture_stall(stalled_for)
+    
+    def _capture_stall(self, stalled_for: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=30)) if frame else "(không lấy được stack)\n"
+        self.stall_count += 1
+        self.last_stall_ms = stalled_for * 1000
+        EVENT_LOOP_STALLS.inc()
+        logger.warning(f"Event loop blocked for more than {stalled_for * 1000:.0f}ms, stack:\n{stack}")
+        self.recent_stalls.append({
+            'timestamp': datetime.now().isoformat(),
+            'blocked_ms': round(stalled_for * 1000, 1),
+            'stack': stack,
+        })
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            'interval_ms': self.interval * 1000,
+            'stall_threshold_ms': self.stall_threshold * 1000,
+            'stall_count': self.stall_count,
+            'last_stall_ms': round(self.last_stall_ms, 1),
+            'recent_stalls': list(self.recent_stalls),
+            'watchdog_alive': bool(self._watchdog and self._watchdog.is_alive()),
+        }
+
+loop_monitor = EventLoopMonitor(health_monitor)
+
+
+class CircuitBreakerOpen(Exception):
+    """Circuit breaker đang OPEN (hoặc đang có lời gọi thử ở HALF_OPEN): từ chối ngay."""
+
+
 class CircuitBreaker:
-    """Circuit Breaker pattern để xử lý lỗi liên tục"""
+    """
+    Circuit Breaker pattern để xử lý lỗi liên tục, dùng được với coroutine.
+
+        await breaker.call(func, *args)     # func async hoặc hàm thường
+        async with breaker: ...             # bọc một khối code
+        @breaker                            # decorator cho hàm async
+
+    Sau `failure_threshold` lỗi liên tiếp thì OPEN: mọi lời gọi bị từ chối ngay bằng
+    CircuitBreakerOpen trong `recovery_timeout` giây. Sau đó HALF_OPEN cho đúng một
+    lời gọi thử: thành công thì CLOSED, lỗi thì OPEN lại.
+    """
     
-    def __init__(self, failure_threshold: int = 5, recovery_timeout: int = 60):
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: int = 60, name: str = "default"):
+        self.name = name
         self.failure_threshold = failure_threshold
         self.recovery_timeout = recovery_timeout
         self.failure_count = 0
+        self.rejected_count = 0
         self.last_failure_time = None
         self.state = 'CLOSED'  # CLOSED, OPEN, HALF_OPEN
+        self._probe_in_flight = False
     
-    def call(self, func, *args, **kwargs):
-        """Thực thi hàm với circuit breaker"""
+    def _transition(self, state: str):
+        if state == 'OPEN':
+            logger.error(f"Circuit breaker '{self.name}' opened after {self.failure_count} failures")
+        else:
+            logger.info(f"Circuit breaker '{self.name}' entering {state} state")
+        self.state = state
+        CIRCUIT_BREAKER_TRANSITIONS.labels(self.name, state).inc()
+    
+    def _reject(self):
+        self.rejected_count += 1
+        CIRCUIT_BREAKER_REJECTIONS.labels(self.name).inc()
+        raise CircuitBreakerOpen(f"Circuit breaker '{self.name}' is {self.state}")
+    
+    def _before_call(self):
         if self.state == 'OPEN':
-            if time.time() - self.last_failure_time > self.recovery_timeout:
-                logger.info("Circuit breaker entering HALF_OPEN state")
-                self.state = 'HALF_OPEN'
-            else:
-                raise Exception("Circuit breaker is OPEN")
-        
-        try:
+            if time.monotonic() - self.last_failure_time < self.recovery_timeout:
+                self._reject()
+            self._transition('HALF_OPEN')
+        if self.state == 'HALF_OPEN':
+            if self._probe_in_flight:
+                self._reject()
+            self._probe_in_flight = True
+    
+    def _on_success(self):
+        self._probe_in_flight = False
+        self.failure_count = 0
+        if self.state != 'CLOSED':
+            self._transition('CLOSED')
+    
+    def _on_failure(self):
+        self._probe_in_flight = False
+        self.failure_count += 1
+        self.last_failure_time = time.monotonic()
+        if self.state == 'HALF_OPEN' or (self.state == 'CLOSED' and self.failure_count >= self.failure_threshold):
+            self._transition('OPEN')
+    
+    async def __aenter__(self):
+        self._before_call()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._on_success()
+        elif issubclass(exc_type, Exception):
+            self._on_failure()
+        else:
+            # CancelledError...: không tính là lỗi, chỉ nhả lượt thử
+            self._probe_in_flight = False
+        return False
+    
+    def __call__(self, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with self:
+                return await func(*args, **kwargs)
+        return wrapper
+    
+    async def call(self, func, *args, **kwargs):
+        """Thực thi hàm với circuit breaker"""
+        async with self:
             result = func(*args, **kwargs)
-            
-            if self.state == 'HALF_OPEN':
-                logger.info("Circuit breaker recovering to CLOSED state")
-                self.state = 'CLOSED'
-                self.failure_count = 0
-            
+            if inspect.isawaitable(result):
+                result = await result
             return result
-        
-        except Exception as e:
-            self.failure_count += 1
-            self.last_failure_time = time.time()
-            
-            if self.failure_count >= self.failure_threshold:
-                logger.error(f"Circuit breaker opened after {self.failure_count} failures")
-                self.state = 'OPEN'
-            
-            raise e
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failure_count': self.failure_count,
+            'rejected_count': self.rejected_count,
+            'seconds_since_failure': (
+                round(time.monotonic() - self.last_failure_time, 1) if self.last_failure_time is not None else None
+            ),
+        }
+
+
+class BulkheadFull(Exception):
+    """Bulkhead hết chỗ: hàng đợi đã đầy hoặc chờ slot quá `max_wait` giây."""
+
+
+class Bulkhead:
+    """
+    Giới hạn số coroutine cùng dùng một tài nguyên (session DB) cho mỗi subsystem,
+    để ingest, API và tác vụ nền không tranh nhau pool kết nối.
+
+    Hết slot thì coroutine xếp hàng tối đa `max_wait` giây; hàng đợi đã có `max_queue`
+    coroutine thì bị từ chối ngay. Khi DB chậm, lỗi BulkheadFull trả về nhanh thay vì
+    hàng nghìn coroutine cùng chờ. Thời gian chờ slot được ghi vào histogram.
+    """
+    
+    def __init__(self, name: str, max_concurrent: int, max_queue: int = 100, max_wait: float = 2.0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_use = 0
+        self.waiting = 0
+        self.rejected_count = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+    
+    def _reject(self, reason: str):
+        self.rejected_count += 1
+        BULKHEAD_REJECTIONS.labels(self.name, reason).inc()
+        raise BulkheadFull(f"Bulkhead '{self.name}' is full ({reason})")
+    
+    async def __aenter__(self):
+        waited = 0.0
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self._reject('queue_full')
+            self.waiting += 1
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                self._reject('timeout')
+            finally:
+                self.waiting -= 1
+            waited = time.perf_counter() - start
+        else:
+            await self._semaphore.acquire()
+        self.in_use += 1
+        BULKHEAD_QUEUE_DURATION.labels(self.name).observe(waited)
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_use -= 1
+        self._semaphore.release()
+        return False
+    
+    def wrap_dependency(self, dependency):
+        """
+        Bọc dependency FastAPI dạng async generator (get_db...) để session chiếm một slot.
+        Generator bên trong được đóng (kể cả khi exception được ném vào) trước khi trả slot,
+        nên session không còn mở khi coroutine khác đã nhận slot đó.
+        """
+        session_context = asynccontextmanager(dependency)
+
+        @functools.wraps(dependency)
+        async def guarded():
+            async with self, session_context() as session:
+                yield session
+        return guarded
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'max_concurrent': self.max_concurrent,
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'rejected_count': self.rejected_count,
+        }
+
+
+# Session DB theo subsystem: MQTT/WebSocket ingest, request API, tác vụ nền (heartbeat, health probe)
+ingest_db_bulkhead = Bulkhead(
+    "db_ingest", settings.DB_BULKHEAD_INGEST, settings.DB_BULKHEAD_MAX_QUEUE, settings.DB_BULKHEAD_MAX_WAIT_SECONDS
+)
+api_db_bulkhead = Bulkhead(
+    "db_api", settings.DB_BULKHEAD_API, settings.DB_BULKHEAD_MAX_QUEUE, settings.DB_BULKHEAD_MAX_WAIT_SECONDS
+)
+background_db_bulkhead = Bulkhead(
+    "db_background", settings.DB_BULKHEAD_BACKGROUND, settings.DB_BULKHEAD_MAX_QUEUE, settings.DB_BULKHEAD_MAX_WAIT_SECONDS
+)
 
 
 class RateLimiter:
-    """Rate limiter đơn giản dựa trên IP"""
+    """
+    Rate limiter GCRA (Generic Cell Rate Algorithm) dùng chung giữa các worker.
+
+    Mỗi key chỉ chiếm một slot 16 byte (hash của key + TAT - theoretical arrival time)
+    trong một bảng kích thước cố định, map từ file qua mmap. Kiểm tra là O(1): băm key,
+    dò tối đa PROBES slot liên tiếp. Slot đã hết hạn (TAT <= now) được tái sử dụng nên
+    không cần dọn dẹp định kỳ; khi bảng đầy, slot sắp hết hạn nhất bị thay thế.
+
+    Không dùng lock: hai worker cập nhật cùng một key đúng cùng lúc có thể để lọt thêm
+    một request, chấp nhận được đối với rate limiting.
+    """
     
-    def __init__(self, max_requests: int = 100, window_seconds: int = 60):
+    _SLOT = struct.Struct("<Qd")
+    PROBES = 8
+    
+    def __init__(self, name: str, max_requests: int = 100, window_seconds: int = 60, slots: int = 16384):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests: Dict[str, deque] = {}
+        self.emission_interval = window_seconds / max_requests
+        self.slots = slots
+        self._mm = open_shared_file(f"ratelimit_{name}.table", slots * self._SLOT.size)
+    
+    @staticmethod
+    def _key_hash(identifier: str) -> int:
+        # hash() của Python khác nhau giữa các process nên phải dùng hàm băm ổn định
+        digest = hashlib.blake2b(identifier.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1  # 0 đánh dấu slot trống
     
     def is_allowed(self, identifier: str) -> bool:
         """Kiểm tra xem request có được phép không"""
         now = time.time()
+        key = self._key_hash(identifier)
+        base = key % self.slots
+        slot_size = self._SLOT.size
         
-        if identifier not in self.requests:
-            self.requests[identifier] = deque()
+        offset, tat = None, 0.0
+        reusable, evict, evict_tat = None, None, float("inf")
+        for i in range(self.PROBES):
+            probe = ((base + i) % self.slots) * slot_size
+            slot_key, slot_tat = self._SLOT.unpack_from(self._mm, probe)
+            if slot_key == key:
+                offset, tat = probe, slot_tat
+                break
+            if reusable is None and (slot_key == 0 or slot_tat <= now):
+                reusable = probe
+            elif slot_tat < evict_tat:
+                evict, evict_tat = probe, slot_tat
+        if offset is None:
+            offset = reusable if reusable is not None else evict
         
-        # Xóa các requests cũ
-        while self.requests[identifier] and self.requests[identifier][0] < now - self.window_seconds:
-            self.requests[identifier].popleft()
-        
-        if len(self.requests[identifier]) >= self.max_requests:
+        new_tat = max(tat, now) + self.emission_interval
+        if new_tat - now > self.window_seconds:
             return False
         
-        self.requests[identifier].append(now)
+        self._SLOT.pack_into(self._mm, offset, key, new_tat)
         return True
-    
-    def cleanup(self):
-        """Dọn dẹp dữ liệu cũ định kỳ"""
-        now = time.time()
-        to_remove = []
-        
-        for identifier, requests in self.requests.items():
-            while requests and requests[0] < now - self.window_seconds:
-                requests.popleft()
-            
-            if not requests:
-                to_remove.append(identifier)
-        
-        for identifier in to_remove:
-            del self.requests[identifier]
 
 # Global rate limiter
-global_rate_limiter = RateLimiter(max_requests=1000, window_seconds=60)
\ No newline at end of file
+global_rate_limiter = RateLimiter("global", max_requests=1000, window_seconds=60)
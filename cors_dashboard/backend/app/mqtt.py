@@ -6,7 +6,7 @@
 # - Kết nối đến MQTT Broker một cách non-blocking.
 # - Lắng nghe (subscribe) các topic dữ liệu từ các thiết bị Pi.
 # - Phân loại và xử lý các loại tin nhắn:
-#   1. Dữ liệu thô (NMEA)
+#   1. Dữ liệu thô (NMEA, hoặc RTCM3 nhị phân từ trạm base)
 #   2. Dữ liệu trạng thái (status - JSON)
 #   3. Dữ liệu cấu hình (config_state - JSON)
 # - Chuyển tiếp (broadcast) dữ liệu đã được xử lý đến các client UI
@@ -16,6 +16,7 @@ import json
 import logging
 import asyncio
 import os
+import time
 import paho.mqtt.client as mqtt
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
@@ -24,6 +25,20 @@ from . import crud, schemas
 from .websocket import manager
 from .database import engine, settings
 from . import nmea_parser
+from .rtcm import is_nmea_sentence, rtcm_monitor
+from .position_history import position_history
+from .survey import survey_monitor
+from .drift import drift_monitor
+from .spatial import station_index
+from .metrics import MQTT_MESSAGES, DB_UPSERT_DURATION
+from .monitoring import health_monitor, ingest_db_bulkhead, BulkheadFull
+from .tracing import ingest_tracer, gga_epoch
+from .logging_setup import serial_ctx
+
+# Các loại topic đã subscribe; topic khác được đếm là "other" để giới hạn số series
+_KNOWN_MESSAGE_TYPES = frozenset({"status", "service_config_state", "base_config_state", "raw_data"})
+# Log theo từng tin nhắn được lấy mẫu theo category (settings.LOG_SAMPLE_RATES)
+_MESSAGE_LOG = {"category": "mqtt.message"}
 
 # --- KHỞI TẠO CÁC ĐỐI TƯỢỢNG ---
 # Tạo một session factory riêng để sử dụng trong luồng MQTT
@@ -67,47 +82,74 @@ def on_message(client, userdata, msg):
     Hàm này chạy trong thread riêng của Paho-MQTT, nhiệm vụ của nó là
     chuyển việc xử lý sang event loop chính của FastAPI một cách an toàn.
     """
-    logging.debug(f"===> Backend nhận được tin nhắn MQTT. Topic: '{msg.topic}'")
+    logging.debug("===> Backend nhận được tin nhắn MQTT. Topic: '%s'", msg.topic, extra=_MESSAGE_LOG)
+    received_at = time.perf_counter()
     
     if main_loop and main_loop.is_running():
         # Đặt coroutine `handle_message_async` vào event loop để thực thi
         asyncio.run_coroutine_threadsafe(
-            handle_message_async(msg.topic, msg.payload), 
+            handle_message_async(msg.topic, msg.payload, received_at), 
             main_loop
         )
     else:
         logging.warning("Event loop chính chưa sẵn sàng để xử lý tin nhắn MQTT.")
 
 
-async def handle_message_async(topic: str, payload: bytes):
+async def handle_message_async(topic: str, payload: bytes, received_at: float | None = None):
     """
     Hàm async xử lý logic chính của tin nhắn MQTT.
     Được thực thi trong event loop của FastAPI.
+    `received_at` (perf_counter lúc paho nhận tin) là mốc đầu của IngestTrace.
     """
-    logging.debug(f"--> Bắt đầu xử lý bất đồng bộ cho topic '{topic}'")
+    logging.debug("--> Bắt đầu xử lý bất đồng bộ cho topic '%s'", topic, extra=_MESSAGE_LOG)
 
     topic_parts = topic.split('/')
     if len(topic_parts) < 4: 
+        MQTT_MESSAGES.labels("invalid").inc()
         logging.warning(f"Nhận được topic MQTT không hợp lệ: {topic}")
         return
     
     message_type = topic_parts[-1]
     serial = topic_parts[2]
+    # Task riêng cho mỗi tin nhắn nên đặt contextvar không ảnh hưởng tin khác
+    serial_ctx.set(serial)
+    MQTT_MESSAGES.labels(message_type if message_type in _KNOWN_MESSAGE_TYPES else "other").inc()
     
     try:
         # --- ƯU TIÊN 1: Xử lý dữ liệu thô (raw_data / NMEA) trước tiên ---
         # Dữ liệu này không phải là JSON, nên phải xử lý riêng và thoát sớm.
         if message_type == "raw_data":
+            if is_nmea_sentence(payload):
+                # Câu NMEA trọn vẹn (checksum đúng) luôn là NMEA: bỏ khung dở trong framer (vd. một
+                # 0xD3 lạc với trường độ dài lớn), nếu không framer sẽ nuốt NMEA của trạm tới ~1 KB
+                rtcm_monitor.discard_pending(serial)
+            elif rtcm_monitor.pending(serial) or not payload.startswith(b'$') or not payload.isascii():
+                # Luồng RTCM3 nhị phân: framer của trạm giữ phần khung còn dở. Một đoạn RTCM có thể
+                # tình cờ bắt đầu bằng 0x24 ('$'), nên chỉ coi là NMEA khi là ASCII thuần và framer trống
+                try:
+                    rtcm_monitor.feed(serial, payload)
+                except Exception as e:
+                    logging.error(f"Lỗi khi xử lý RTCM cho '{serial}': {e}")
+                return
             try:
+                trace = ingest_tracer.start("nmea", serial, "mqtt", received_at)
                 line = payload.decode('ascii', errors='ignore')
                 parsed_data = nmea_parser.parse(line)
                 if parsed_data:
+                    if parsed_data.get("type") == "GGA":
+                        trace.set_device_timestamp(gga_epoch(parsed_data.get("timestamp_utc"), trace.received_wall))
+                        position_history.record_gga(serial, parsed_data)
+                        survey_monitor.record_gga(serial, parsed_data)
+                        drift_monitor.record_gga(serial, parsed_data)
+                        station_index.update_fix(serial, parsed_data)
                     # Gửi dữ liệu đã phân tích đến UI qua WebSocket
                     await manager.broadcast({
                         "type": "nmea_update",
                         "serial": serial,
                         "data": parsed_data
                     })
+                    trace.mark_broadcast()
+                    ingest_tracer.finish(trace)
             except Exception as e:
                 logging.error(f"Lỗi khi phân tích dữ liệu NMEA cho '{serial}': {e}")
             return # Quan trọng: Thoát sớm sau khi xử lý raw_data
@@ -118,34 +160,53 @@ async def handle_message_async(topic: str, payload: bytes):
         
         # --- Xử lý tin nhắn 'status' ---
         if message_type == "status":
-            async with AsyncSessionLocal_MQTT() as session:
+            trace = ingest_tracer.start("status", serial, "mqtt", received_at)
+            trace.set_device_timestamp(data.get("timestamp"))
+            async with ingest_db_bulkhead, AsyncSessionLocal_MQTT() as session:
+                start = time.perf_counter()
                 device_obj = await crud.update_or_create_device(session, device_data=data)
+                trace.mark_db_commit()
+                elapsed = time.perf_counter() - start
+                DB_UPSERT_DURATION.labels("mqtt").observe(elapsed)
+                health_monitor.record_latency('db', elapsed * 1000)
                 if device_obj:
+                    drift_monitor.set_reference(device_obj.serial, device_obj.base_config)
+                    station_index.update_device(device_obj)
                     device_schema = schemas.Device.from_orm(device_obj)
                     #logging.info(f"Đang broadcast status_update cho '{serial}' đến {len(manager.active_connections)} UI client(s).")
                     await manager.broadcast({
                         "type": "status_update", 
                         "data": device_schema.model_dump()
                     })
+                    trace.mark_broadcast()
+                    ingest_tracer.finish(trace)
                 else:
                     logging.error(f"Không thể cập nhật/tạo thiết bị '{serial}' trong DB từ MQTT.")
 
         # --- Xử lý tin nhắn 'base_config_state' ---
         elif message_type == "base_config_state":
+            trace = ingest_tracer.start("config", serial, "mqtt", received_at)
             await manager.broadcast({
                 "type": "base_config_state",
                 "serial": serial,
                 "data": data
             })
+            trace.mark_broadcast()
+            ingest_tracer.finish(trace)
 
         # --- Xử lý tin nhắn 'service_config_state' ---
         elif message_type == "service_config_state":
+            trace = ingest_tracer.start("config", serial, "mqtt", received_at)
             await manager.broadcast({
                 "type": "service_config_state", 
                 "serial": serial, 
                 "data": data
             })
+            trace.mark_broadcast()
+            ingest_tracer.finish(trace)
 
+    except BulkheadFull as e:
+        logging.warning(f"Bỏ qua tin nhắn '{topic}' vì DB quá tải: {e}")
     except json.JSONDecodeError:
         logging.warning(f"Nhận được tin nhắn không phải JSON trên topic '{topic}'. Payload: {payload[:50]}...")
     except Exception as e:
@@ -220,18 +281,21 @@ def stop_mqtt_loop():
 def publish_message(topic: str, payload: str, qos: int = 1):
     """
     Hàm tiện ích để gửi tin nhắn từ backend đến MQTT Broker.
+    Trả về True nếu paho nhận tin nhắn vào hàng đợi gửi thành công.
     """
     try:
         if not mqtt_client.is_connected():
             logging.warning(f"Không thể publish vì chưa kết nối MQTT. Topic: {topic}")
-            return
+            return False
 
         result = mqtt_client.publish(topic, payload, qos=qos)
         
         if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            logging.debug(f"✓ Đã publish thành công đến topic '{topic}'")
+            logging.debug("✓ Đã publish thành công đến topic '%s'", topic, extra=_MESSAGE_LOG)
+            return True
         else:
             logging.error(f"!!! Lỗi khi publish đến topic '{topic}': {mqtt.error_string(result.rc)}")
             
     except Exception as e:
-        logging.error(f"Ngoại lệ khi publish tin nhắn MQTT: {e}", exc_info=True)
\ No newline at end of file
+        logging.error(f"Ngoại lệ khi publish tin nhắn MQTT: {e}", exc_info=True)
+    return False
\ No newline at end of file
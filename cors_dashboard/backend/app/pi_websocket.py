@@ -2,6 +2,9 @@
 import logging
 from typing import Dict
 from fastapi import WebSocket
+from .metrics import WEBSOCKET_CONNECTIONS
+
+_pi_connections_gauge = WEBSOCKET_CONNECTIONS.labels("pi")
 
 class PiConnectionManager:
     def __init__(self):
@@ -12,12 +15,14 @@ class PiConnectionManager:
         """Chấp nhận và lưu kết nối từ một Pi."""
         await websocket.accept()
         self.active_connections[serial] = websocket
+        _pi_connections_gauge.set(len(self.active_connections))
         logging.info(f"Pi '{serial}' connected via WebSocket.")
 
     def disconnect(self, serial: str):
         """Xóa kết nối khi Pi ngắt kết nối."""
         if serial in self.active_connections:
             del self.active_connections[serial]
+            _pi_connections_gauge.set(len(self.active_connections))
             logging.info(f"Pi '{serial}' disconnected from WebSocket.")
 
     async def send_personal_message(self, serial: str, message: dict) -> bool:
@@ -0,0 +1,292 @@
+# ==============================================================================
+# == backend/app/position_history.py - Lịch sử vị trí GGA theo trạm          ==
+# ==============================================================================
+#
+# UI chỉ nhận GGA mới nhất nên không vẽ được biểu đồ ổn định vị trí/độ cao.
+# Module này giữ cho mỗi trạm một ring buffer kích thước cố định (array kiểu C,
+# không tạo object cho từng fix) và trả về một khoảng thời gian đã giảm mẫu
+# theo LTTB (Largest-Triangle-Three-Buckets) còn vài trăm điểm cho biểu đồ.
+#
+# Nếu đặt POSITION_HISTORY_DIR, các ring buffer được ghi xuống đĩa định kỳ và
+# khi tắt, rồi nạp lại lúc khởi động để lịch sử không mất sau khi restart.
+
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+
+from .database import settings
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("t", "lat", "lon", "alt", "hdop")
+_FILE_MAGIC = b"PHR2"
+_FILE_HEADER = struct.Struct("<4sIIH")  # magic, capacity, số điểm, độ dài serial (UTF-8, ngay sau header)
+_FILE_SUFFIX = ".pos"
+
+
+class PositionRing:
+    """
+    Ring buffer các fix GGA: năm cột float64 (t, lat, lon, alt, hdop) và một cột
+    int8 (fix quality). Bộ nhớ cấp dần tới `capacity` rồi ghi đè điểm cũ nhất.
+    """
+
+    __slots__ = ("capacity", "columns", "fix", "_head")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.columns = {name: array("d") for name in FIELDS}
+        self.fix = array("b")
+        self._head = 0  # vị trí điểm cũ nhất khi đã đầy
+
+    def __len__(self) -> int:
+        return len(self.fix)
+
+    @property
+    def last_time(self) -> Optional[float]:
+        if not self.fix:
+            return None
+        return self.columns["t"][self._head - 1]
+
+    def append(self, t: float, lat: float, lon: float, alt: float, hdop: float, fix_quality: int):
+        last = self.last_time
+        if last is not None and t < last:
+            t = last  # đồng hồ lùi: giữ cột thời gian không giảm để tìm kiếm nhị phân
+        values = (t, lat, lon, alt, hdop)
+        if len(self.fix) < self.capacity:
+            for name, value in zip(FIELDS, values):
+                self.columns[name].append(value)
+            self.fix.append(fix_quality)
+            return
+        i = self._head
+        for name, value in zip(FIELDS, values):
+            self.columns[name][i] = value
+        self.fix[i] = fix_quality
+        self._head = (i + 1) % self.capacity
+
+    def _ordered(self, column: array) -> array:
+        head = self._head
+        return column[head:] + column[:head] if head else column[:]
+
+    def window(self, start: Optional[float] = None, end: Optional[float] = None) -> Dict[str, array]:
+        """Các cột theo thứ tự thời gian, chỉ gồm điểm có start <= t <= end."""
+        times = self._ordered(self.columns["t"])
+        lo = 0 if start is None else bisect_left(times, start)
+        hi = len(times) if end is None else bisect_right(times, end)
+        result = {"t": times[lo:hi]}
+        for name in FIELDS[1:]:
+            result[name] = self._ordered(self.columns[name])[lo:hi]
+        result["fix"] = self._ordered(self.fix)[lo:hi]
+        return result
+
+    def to_bytes(self, serial: str) -> bytes:
+        columns = self.window()
+        name = serial.encode("utf-8")
+        parts = [_FILE_HEADER.pack(_FILE_MAGIC, self.capacity, len(self), len(name)), name]
+        parts.extend(columns[name].tobytes() for name in FIELDS)
+        parts.append(columns["fix"].tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, capacity: int) -> tuple[str, "PositionRing"]:
+        """Ngược lại của to_bytes(): trả về (serial gốc, ring)."""
+        magic, _, count, name_length = _FILE_HEADER.unpack_from(data, 0)
+        offset = _FILE_HEADER.size + name_length
+        if magic != _FILE_MAGIC or len(data) != offset + count * (8 * len(FIELDS) + 1):
+            raise ValueError("file lịch sử vị trí không hợp lệ")
+        serial = data[_FILE_HEADER.size:offset].decode("utf-8")
+        columns = {}
+        for name in FIELDS:
+            columns[name] = array("d")
+            columns[name].frombytes(data[offset:offset + count * 8])
+            offset += count * 8
+        fix = array("b")
+        fix.frombytes(data[offset:offset + count])
+
+        ring = cls(capacity)
+        keep = min(count, capacity)  # capacity có thể đã giảm từ lần ghi trước
+        for name in FIELDS:
+            ring.columns[name] = columns[name][count - keep:]
+        ring.fix = fix[count - keep:]
+        return serial, ring
+
+
+def lttb_indices(t: Sequence[float], series: Sequence[Sequence[float]], threshold: int) -> list[int]:
+    """
+    Chọn `threshold` chỉ số theo LTTB. Với nhiều chuỗi (lat, lon, alt...) diện tích
+    tam giác của từng chuỗi được chuẩn hóa theo biên độ của chuỗi đó rồi cộng lại,
+    nên các điểm được giữ chung cho mọi chuỗi và cùng một mốc thời gian.
+    Điểm đầu và cuối luôn được giữ.
+    """
+    n = len(t)
+    if threshold >= n or n <= 2:
+        return list(range(n))
+    threshold = max(threshold, 3)
+
+    scales = []
+    for values in series:
+        span = max(values) - min(values)
+        scales.append(1.0 / span if span > 0 else 0.0)
+    columns = [(values, scale) for values, scale in zip(series, scales) if scale]
+
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # Bucket hiện tại [start, end) và trung bình bucket kế tiếp
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, n)
+        count = next_end - next_start
+        avg_t = sum(t[next_start:next_end]) / count
+        avgs = [sum(values[next_start:next_end]) / count for values, _ in columns]
+
+        ta = t[a]
+        best = start
+        best_area = -1.0
+        for j in range(start, end):
+            tj = t[j]
+            area = 0.0
+            for (values, scale), avg in zip(columns, avgs):
+                ya = values[a]
+                area += abs((ta - avg_t) * (values[j] - ya) - (ta - tj) * (avg - ya)) * scale
+            if area > best_area:
+                best_area = area
+                best = j
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+def downsample(window: dict, points: int) -> dict:
+    """Giảm một window (PositionHistory.window) còn tối đa `points` điểm; chạy được trong thread."""
+    indices = lttb_indices(window["t"], [window["lat"], window["lon"], window["alt"]], points)
+    result = {
+        "serial": window["serial"],
+        "capacity": window["capacity"],
+        "stored": window["stored"],
+        "window_points": len(window["t"]),
+        "points": len(indices),
+    }
+    for name in (*FIELDS, "fix"):
+        column = window[name]
+        result[name] = [column[i] for i in indices]
+    return result
+
+
+class PositionHistory:
+    """Ring buffer cho từng serial; trạm lâu không cập nhật nhất bị bỏ khi vượt `max_devices`."""
+
+    def __init__(self, capacity: int, max_devices: int, directory: Optional[str] = None):
+        self.capacity = capacity
+        self.max_devices = max_devices
+        self.directory = directory or None
+        self.rings: "OrderedDict[str, PositionRing]" = OrderedDict()
+
+    def record_gga(self, serial: str, gga: dict, now: Optional[float] = None):
+        """Thêm một fix từ kết quả NMEAParser (type GGA); fix thiếu tọa độ bị bỏ qua."""
+        lat = gga.get("latitude")
+        lon = gga.get("longitude")
+        if lat is None or lon is None:
+            return
+        ring = self.rings.get(serial)
+        if ring is None:
+            ring = self.rings[serial] = PositionRing(self.capacity)
+            if len(self.rings) > self.max_devices:
+                self.rings.popitem(last=False)
+        else:
+            self.rings.move_to_end(serial)
+        ring.append(
+            time.time() if now is None else now, lat, lon,
+            gga.get("altitude") or 0.0, gga.get("hdop") or 99.99, gga.get("fix_quality") or 0,
+        )
+
+    def window(self, serial: str, start: Optional[float] = None, end: Optional[float] = None) -> Optional[dict]:
+        """
+        Bản sao khoảng [start, end] (epoch giây) của `serial`. Gọi trên event loop;
+        kết quả là bản sao nên có thể đưa sang thread để downsample().
+        """
+        ring = self.rings.get(serial)
+        if ring is None:
+            return None
+        window = ring.window(start, end)
+        window.update(serial=serial, capacity=ring.capacity, stored=len(ring))
+        return window
+
+    # --- Lưu / nạp từ đĩa ---
+
+    def _path(self, serial: str) -> str:
+        # Tên file chỉ để phân biệt trạm (serial gốc nằm trong header); thêm hash khi phải
+        # thay ký tự để hai serial khác nhau không ghi đè lên cùng một file
+        safe = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in serial)
+        if safe != serial:
+            safe += "-" + hashlib.blake2b(serial.encode("utf-8"), digest_size=4).hexdigest()
+        return os.path.join(self.directory, safe + _FILE_SUFFIX)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        # Nhiều worker cùng ghi: os.replace nguyên tử nên file luôn hợp lệ
+        os.replace(tmp, path)
+
+    async def save(self) -> int:
+        """
+        Ghi mọi ring buffer. Chụp dữ liệu trên event loop (ring không bị sửa giữa chừng),
+        ghi file trong thread. Trả về số trạm đã ghi.
+        """
+        if not self.directory:
+            return 0
+        await asyncio.to_thread(os.makedirs, self.directory, exist_ok=True)
+        saved = 0
+        for serial, ring in list(self.rings.items()):
+            try:
+                await asyncio.to_thread(self._write, self._path(serial), ring.to_bytes(serial))
+                saved += 1
+            except OSError as e:
+                logger.warning(f"Không ghi được lịch sử vị trí của '{serial}': {e}")
+        return saved
+
+    async def run_persistence(self, interval: float):
+        """Task nền: ghi xuống đĩa mỗi `interval` giây (không làm gì nếu chưa đặt thư mục)."""
+        if not self.directory or interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Lỗi khi lưu lịch sử vị trí: {e}")
+
+    def load(self) -> int:
+        """Nạp các file đã lưu (gọi lúc khởi động). Trả về số trạm đã nạp."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return 0
+        loaded = 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(_FILE_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "rb") as f:
+                    serial, ring = PositionRing.from_bytes(f.read(), self.capacity)
+                self.rings[serial] = ring
+                loaded += 1
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"Bỏ qua file lịch sử vị trí '{name}': {e}")
+        while len(self.rings) > self.max_devices:
+            self.rings.popitem(last=False)
+        return loaded
+
+
+position_history = PositionHistory(
+    settings.POSITION_HISTORY_SIZE, settings.POSITION_HISTORY_MAX_DEVICES, settings.POSITION_HISTORY_DIR
+)
@@ -0,0 +1,147 @@
+# ==============================================================================
+# == backend/app/profiler.py - Profiler lấy mẫu theo yêu cầu (admin)         ==
+# ==============================================================================
+#
+# Khi một worker ngốn CPU, admin gọi endpoint profile để lấy mẫu stack của mọi
+# thread trong worker đó (event loop, thread paho MQTT, executor...) trong N giây.
+# Không có gì chạy khi không profile: thread lấy mẫu chỉ tồn tại trong lúc đo.
+# Kết quả:
+#   - collapsed stack ("thread;frame;frame count") cho flamegraph.pl / speedscope
+#   - top hàm theo self time (số mẫu hàm nằm ở đỉnh stack) và total time
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict
+
+MAX_PROFILE_SECONDS = 60.0
+MIN_INTERVAL_SECONDS = 0.001
+MAX_STACK_DEPTH = 128
+
+# Frame ở đỉnh stack khi thread chỉ đang chờ (select/Condition.wait...);
+# bỏ qua mặc định để kết quả chỉ còn thời gian thực sự dùng CPU.
+IDLE_LEAVES = frozenset({
+    ("selectors", "EpollSelector.select"), ("selectors", "PollSelector.select"),
+    ("threading", "Condition.wait"), ("threading", "Event.wait"),
+    ("concurrent.futures.thread", "_worker"),
+    # paho chờ trong select.select()/time.sleep() (hàm C) nên đỉnh stack là chính vòng lặp
+    ("paho.mqtt.client", "Client._loop"), ("paho.mqtt.client", "Client._reconnect_wait"),
+})
+
+
+class ProfilerBusy(Exception):
+    """Worker đang chạy một phiên profile khác."""
+
+
+class SamplingProfiler:
+    """
+    Profiler thống kê: một thread đọc sys._current_frames() mỗi `interval` giây
+    và đếm các stack giống nhau. Mỗi worker chỉ chạy một phiên tại một thời điểm.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels: Dict[Any, str] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def _label(self, frame) -> str:
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            module = frame.f_globals.get("__name__", "?")
+            label = self._labels[code] = f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+        return label
+
+    def run(self, seconds: float, interval: float = 0.01, include_idle: bool = False) -> Dict[str, Any]:
+        """Lấy mẫu trong `seconds` giây (chặn thread gọi). Raise ProfilerBusy nếu đang có phiên khác."""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            return self._sample(min(seconds, MAX_PROFILE_SECONDS), max(interval, MIN_INTERVAL_SECONDS), include_idle)
+        finally:
+            # Không giữ tham chiếu tới code object giữa các phiên
+            self._labels = {}
+            self._lock.release()
+
+    def _sample(self, seconds: float, interval: float, include_idle: bool) -> Dict[str, Any]:
+        own_ident = threading.get_ident()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        stacks: Counter = Counter()
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        next_tick = started
+
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    labels.append(self._label(frame))
+                    frame = frame.f_back
+                if ident not in thread_names:
+                    thread_names.update((t.ident, t.name) for t in threading.enumerate())
+                stacks[(thread_names.get(ident, f"thread-{ident}"), tuple(reversed(labels)))] += 1
+            samples += 1
+            # Giữ nhịp cố định; nếu bị trễ (GIL bận) thì bỏ qua các tick đã lỡ
+            next_tick += interval
+            if next_tick < now:
+                next_tick = now + interval
+            time.sleep(max(next_tick - time.perf_counter(), 0))
+
+        duration = time.perf_counter() - started
+        if not include_idle:
+            stacks = Counter({
+                key: count for key, count in stacks.items()
+                if not key[1] or tuple(key[1][-1].split(":", 1)) not in IDLE_LEAVES
+            })
+        return self._report(stacks, samples, duration, interval)
+
+    @staticmethod
+    def _report(stacks: Counter, samples: int, duration: float, interval: float) -> Dict[str, Any]:
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        thread_counts: Counter = Counter()
+        for (thread_name, frames), count in stacks.items():
+            thread_counts[thread_name] += count
+            if frames:
+                self_counts[frames[-1]] += count
+                for label in set(frames):
+                    total_counts[label] += count
+
+        busy = sum(stacks.values()) or 1
+        functions = [
+            {
+                "function": label,
+                "self_samples": count,
+                "self_percent": round(count * 100 / busy, 2),
+                "total_samples": total_counts[label],
+                "total_percent": round(total_counts[label] * 100 / busy, 2),
+            }
+            for label, count in self_counts.most_common()
+        ]
+        collapsed = "\n".join(
+            f"{';'.join((thread_name.replace(';', '_'), *frames))} {count}"
+            for (thread_name, frames), count in sorted(stacks.items(), key=lambda item: -item[1])
+        )
+        return {
+            "pid": os.getpid(),
+            "duration_seconds": round(duration, 3),
+            "interval_ms": round(interval * 1000, 3),
+            "samples": samples,
+            "threads": dict(thread_counts.most_common()),
+            "functions": functions,
+            "collapsed": collapsed,
+        }
+
+
+profiler = SamplingProfiler()
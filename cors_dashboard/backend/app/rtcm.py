@@ -0,0 +1,408 @@
+# ==============================================================================
+# == backend/app/rtcm.py - Tách khung và giải mã luồng RTCM3 (raw_data)      ==
+# ==============================================================================
+#
+# Trạm base gửi RTCM3 nhị phân trên cùng topic raw_data với NMEA. Một tin MQTT
+# có thể chứa nhiều khung, nửa khung hoặc rác giữa các khung, nên mỗi trạm có
+# một RtcmFramer giữ phần còn dở trong bytearray dùng lại giữa các lần feed.
+#
+# Khung RTCM3:  D3 | 6 bit reserved (0) + 10 bit độ dài | payload | CRC-24Q (3 byte)
+#
+# Chỉ giải mã phần cần cho giám sát: tọa độ ARP của trạm (1005/1006) và header
+# MSM (1071..1137: station id, epoch, số vệ tinh/tín hiệu). Các loại khác chỉ
+# được đếm để báo tần suất từng loại tin của mỗi trạm.
+
+import re
+import time
+from typing import Callable, Dict, Optional
+
+from .geodesy import ecef_to_lla
+from .metrics import RTCM_FRAMES, RTCM_CRC_ERRORS
+
+PREAMBLE = 0xD3
+HEADER_LEN = 3
+CRC_LEN = 3
+# Phần còn dở vượt quá mức này (luồng hỏng/không phải RTCM) thì bỏ, chỉ giữ đủ cho một khung
+MAX_BUFFER = 8 * 1024
+MAX_FRAME = HEADER_LEN + 1023 + CRC_LEN
+# Tần suất tính lại theo cửa sổ (giây); tin về theo lô vẫn cho tần suất đúng
+RATE_WINDOW_SECONDS = 10.0
+
+# Header MSM dài tối đa 169 bit + cell mask 64 bit: chỉ chuyển chừng đó byte sang int
+_MSM_HEADER_BYTES = 30
+# Một câu NMEA trọn vẹn trong một tin raw_data: $<nội dung>*<checksum hex>[CR][LF]
+_NMEA_SENTENCE = re.compile(rb"\$([\x20-\x7e]{1,200})\*([0-9A-Fa-f]{2})\r?\n?")
+MSM_CONSTELLATIONS = {
+    107: "GPS", 108: "GLONASS", 109: "Galileo", 110: "SBAS",
+    111: "QZSS", 112: "BeiDou", 113: "NavIC",
+}
+
+
+def _make_crc24q_table() -> tuple:
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+        table.append(crc & 0xFFFFFF)
+    return tuple(table)
+
+
+_CRC24Q_TABLE = _make_crc24q_table()
+
+
+def crc24q(data) -> int:
+    """CRC-24Q (Qualcomm) theo bảng tra 256 phần tử; `data` là bytes/bytearray/memoryview."""
+    table = _CRC24Q_TABLE
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ byte]
+    return crc
+
+
+def rtcm_frame(payload: bytes) -> bytes:
+    """Đóng gói payload thành một khung RTCM3 hoàn chỉnh (dùng khi kiểm thử/giả lập trạm)."""
+    if len(payload) > 1023:
+        raise ValueError("Payload RTCM3 tối đa 1023 byte")
+    body = bytes((PREAMBLE, len(payload) >> 8, len(payload) & 0xFF)) + bytes(payload)
+    return body + crc24q(body).to_bytes(CRC_LEN, "big")
+
+
+def is_nmea_sentence(data) -> bool:
+    """`data` là đúng một câu NMEA với checksum XOR khớp (khung RTCM dở gần như không thể thỏa)."""
+    match = _NMEA_SENTENCE.fullmatch(data)
+    if match is None:
+        return False
+    checksum = 0
+    for byte in match.group(1):
+        checksum ^= byte
+    return checksum == int(match.group(2), 16)
+
+
+class RtcmDecodeError(ValueError):
+    """Payload ngắn hơn nội dung mà loại tin yêu cầu."""
+
+
+class _BitReader:
+    """Đọc lần lượt các trường big-endian theo bit."""
+
+    __slots__ = ("value", "remaining")
+
+    def __init__(self, data):
+        self.value = int.from_bytes(data, "big")
+        self.remaining = len(data) * 8
+
+    def u(self, bits: int) -> int:
+        self.remaining -= bits
+        if self.remaining < 0:
+            raise RtcmDecodeError("payload quá ngắn")
+        return (self.value >> self.remaining) & ((1 << bits) - 1)
+
+    def s(self, bits: int) -> int:
+        value = self.u(bits)
+        return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def message_type(payload) -> int:
+    """12 bit đầu của payload (DF002)."""
+    return (payload[0] << 4) | (payload[1] >> 4) if len(payload) >= 2 else 0
+
+
+def is_msm(msg_type: int) -> bool:
+    return msg_type // 10 in MSM_CONSTELLATIONS and 1 <= msg_type % 10 <= 7
+
+
+def decode_station_arp(payload) -> dict:
+    """1005/1006: tọa độ ECEF của điểm tham chiếu anten (ARP), kèm LLA và chiều cao anten (1006)."""
+    r = _BitReader(payload[:21])
+    msg_type = r.u(12)
+    station_id = r.u(12)
+    itrf_year = r.u(6)
+    gps, glonass, galileo, reference_station = r.u(1), r.u(1), r.u(1), r.u(1)
+    x = r.s(38) * 1e-4
+    r.u(2)  # DF142 single receiver oscillator + DF001 reserved
+    y = r.s(38) * 1e-4
+    r.u(2)  # DF364 quarter cycle indicator
+    z = r.s(38) * 1e-4
+    antenna_height = r.u(16) * 1e-4 if msg_type == 1006 else 0.0
+    lat, lon, alt = ecef_to_lla(x, y, z)
+    return {
+        "message_type": msg_type,
+        "station_id": station_id,
+        "itrf_year": itrf_year,
+        "gps": bool(gps), "glonass": bool(glonass), "galileo": bool(galileo),
+        "reference_station": bool(reference_station),
+        "ecef": (x, y, z),
+        "antenna_height": antenna_height,
+        "latitude": lat, "longitude": lon, "altitude": alt,
+    }
+
+
+def decode_msm_header(payload) -> dict:
+    """Header của MSM1..MSM7 (mọi hệ vệ tinh)."""
+    r = _BitReader(payload[:_MSM_HEADER_BYTES])
+    msg_type = r.u(12)
+    station_id = r.u(12)
+    epoch = r.u(30)
+    multiple_message = r.u(1)
+    iods = r.u(3)
+    r.u(7)  # reserved
+    clock_steering = r.u(2)
+    external_clock = r.u(2)
+    r.u(4)  # divergence-free smoothing + smoothing interval
+    satellite_mask = r.u(64)
+    signal_mask = r.u(32)
+    satellites = satellite_mask.bit_count()
+    signals = signal_mask.bit_count()
+    if satellites * signals > 64:
+        raise RtcmDecodeError("cell mask vượt quá 64 bit")
+    cells = r.u(satellites * signals).bit_count()
+
+    constellation = MSM_CONSTELLATIONS[msg_type // 10]
+    if constellation == "GLONASS":
+        # 3 bit thứ trong tuần + 27 bit ms trong ngày (giờ Moscow)
+        epoch_ms = epoch & ((1 << 27) - 1)
+    else:
+        epoch_ms = epoch
+    return {
+        "message_type": msg_type,
+        "station_id": station_id,
+        "constellation": constellation,
+        "msm": msg_type % 10,
+        "epoch_ms": epoch_ms,
+        "multiple_message": bool(multiple_message),
+        "iods": iods,
+        "clock_steering": clock_steering,
+        "external_clock": external_clock,
+        "satellites": satellites,
+        "signals": signals,
+        "cells": cells,
+    }
+
+
+class RtcmFramer:
+    """
+    Tách khung RTCM3 từ luồng byte theo từng phần.
+
+    feed() nối dữ liệu mới vào bộ đệm, dò preamble, kiểm độ dài và CRC rồi gọi
+    on_frame(msg_type, payload) với payload là memoryview trỏ thẳng vào bộ đệm
+    (không copy). Callback phải dùng xong payload trước khi trả về; giữ lại
+    memoryview sẽ làm lần thu gọn bộ đệm sau đó lỗi BufferError.
+    """
+
+    __slots__ = ("_buffer", "frames", "crc_errors", "bytes_discarded")
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.bytes_discarded = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def discard(self) -> int:
+        """Bỏ phần khung còn dở (tính vào bytes_discarded), trả về số byte đã bỏ."""
+        discarded = len(self._buffer)
+        self.bytes_discarded += discarded
+        self._buffer.clear()
+        return discarded
+
+    def feed(self, data, on_frame: Callable[[int, memoryview], None]) -> int:
+        """Xử lý `data`, trả về số khung hợp lệ tìm được."""
+        buf = self._buffer
+        buf += data
+        size = len(buf)
+        pos = 0
+        found = 0
+        view = memoryview(buf)
+        try:
+            while True:
+                start = buf.find(PREAMBLE, pos)
+                if start < 0:
+                    self.bytes_discarded += size - pos
+                    pos = size
+                    break
+                self.bytes_discarded += start - pos
+                pos = start
+                if start + HEADER_LEN > size:
+                    break
+                if buf[start + 1] & 0xFC:
+                    # 6 bit reserved khác 0: D3 này là dữ liệu, không phải preamble
+                    self.bytes_discarded += 1
+                    pos = start + 1
+                    continue
+                body_end = start + HEADER_LEN + (((buf[start + 1] & 0x03) << 8) | buf[start + 2])
+                end = body_end + CRC_LEN
+                if end > size:
+                    break  # chờ phần còn lại của khung
+                if crc24q(view[start:body_end]) != int.from_bytes(view[body_end:end], "big"):
+                    self.crc_errors += 1
+                    self.bytes_discarded += 1
+                    pos = start + 1
+                    continue
+                payload = view[start + HEADER_LEN:body_end]
+                try:
+                    on_frame(message_type(payload), payload)
+                finally:
+                    payload.release()
+                found += 1
+                pos = end
+        finally:
+            view.release()
+
+        if pos:
+            del buf[:pos]
+        if len(buf) > MAX_BUFFER:
+            # Không tìm được khung trong chừng này byte: chỉ giữ phần đuôi có thể là khung dở
+            self.bytes_discarded += len(buf) - MAX_FRAME
+            del buf[:-MAX_FRAME]
+        self.frames += found
+        return found
+
+
+class _TypeRate:
+    __slots__ = ("count", "first_seen", "last_seen", "window_start", "window_count", "rate")
+
+    def __init__(self, now: float):
+        self.count = 0
+        self.first_seen = self.last_seen = self.window_start = now
+        self.window_count = 0
+        self.rate: Optional[float] = None
+
+    def hit(self, now: float):
+        self.count += 1
+        self.last_seen = now
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW_SECONDS:
+            self.rate = (self.count - self.window_count) / elapsed
+            self.window_start = now
+            self.window_count = self.count
+
+    def current_rate(self, now: float) -> float:
+        elapsed = now - self.window_start
+        if self.rate is None:
+            # Chưa đủ một cửa sổ: ước lượng từ lúc bắt đầu thấy loại tin này
+            span = self.last_seen - self.first_seen
+            return (self.count - 1) / span if span > 0 else 0.0
+        if now - self.last_seen > max(3 / self.rate if self.rate else 0, RATE_WINDOW_SECONDS):
+            return 0.0  # trạm đã ngừng gửi loại tin này
+        if elapsed >= RATE_WINDOW_SECONDS:
+            return (self.count - self.window_count) / elapsed
+        return self.rate
+
+
+class RtcmStation:
+    """Trạng thái RTCM của một trạm: framer, tần suất từng loại tin, tọa độ ARP, header MSM gần nhất."""
+
+    __slots__ = ("serial", "framer", "types", "station_id", "arp", "msm", "decode_errors", "bytes", "last_seen")
+
+    def __init__(self, serial: str):
+        self.serial = serial
+        self.framer = RtcmFramer()
+        self.types: Dict[int, _TypeRate] = {}
+        self.station_id: Optional[int] = None
+        self.arp: Optional[dict] = None
+        self.msm: Dict[str, dict] = {}
+        self.decode_errors = 0
+        self.bytes = 0
+        self.last_seen = 0.0
+
+    def status(self, now: float) -> dict:
+        return {
+            "serial": self.serial,
+            "station_id": self.station_id,
+            "last_seen_seconds_ago": round(now - self.last_seen, 1),
+            "bytes": self.bytes,
+            "frames": self.framer.frames,
+            "crc_errors": self.framer.crc_errors,
+            "decode_errors": self.decode_errors,
+            "bytes_discarded": self.framer.bytes_discarded,
+            "messages": {
+                str(msg_type): {
+                    "count": rate.count,
+                    "rate_hz": round(rate.current_rate(now), 3),
+                    "last_seen_seconds_ago": round(now - rate.last_seen, 1),
+                }
+                for msg_type, rate in sorted(self.types.items())
+            },
+            "base_position": self.arp,
+            "msm": self.msm,
+        }
+
+
+class RtcmMonitor:
+    """Giữ RtcmStation cho từng serial; gọi từ event loop nên không cần khóa."""
+
+    def __init__(self):
+        self.stations: Dict[str, RtcmStation] = {}
+        # Đếm khung trong lần feed hiện tại để cập nhật metrics một lần mỗi tin MQTT
+        self._frame_counts: Dict[int, int] = {}
+        self._station: Optional[RtcmStation] = None
+        self._now = 0.0
+
+    def feed(self, serial: str, data, now: Optional[float] = None) -> int:
+        """Đưa một đoạn raw_data nhị phân của `serial` vào framer, trả về số khung hợp lệ."""
+        station = self.stations.get(serial)
+        if station is None:
+            station = self.stations[serial] = RtcmStation(serial)
+        self._now = time.monotonic() if now is None else now
+        self._station = station
+        crc_errors = station.framer.crc_errors
+        try:
+            found = station.framer.feed(data, self._on_frame)
+        finally:
+            self._station = None
+        station.bytes += len(data)
+        station.last_seen = self._now
+
+        for msg_type, count in self._frame_counts.items():
+            RTCM_FRAMES.labels(str(msg_type) if 1001 <= msg_type <= 1300 else "other").inc(count)
+        self._frame_counts.clear()
+        if station.framer.crc_errors != crc_errors:
+            RTCM_CRC_ERRORS.inc(station.framer.crc_errors - crc_errors)
+        return found
+
+    def _on_frame(self, msg_type: int, payload: memoryview):
+        station = self._station
+        now = self._now
+        rate = station.types.get(msg_type)
+        if rate is None:
+            rate = station.types[msg_type] = _TypeRate(now)
+        rate.hit(now)
+        self._frame_counts[msg_type] = self._frame_counts.get(msg_type, 0) + 1
+
+        try:
+            if msg_type == 1005 or msg_type == 1006:
+                station.arp = decode_station_arp(payload)
+                station.station_id = station.arp["station_id"]
+            elif is_msm(msg_type):
+                header = decode_msm_header(payload)
+                station.msm[header["constellation"]] = header
+                station.station_id = header["station_id"]
+        except RtcmDecodeError:
+            station.decode_errors += 1
+
+    def pending(self, serial: str) -> int:
+        """Số byte của khung còn dở trong framer của `serial` (0 nếu chưa có)."""
+        station = self.stations.get(serial)
+        return station.framer.pending if station else 0
+
+    def discard_pending(self, serial: str) -> int:
+        """Bỏ khung còn dở trong framer của `serial`, trả về số byte đã bỏ."""
+        station = self.stations.get(serial)
+        return station.framer.discard() if station else 0
+
+    def status(self, serial: str) -> Optional[dict]:
+        station = self.stations.get(serial)
+        return station.status(time.monotonic()) if station else None
+
+    def report(self) -> list[dict]:
+        now = time.monotonic()
+        return [station.status(now) for _, station in sorted(self.stations.items())]
+
+
+rtcm_monitor = RtcmMonitor()
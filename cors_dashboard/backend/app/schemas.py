@@ -24,6 +24,12 @@ class Device(DeviceBase):
     ntrip_status: dict | None = Field(default_factory=dict)
     is_locked: bool | None = False
 
+class DeviceConfigHistoryEntry(BaseModel):
+    kind: str
+    config_hash: str | None = None
+    changed_at: int
+    content: dict = Field(default_factory=dict)
+
 class Command(BaseModel):
     command: str
     payload: dict[str, Any] = Field(default_factory=dict)
@@ -97,15 +103,54 @@ class UserUpdate(BaseModel):
             raise ValueError('Mật khẩu phải có ít nhất 6 ký tự')
         return v
 
+class DeviceConflict(BaseModel):
+    serial: str
+    user_id: int | None = None
+
+class DeviceAssignmentResult(BaseModel):
+    assigned: list[str] = []
+    conflicts: list[DeviceConflict] = []
+    not_found: list[str] = []
+
 class UserResponse(UserBase):
     id: int
     is_active: bool
     created_at: int
     permissions: list[str] = []
-    
+    device_assignment: DeviceAssignmentResult | None = None
+
+    class Config:
+        from_attributes = True
+
+class DeviceSummary(BaseModel):
+    serial: str
+    name: str | None = None
+    status: str | None = "offline"
+    ntrip_connected: bool | None = False
+
     class Config:
         from_attributes = True
 
+class UserWithDevices(UserResponse):
+    device_count: int = 0
+    online_count: int = 0
+    devices: list[DeviceSummary] = []
+
+class UserImportRowResult(BaseModel):
+    row: int
+    username: str | None = None
+    status: str  # created | updated | error
+    detail: str | None = None
+    user_id: int | None = None
+    device_assignment: DeviceAssignmentResult | None = None
+
+class UserImportReport(BaseModel):
+    total_rows: int
+    created: int
+    updated: int
+    failed: int
+    results: list[UserImportRowResult]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
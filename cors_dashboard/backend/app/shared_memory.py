@@ -0,0 +1,64 @@
+# ==============================================================================
+# == backend/app/shared_memory.py - Trạng thái dùng chung giữa các worker    ==
+# ==============================================================================
+#
+# Uvicorn chạy nhiều worker (process) trên cùng một máy. Các đối tượng ở đây
+# được map từ file trong SHARED_STATE_DIR bằng mmap, nên mọi worker đọc/ghi
+# cùng một vùng nhớ mà không cần thêm dịch vụ ngoài (Redis...).
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from .database import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _default_shared_dir() -> str:
+    # Tách theo DATABASE_URL để hai bản cài đặt trên cùng máy không dùng chung trạng thái
+    suffix = hashlib.sha1(settings.DATABASE_URL.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(tempfile.gettempdir(), f"cors_dashboard-{suffix}")
+
+
+SHARED_STATE_DIR = settings.SHARED_STATE_DIR or _default_shared_dir()
+
+
+def open_shared_file(name: str, size: int) -> mmap.mmap:
+    """Mở (hoặc tạo) file `name` kích thước `size` byte và map vào bộ nhớ."""
+    os.makedirs(SHARED_STATE_DIR, exist_ok=True)
+    path = os.path.join(SHARED_STATE_DIR, name)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+class SharedEpoch:
+    """
+    Một giá trị 8 byte dùng chung giữa các worker.
+    Worker nào thay đổi dữ liệu thì gọi bump(); các worker khác so sánh read()
+    với giá trị đã thấy lần trước để biết cache của mình đã cũ.
+    """
+
+    _FORMAT = "<Q"
+
+    def __init__(self, name: str):
+        self.name = name
+        self._mm = open_shared_file(f"{name}.epoch", struct.calcsize(self._FORMAT))
+
+    def read(self) -> int:
+        return struct.unpack_from(self._FORMAT, self._mm, 0)[0]
+
+    def bump(self) -> int:
+        # Dùng time_ns thay vì tăng dần: hai worker bump cùng lúc vẫn tạo giá trị mới
+        value = time.time_ns()
+        struct.pack_into(self._FORMAT, self._mm, 0, value)
+        return value
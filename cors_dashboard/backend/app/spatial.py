@@ -0,0 +1,291 @@
+# ==============================================================================
+# == backend/app/spatial.py - Chỉ mục không gian các trạm (lưới lat/lon)     ==
+# ==============================================================================
+#
+# Bảng devices không có cột tọa độ, nên câu hỏi "trạm online nào gần rover nhất"
+# trước đây phải tải mọi trạm về trình duyệt. Module này giữ trong RAM vị trí
+# từng trạm (tọa độ FIXED_LLA trong base_config, nếu không có thì fix GGA mới
+# nhất) trong một lưới ô lat/lon, cập nhật từng trạm khi vị trí/trạng thái đổi.
+#
+# Truy vấn k trạm gần nhất duyệt các vành ô quanh điểm hỏi, dừng khi khoảng cách
+# tới phần chưa duyệt lớn hơn ứng viên thứ k. Khoảng cách là góc tâm trên mặt cầu
+# (đủ để xếp hạng trạm), so sánh bằng bình phương dây cung của vector đơn vị.
+
+import heapq
+import math
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from .database import settings
+from .drift import fixed_reference
+
+EARTH_RADIUS_M = 6371008.8
+# Cùng ngưỡng với heartbeat checker: trạm "online" không báo status quá lâu được coi là offline
+STATUS_TIMEOUT_SECONDS = 180
+
+
+def _unit_vector(lat: float, lon: float) -> tuple[float, float, float]:
+    phi = math.radians(lat)
+    lam = math.radians(lon)
+    cos_phi = math.cos(phi)
+    return cos_phi * math.cos(lam), cos_phi * math.sin(lam), math.sin(phi)
+
+
+def _chord2_to_meters(chord2: float) -> float:
+    return 2 * math.asin(min(math.sqrt(chord2) / 2, 1.0)) * EARTH_RADIUS_M
+
+
+class IndexedStation:
+    __slots__ = ("serial", "name", "lat", "lon", "vector", "source", "status", "status_time",
+                 "ntrip_connected", "cell")
+
+    def __init__(self, serial: str):
+        self.serial = serial
+        self.name: Optional[str] = None
+        self.lat: Optional[float] = None
+        self.lon: Optional[float] = None
+        self.vector = (0.0, 0.0, 0.0)
+        self.source: Optional[str] = None  # "fixed" (base_config) hoặc "fix" (GGA)
+        self.status = "offline"
+        self.status_time = 0.0
+        self.ntrip_connected = False
+        self.cell: Optional[tuple[int, int]] = None
+
+    def effective_status(self, now: float) -> str:
+        if self.status == "online" and now - self.status_time > STATUS_TIMEOUT_SECONDS:
+            return "offline"
+        return self.status
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "serial": self.serial,
+            "name": self.name,
+            "lat": self.lat,
+            "lon": self.lon,
+            "position_source": self.source,
+            "status": self.effective_status(now),
+            "ntrip_connected": self.ntrip_connected,
+        }
+
+
+class StationIndex:
+    """Lưới ô `cell_degrees` độ; mỗi ô là dict serial -> IndexedStation. Chỉ dùng từ event loop."""
+
+    def __init__(self, cell_degrees: float):
+        self.cell_degrees = cell_degrees
+        self.rows = math.ceil(180 / cell_degrees)
+        self.cols = math.ceil(360 / cell_degrees)
+        self.stations: Dict[str, IndexedStation] = {}
+        self.cells: Dict[tuple[int, int], Dict[str, IndexedStation]] = {}
+        # callback(station, removed) sau mỗi thay đổi vị trí/trạng thái (vd. cụm bản đồ)
+        self._subscribers: list[Callable[[IndexedStation, bool], None]] = []
+
+    def subscribe(self, callback: Callable[[IndexedStation, bool], None]):
+        self._subscribers.append(callback)
+
+    def _notify(self, station: IndexedStation, removed: bool = False):
+        for callback in self._subscribers:
+            callback(station, removed)
+
+    def _cell_of(self, lat: float, lon: float) -> tuple[int, int]:
+        row = min(int((lat + 90) / self.cell_degrees), self.rows - 1)
+        col = int(((lon + 180) % 360) / self.cell_degrees) % self.cols
+        return row, col
+
+    def _station(self, serial: str) -> IndexedStation:
+        station = self.stations.get(serial)
+        if station is None:
+            station = self.stations[serial] = IndexedStation(serial)
+        return station
+
+    def _move(self, station: IndexedStation, lat: float, lon: float, source: str):
+        station.lat = lat
+        station.lon = lon
+        station.source = source
+        station.vector = _unit_vector(lat, lon)
+        cell = self._cell_of(lat, lon)
+        if cell != station.cell:
+            if station.cell is not None:
+                bucket = self.cells[station.cell]
+                del bucket[station.serial]
+                if not bucket:
+                    del self.cells[station.cell]
+            self.cells.setdefault(cell, {})[station.serial] = station
+            station.cell = cell
+
+    # --- Cập nhật ---
+
+    def update_device(self, device, now: Optional[float] = None):
+        """Cập nhật từ bản ghi Device (sau upsert status, lúc khởi động...)."""
+        station = self._station(device.serial)
+        station.name = device.name
+        station.ntrip_connected = bool(device.ntrip_connected)
+        station.status = device.status or "offline"
+        station.status_time = time.time() if now is None else now
+        reference = fixed_reference(device.base_config)
+        if reference is not None:
+            self._move(station, reference[0], reference[1], "fixed")
+        elif station.source == "fixed":
+            # Không còn FIXED_LLA: giữ vị trí cũ cho tới khi có fix GGA mới
+            station.source = "fix"
+        self._notify(station)
+
+    def set_status(self, serial: str, status: str, now: Optional[float] = None):
+        station = self._station(serial)
+        station.status = status
+        station.status_time = time.time() if now is None else now
+        self._notify(station)
+
+    def update_fix(self, serial: str, gga: dict):
+        """Vị trí từ GGA, chỉ dùng khi trạm chưa có tọa độ FIXED_LLA."""
+        lat = gga.get("latitude")
+        lon = gga.get("longitude")
+        if lat is None or lon is None or not gga.get("fix_quality"):
+            return
+        station = self._station(serial)
+        if station.source == "fixed" or (station.lat == lat and station.lon == lon):
+            return
+        self._move(station, lat, lon, "fix")
+        self._notify(station)
+
+    def remove(self, serial: str):
+        station = self.stations.pop(serial, None)
+        if station is not None and station.cell is not None:
+            bucket = self.cells[station.cell]
+            del bucket[serial]
+            if not bucket:
+                del self.cells[station.cell]
+        if station is not None:
+            self._notify(station, removed=True)
+
+    # --- Truy vấn ---
+
+    def _outside_bound(self, lat: float, lon: float, row: int, col: int, r: int) -> float:
+        """Góc tâm (rad) nhỏ nhất từ điểm hỏi tới mọi điểm ngoài khối ô đã duyệt (bán kính r ô)."""
+        cell = self.cell_degrees
+        bound = math.inf
+        if row - r > 0:
+            bound = min(bound, lat - (-90 + (row - r) * cell))
+        if row + r + 1 < self.rows:
+            bound = min(bound, -90 + (row + r + 1) * cell - lat)
+        bound = math.radians(bound) if bound != math.inf else math.inf
+        if 2 * r + 1 < self.cols:
+            lon_offset = (lon + 180) % 360
+            west = lon_offset - (col - r) * cell
+            east = (col + r + 1) * cell - lon_offset
+            dl = math.radians(min(west, east, 90.0))
+            # Khoảng cách tới kinh tuyến biên: asin(cos(lat) * sin(dl))
+            bound = min(bound, math.asin(min(math.cos(math.radians(lat)) * math.sin(dl), 1.0)))
+        return bound
+
+    def _ring(self, row: int, col: int, r: int) -> Iterable[tuple[int, int]]:
+        if r == 0:
+            yield row, col
+            return
+        seen = set()
+        for i in range(max(row - r, 0), min(row + r, self.rows - 1) + 1):
+            if abs(i - row) == r:
+                columns = range(col - r, col + r + 1)
+            else:
+                columns = (col - r, col + r)
+            for j in columns:
+                key = (i, j % self.cols)
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def nearest(self, lat: float, lon: float, k: int = 1,
+                predicate: Optional[Callable[[IndexedStation], bool]] = None,
+                max_distance: Optional[float] = None) -> list[tuple[float, IndexedStation]]:
+        """k trạm gần nhất thỏa `predicate`, dạng (khoảng cách m, trạm), gần nhất trước."""
+        qx, qy, qz = _unit_vector(lat, lon)
+        row, col = self._cell_of(lat, lon)
+        max_chord2 = (2 * math.sin(min(max_distance / EARTH_RADIUS_M, math.pi) / 2)) ** 2 if max_distance else math.inf
+        heap: list[tuple[float, str, IndexedStation]] = []  # max-heap theo -chord2
+        worst = max_chord2  # ứng viên phải gần hơn mức này (thứ k hiện tại hoặc max_distance)
+
+        def scan(bucket: Dict[str, IndexedStation]):
+            nonlocal worst
+            for station in bucket.values():
+                x, y, z = station.vector
+                chord2 = (x - qx) * (x - qx) + (y - qy) * (y - qy) + (z - qz) * (z - qz)
+                if chord2 >= worst or (predicate is not None and not predicate(station)):
+                    continue
+                if len(heap) < k:
+                    heapq.heappush(heap, (-chord2, station.serial, station))
+                    if len(heap) == k:
+                        worst = min(-heap[0][0], max_chord2)
+                else:
+                    heapq.heapreplace(heap, (-chord2, station.serial, station))
+                    worst = -heap[0][0]
+
+        cells = self.cells
+        r = 0
+        visited: set[tuple[int, int]] = set()
+        max_r = max(self.rows, self.cols)
+        while r <= max_r:
+            if len(visited) > len(cells):
+                # Đã duyệt nhiều ô hơn số ô có trạm (bộ lọc khắt khe, trạm thưa): quét thẳng các ô còn lại
+                for key, bucket in cells.items():
+                    if key not in visited:
+                        scan(bucket)
+                break
+            for key in self._ring(row, col, r):
+                if key in visited:
+                    continue  # vành lớn hơn cả vòng kinh độ quay lại ô đã duyệt
+                visited.add(key)
+                bucket = cells.get(key)
+                if bucket:
+                    scan(bucket)
+            bound = self._outside_bound(lat, lon, row, col, r)
+            if bound == math.inf or (2 * math.sin(min(bound, math.pi) / 2)) ** 2 >= worst:
+                break
+            r += 1
+
+        return [(_chord2_to_meters(-neg), station) for neg, _, station in sorted(heap, reverse=True)]
+
+    def within(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+               predicate: Optional[Callable[[IndexedStation], bool]] = None) -> list[IndexedStation]:
+        """Trạm trong khung [min_lat, max_lat] x [min_lon, max_lon]; min_lon > max_lon nghĩa là vắt qua kinh tuyến 180."""
+        wraps = min_lon > max_lon
+
+        def inside(station: IndexedStation) -> bool:
+            if not (min_lat <= station.lat <= max_lat):
+                return False
+            if wraps:
+                return station.lon >= min_lon or station.lon <= max_lon
+            return min_lon <= station.lon <= max_lon
+
+        row_lo, col_lo = self._cell_of(min_lat, min_lon)
+        row_hi, col_hi = self._cell_of(max_lat, max_lon)
+        if not wraps and max_lon >= 180:
+            # Kinh tuyến 180 là cạnh đông: quét tới cột cuối rồi thêm cột 0, nơi _cell_of đặt trạm có lon = 180
+            col_span = self.cols - col_lo + 1 if col_lo else self.cols
+        else:
+            col_span = (col_hi - col_lo) % self.cols + 1
+            if wraps and col_span == 1:
+                col_span = self.cols  # khung gần như cả vòng kinh độ
+        if (row_hi - row_lo + 1) * col_span > len(self.cells):
+            keys = [key for key in self.cells if row_lo <= key[0] <= row_hi]
+        else:
+            keys = [(i, (col_lo + dj) % self.cols) for i in range(row_lo, row_hi + 1) for dj in range(col_span)]
+
+        result = []
+        for key in keys:
+            bucket = self.cells.get(key)
+            if bucket:
+                for station in bucket.values():
+                    if inside(station) and (predicate is None or predicate(station)):
+                        result.append(station)
+        return result
+
+    def status(self) -> dict:
+        return {
+            "stations": len(self.stations),
+            "positioned": sum(1 for station in self.stations.values() if station.cell is not None),
+            "occupied_cells": len(self.cells),
+            "cell_degrees": self.cell_degrees,
+        }
+
+
+station_index = StationIndex(settings.SPATIAL_CELL_DEGREES)
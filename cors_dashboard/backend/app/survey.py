@@ -0,0 +1,251 @@
+# ==============================================================================
+# == backend/app/survey.py - Ước lượng tọa độ base từ luồng GGA (survey-in)  ==
+# ==============================================================================
+#
+# Thay vì chạy SURVEY_IN mù trên chip hoặc tự tính tọa độ FIXED_LLA ở nơi khác,
+# server cộng dồn các fix GGA của từng trạm theo thuật toán Welford (trung bình
+# và hiệp phương sai trong ECEF, bộ nhớ O(1) mỗi trạm) và đề xuất tọa độ cố định
+# có thể đẩy xuống chip qua command_builder.
+#
+# Lọc theo chất lượng fix: khi xuất hiện loại fix tốt hơn (vd. RTK fixed sau khi
+# chỉ có GPS đơn), bộ ước lượng bắt đầu lại và chỉ nhận loại fix đó trở lên.
+# Chỉ coi là hội tụ khi hạng fix đạt SURVEY_MIN_FIX_RANK (mặc định RTK fixed).
+#
+# Fix GGA 1 Hz tương quan mạnh theo thời gian (multipath, khí quyển), nên std/√n
+# đánh giá quá cao độ chính xác. Độ chính xác lấy theo phương pháp batch means:
+# trung bình của từng khối SURVEY_CHECKPOINT_SECONDS giây được coi là một mẫu,
+# sai số chuẩn = độ phân tán các trung bình khối / √(số khối).
+
+import math
+import time
+from typing import Dict, Optional
+
+from .database import settings
+from .geodesy import ecef_to_lla, enu_rotation, lla_to_ecef
+
+# Thứ hạng chất lượng theo fix quality của GGA; 0 (invalid) và 6 (estimated) không được dùng
+FIX_RANK = {1: 1, 2: 2, 3: 2, 5: 3, 4: 4}
+RANK_RTK_FIXED = 4
+
+
+class SurveyEstimator:
+    """Trung bình/hiệp phương sai ECEF (Welford) của các fix được chấp nhận cho một trạm."""
+
+    __slots__ = (
+        "rank", "n", "mean", "m2", "geoid_sum", "started", "last_update", "rejected",
+        "checkpoint", "drift_per_minute", "accuracy_trend_per_minute",
+        "block_n", "block_sum", "batches", "batch_mean", "batch_m2",
+    )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, rank: int = 0):
+        self.rank = rank
+        self.n = 0
+        self.mean = [0.0, 0.0, 0.0]
+        # Tổng tích độ lệch: xx, xy, xz, yy, yz, zz
+        self.m2 = [0.0] * 6
+        self.geoid_sum = 0.0
+        self.started: Optional[float] = None
+        self.last_update: Optional[float] = None
+        self.rejected = 0
+        # (thời điểm, trung bình, mean_accuracy) lần chốt gần nhất để tính tốc độ hội tụ
+        self.checkpoint: Optional[tuple] = None
+        self.drift_per_minute: Optional[float] = None
+        self.accuracy_trend_per_minute: Optional[float] = None
+        # Khối đang gom (tổng ECEF) và Welford trên trung bình các khối đã đóng (m2 là tổng bình phương 3D)
+        self.block_n = 0
+        self.block_sum = [0.0, 0.0, 0.0]
+        self.batches = 0
+        self.batch_mean = [0.0, 0.0, 0.0]
+        self.batch_m2 = 0.0
+
+    def add(self, gga: dict, now: float, max_hdop: float, checkpoint_seconds: float) -> bool:
+        """Cộng một fix GGA; trả về False nếu fix bị loại."""
+        rank = FIX_RANK.get(gga.get("fix_quality"), 0)
+        lat = gga.get("latitude")
+        lon = gga.get("longitude")
+        alt = gga.get("altitude")
+        if not rank or lat is None or lon is None or alt is None or (gga.get("hdop") or 99.99) > max_hdop:
+            self.rejected += 1
+            return False
+        if rank < self.rank:
+            self.rejected += 1
+            return False
+        if rank > self.rank:
+            self.reset(rank)
+
+        geoid = gga.get("geoid_separation") or 0.0
+        x, y, z = lla_to_ecef(lat, lon, alt + geoid)
+        self.n += 1
+        mean = self.mean
+        dx, dy, dz = x - mean[0], y - mean[1], z - mean[2]
+        mean[0] += dx / self.n
+        mean[1] += dy / self.n
+        mean[2] += dz / self.n
+        ex, ey, ez = x - mean[0], y - mean[1], z - mean[2]
+        m2 = self.m2
+        m2[0] += dx * ex
+        m2[1] += dx * ey
+        m2[2] += dx * ez
+        m2[3] += dy * ey
+        m2[4] += dy * ez
+        m2[5] += dz * ez
+        self.geoid_sum += geoid
+        self.block_n += 1
+        self.block_sum[0] += x
+        self.block_sum[1] += y
+        self.block_sum[2] += z
+
+        if self.started is None:
+            self.started = now
+        self.last_update = now
+        if self.checkpoint is None:
+            self.checkpoint = (now, tuple(mean), None)
+        elif now - self.checkpoint[0] >= checkpoint_seconds:
+            self._close_block()
+            self._update_convergence(now)
+        return True
+
+    def _close_block(self):
+        block = [value / self.block_n for value in self.block_sum]
+        self.batches += 1
+        mean = self.batch_mean
+        delta = [b - m for b, m in zip(block, mean)]
+        for i in range(3):
+            mean[i] += delta[i] / self.batches
+        self.batch_m2 += sum(d * (b - m) for d, b, m in zip(delta, block, mean))
+        self.block_n = 0
+        self.block_sum = [0.0, 0.0, 0.0]
+
+    def covariance(self) -> list[float]:
+        """Hiệp phương sai mẫu ECEF (xx, xy, xz, yy, yz, zz), m^2."""
+        if self.n < 2:
+            return [0.0] * 6
+        return [value / (self.n - 1) for value in self.m2]
+
+    def std_3d(self) -> float:
+        """Độ lệch chuẩn 3D của các fix: sqrt(trace(C))."""
+        c = self.covariance()
+        return math.sqrt(max(c[0] + c[3] + c[5], 0.0))
+
+    def batch_std(self) -> Optional[float]:
+        """Độ lệch chuẩn 3D giữa trung bình các khối (chưa chia √số khối)."""
+        return math.sqrt(self.batch_m2 / (self.batches - 1)) if self.batches >= 2 else None
+
+    def mean_accuracy(self) -> Optional[float]:
+        """Sai số chuẩn 3D của vị trí trung bình theo batch means: batch_std / √(số khối)."""
+        std = self.batch_std()
+        return std / math.sqrt(self.batches) if std is not None else None
+
+    def _update_convergence(self, now: float):
+        then, old_mean, old_accuracy = self.checkpoint
+        minutes = (now - then) / 60
+        accuracy = self.mean_accuracy()
+        self.drift_per_minute = math.dist(self.mean, old_mean) / minutes
+        if old_accuracy is not None and accuracy is not None:
+            self.accuracy_trend_per_minute = (accuracy - old_accuracy) / minutes
+        self.checkpoint = (now, tuple(self.mean), accuracy)
+
+    def enu_std(self, lat: float, lon: float) -> tuple[float, float, float]:
+        """Độ lệch chuẩn theo East/North/Up: xoay hiệp phương sai ECEF về ENU tại vị trí trung bình."""
+        xx, xy, xz, yy, yz, zz = self.covariance()
+        cov = ((xx, xy, xz), (xy, yy, yz), (xz, yz, zz))
+        result = []
+        for row in enu_rotation(lat, lon):
+            # r^T C r
+            variance = sum(row[i] * cov[i][j] * row[j] for i in range(3) for j in range(3))
+            result.append(math.sqrt(max(variance, 0.0)))
+        return tuple(result)
+
+    def report(self, now: float, target_accuracy: float, min_samples: int,
+               min_fix_rank: int = RANK_RTK_FIXED, min_batches: int = 2) -> dict:
+        result = {
+            "samples": self.n,
+            "batches": self.batches,
+            "rejected": self.rejected,
+            "fix_rank": self.rank,
+            "min_fix_rank": min_fix_rank,
+            "fix_rank_ok": self.rank >= min_fix_rank,
+            "duration_seconds": round(now - self.started, 1) if self.started is not None else 0.0,
+            "last_update_seconds_ago": round(now - self.last_update, 1) if self.last_update is not None else None,
+        }
+        if self.n == 0:
+            result.update(converged=False, recommended=None)
+            return result
+
+        lat, lon, height = ecef_to_lla(*self.mean)
+        east, north, up = self.enu_std(lat, lon)
+        accuracy = self.mean_accuracy()
+        batch_std = self.batch_std()
+        converged = (
+            self.rank >= min_fix_rank and self.n >= min_samples and self.batches >= max(min_batches, 2)
+            and accuracy is not None and accuracy <= target_accuracy
+            and self.drift_per_minute is not None and self.drift_per_minute <= target_accuracy
+        )
+        result.update({
+            "mean_ecef": [round(v, 4) for v in self.mean],
+            "std_3d": round(self.std_3d(), 4),
+            "std_enu": {"east": round(east, 4), "north": round(north, 4), "up": round(up, 4)},
+            "mean_accuracy": round(accuracy, 4) if accuracy is not None else None,
+            "batch_std": round(batch_std, 4) if batch_std is not None else None,
+            # Trung bình dịch chuyển bao nhiêu mét/phút và mean_accuracy giảm bao nhiêu mét/phút
+            "drift_m_per_min": round(self.drift_per_minute, 5) if self.drift_per_minute is not None else None,
+            "accuracy_trend_m_per_min": (
+                round(self.accuracy_trend_per_minute, 5) if self.accuracy_trend_per_minute is not None else None
+            ),
+            "target_accuracy": target_accuracy,
+            "converged": converged,
+            "recommended": {
+                "lat": round(lat, 9),
+                "lon": round(lon, 9),
+                # Cao độ ellipsoid (dùng cho FIXED_LLA) và cao độ MSL tương ứng
+                "alt": round(height, 4),
+                "alt_msl": round(height - self.geoid_sum / self.n, 4),
+                # Độ chính xác gửi xuống chip (fixedPosAcc): độ phân tán giữa các khối, không chia √số khối
+                # vì các khối vẫn tương quan với nhau; chưa đủ khối thì dùng std_3d của các fix
+                "accuracy": round(max(batch_std if batch_std is not None else self.std_3d(), 0.001), 4),
+            },
+        })
+        return result
+
+
+class SurveyMonitor:
+    """Một SurveyEstimator cho mỗi serial, cập nhật từ các GGA nhận được (MQTT và WebSocket)."""
+
+    def __init__(self, max_hdop: float, checkpoint_seconds: float, min_samples: int, target_accuracy: float,
+                 min_fix_rank: int = RANK_RTK_FIXED, min_batches: int = 2):
+        self.max_hdop = max_hdop
+        self.checkpoint_seconds = checkpoint_seconds
+        self.min_samples = min_samples
+        self.target_accuracy = target_accuracy
+        self.min_fix_rank = min_fix_rank
+        self.min_batches = min_batches
+        self.estimators: Dict[str, SurveyEstimator] = {}
+
+    def record_gga(self, serial: str, gga: dict, now: Optional[float] = None):
+        estimator = self.estimators.get(serial)
+        if estimator is None:
+            estimator = self.estimators[serial] = SurveyEstimator()
+        estimator.add(gga, time.time() if now is None else now, self.max_hdop, self.checkpoint_seconds)
+
+    def report(self, serial: str, target_accuracy: Optional[float] = None) -> Optional[dict]:
+        estimator = self.estimators.get(serial)
+        if estimator is None:
+            return None
+        result = estimator.report(
+            time.time(), target_accuracy or self.target_accuracy, self.min_samples, self.min_fix_rank, self.min_batches
+        )
+        result["serial"] = serial
+        return result
+
+    def reset(self, serial: str) -> bool:
+        return self.estimators.pop(serial, None) is not None
+
+
+survey_monitor = SurveyMonitor(
+    settings.SURVEY_MAX_HDOP, settings.SURVEY_CHECKPOINT_SECONDS,
+    settings.SURVEY_MIN_SAMPLES, settings.SURVEY_TARGET_ACCURACY_M,
+    settings.SURVEY_MIN_FIX_RANK, settings.SURVEY_MIN_BATCHES,
+)
@@ -0,0 +1,152 @@
+# ==============================================================================
+# == backend/app/tracing.py - Đo độ trễ từng chặng của dữ liệu từ trạm -> UI ==
+# ==============================================================================
+#
+# Mỗi tin nhắn status/NMEA/config đi vào (qua MQTT hoặc WebSocket của Pi) mang
+# một IngestTrace ghi lại các mốc:
+#   device_ts (thời điểm trạm tạo dữ liệu) -> received (paho/WS nhận)
+#   -> dequeued (event loop bắt đầu xử lý) -> db_committed -> broadcast_sent
+# Độ trễ từng chặng được đưa vào sketch phân vị (cửa sổ 1m/5m/1h) và histogram
+# Prometheus; một phần nhỏ trace được ghi log đầy đủ để xem từng tin cụ thể.
+
+import json
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Dict
+
+from .database import settings
+from .metrics import Histogram
+from .monitoring import WindowedQuantiles, health_monitor
+
+trace_logger = logging.getLogger("app.trace")
+
+INGEST_STAGE_DURATION = Histogram(
+    "ingest_stage_duration_seconds", "Độ trễ từng chặng của dữ liệu trạm từ lúc tạo đến lúc gửi UI",
+    ("kind", "stage"),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+
+# station: trạm -> backend (gồm broker, phụ thuộc đồng bộ đồng hồ của trạm)
+# queue: thread paho -> event loop; db: ghi DB + commit; broadcast: gửi UI; total: nhận -> gửi UI xong
+STAGES = ("station", "queue", "db", "broadcast", "total")
+BROWSER_STAGES = ("browser_render", "browser_delivery")
+
+
+def gga_epoch(timestamp_utc: str | None, now: float | None = None) -> float | None:
+    """Đổi giờ UTC trong câu GGA (hhmmss.ss) thành epoch, chọn ngày gần `now` nhất."""
+    if not timestamp_utc or len(timestamp_utc) < 6:
+        return None
+    try:
+        seconds_of_day = int(timestamp_utc[0:2]) * 3600 + int(timestamp_utc[2:4]) * 60 + float(timestamp_utc[4:])
+    except ValueError:
+        return None
+    now = time.time() if now is None else now
+    midnight = datetime.fromtimestamp(now, timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    candidate = midnight + seconds_of_day
+    # Qua nửa đêm UTC: câu 23:59:59 đến lúc 00:00:01
+    if candidate - now > 43200:
+        candidate -= 86400
+    elif now - candidate > 43200:
+        candidate += 86400
+    return candidate
+
+
+class IngestTrace:
+    """Các mốc thời gian của một tin nhắn. Mốc nội bộ dùng perf_counter, device_ts dùng epoch."""
+
+    __slots__ = ("kind", "serial", "source", "device_ts", "received_wall",
+                 "received", "dequeued", "db_committed", "broadcast_sent")
+
+    def __init__(self, kind: str, serial: str, source: str, received: float | None = None):
+        self.kind = kind
+        self.serial = serial
+        self.source = source
+        self.device_ts: float | None = None
+        # Mốc nhận: perf_counter từ thread paho nếu có, đồng thời quy đổi ra epoch
+        now_perf = time.perf_counter()
+        self.received = received if received is not None else now_perf
+        self.received_wall = time.time() - (now_perf - self.received)
+        self.dequeued = now_perf
+        self.db_committed: float | None = None
+        self.broadcast_sent: float | None = None
+
+    def set_device_timestamp(self, ts: float | None):
+        if ts:
+            self.device_ts = float(ts)
+
+    def mark_db_commit(self):
+        self.db_committed = time.perf_counter()
+
+    def mark_broadcast(self):
+        self.broadcast_sent = time.perf_counter()
+
+    def stages_ms(self) -> Dict[str, float]:
+        stages = {}
+        if self.device_ts is not None:
+            # Đồng hồ trạm lệch có thể cho giá trị âm: coi như 0
+            stages["station"] = max((self.received_wall - self.device_ts) * 1000, 0.0)
+        stages["queue"] = (self.dequeued - self.received) * 1000
+        if self.db_committed is not None:
+            stages["db"] = (self.db_committed - self.dequeued) * 1000
+        if self.broadcast_sent is not None:
+            stages["broadcast"] = (self.broadcast_sent - (self.db_committed or self.dequeued)) * 1000
+            stages["total"] = (self.broadcast_sent - self.received) * 1000
+        return stages
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind, "serial": self.serial, "source": self.source,
+            "device_ts": self.device_ts, "received_ts": round(self.received_wall, 6),
+            "stages_ms": {stage: round(ms, 3) for stage, ms in self.stages_ms().items()},
+        }
+
+
+class IngestTracer:
+    """Gom độ trễ theo (kind, stage) và giữ một ít trace mẫu gần nhất."""
+
+    def __init__(self, sample_rate: float, recent: int = 200):
+        self.sample_rate = sample_rate
+        self.latency: Dict[str, WindowedQuantiles] = {}
+        self.recent = deque(maxlen=recent)
+
+    def start(self, kind: str, serial: str, source: str, received: float | None = None) -> IngestTrace:
+        return IngestTrace(kind, serial, source, received)
+
+    def _observe(self, kind: str, stage: str, ms: float):
+        key = f"{kind}.{stage}"
+        windowed = self.latency.get(key)
+        if windowed is None:
+            windowed = self.latency[key] = WindowedQuantiles()
+        windowed.observe(ms)
+        INGEST_STAGE_DURATION.labels(kind, stage).observe(ms / 1000)
+
+    def finish(self, trace: IngestTrace):
+        """Gọi sau khi broadcast xong (hoặc khi tin nhắn dừng lại không gửi UI)."""
+        stages = trace.stages_ms()
+        for stage, ms in stages.items():
+            self._observe(trace.kind, stage, ms)
+        if trace.source == "mqtt" and "total" in stages:
+            health_monitor.record_latency('mqtt_to_ui', stages["total"])
+        if self.sample_rate and random.random() < self.sample_rate:
+            record = trace.to_dict()
+            self.recent.append(record)
+            trace_logger.info(json.dumps(record, separators=(",", ":")))
+
+    def record_browser(self, render_ms: float | None, delivery_ms: float | None):
+        """
+        Độ trễ do trình duyệt báo lại (frame có server_ts):
+        render = nhận frame -> vẽ xong (đồng hồ trình duyệt);
+        delivery = server_ts -> vẽ xong (gồm mạng và độ lệch đồng hồ).
+        """
+        for stage, ms in zip(BROWSER_STAGES, (render_ms, delivery_ms)):
+            if isinstance(ms, (int, float)) and 0 <= ms <= 600_000:
+                self._observe("ui", stage, float(ms))
+
+    def summary(self, percentiles=(50, 95, 99)) -> Dict[str, Any]:
+        return {key: windowed.summary(percentiles) for key, windowed in sorted(self.latency.items())}
+
+
+ingest_tracer = IngestTracer(sample_rate=settings.INGEST_TRACE_SAMPLE_RATE)
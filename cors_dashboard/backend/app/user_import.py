@@ -0,0 +1,192 @@
+# ==============================================================================
+# == backend/app/user_import.py - Import hàng loạt user và gán trạm          ==
+# ==============================================================================
+#
+# File import (CSV hoặc JSON) được xử lý theo từng batch:
+# - Một SELECT để tìm các username đã tồn tại trong batch.
+# - Hash mật khẩu song song trong executor hash riêng (auth.password_hasher).
+# - Một INSERT nhiều dòng cho các user mới.
+# - Gán trạm bằng UPDATE ... WHERE serial IN (...) và commit một lần mỗi batch.
+# Kết quả trả về chi tiết cho từng dòng của file.
+
+import asyncio
+import csv
+import io
+import json
+import logging
+import re
+
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import auth, crud, schemas
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = 100
+MAX_IMPORT_BYTES = 5 * 1024 * 1024
+
+_SERIAL_SEPARATORS = re.compile(r"[;,|\s]+")
+
+
+def _split_serials(value) -> list[str]:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [s for s in _SERIAL_SEPARATORS.split(str(value)) if s]
+
+
+def parse_import_file(content: bytes, filename: str | None = None, content_type: str | None = None) -> list[dict]:
+    """
+    Đọc file import thành list dict.
+    JSON: một list object, hoặc {"users": [...]}.
+    CSV: header gồm username, password, role, full_name, assigned_devices
+         (các serial trong assigned_devices cách nhau bởi ';', ',' hoặc '|').
+    """
+    text = content.decode("utf-8-sig")
+    is_json = (filename or "").lower().endswith(".json") or "json" in (content_type or "")
+
+    if is_json:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get("users", [])
+        if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+            raise ValueError("JSON import phải là một danh sách các object user")
+        rows = data
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        rows = [
+            {(key or "").strip().lower(): (value.strip() if isinstance(value, str) else value) for key, value in row.items()}
+            for row in reader
+        ]
+
+    for row in rows:
+        row["assigned_devices"] = _split_serials(row.get("assigned_devices"))
+        if not row.get("full_name"):
+            row["full_name"] = None
+    return rows
+
+
+async def _apply_batch(
+    batch: list[tuple[int, dict]],
+    auth_db: AsyncSession,
+    devices_db: AsyncSession
+) -> list[schemas.UserImportRowResult]:
+    results: dict[int, schemas.UserImportRowResult] = {}
+    usernames = [str(row.get("username") or "").strip() for _, row in batch]
+    existing = await crud.get_existing_usernames(auth_db, [u for u in usernames if u])
+
+    to_create: list[tuple[int, schemas.UserCreate]] = []
+    # (row_no, user_id, role, serials) - giữ giá trị thuần để không phụ thuộc trạng thái ORM sau rollback
+    assignments: list[tuple[int, int, str, list[str]]] = []
+
+    for (row_no, row), username in zip(batch, usernames):
+        if username in existing:
+            user = existing[username]
+            serials = row["assigned_devices"]
+            if not serials:
+                results[row_no] = schemas.UserImportRowResult(row=row_no, username=username, status="error",
+                                                              user_id=user.id, detail="Username already exists")
+                continue
+            results[row_no] = schemas.UserImportRowResult(row=row_no, username=username, status="updated", user_id=user.id)
+            assignments.append((row_no, user.id, user.role, serials))
+            continue
+
+        try:
+            user_data = schemas.UserCreate(**{**row, "username": username})
+        except ValidationError as e:
+            results[row_no] = schemas.UserImportRowResult(row=row_no, username=username or None, status="error",
+                                                          detail="; ".join(err["msg"] for err in e.errors()))
+            continue
+        to_create.append((row_no, user_data))
+
+    # Không bị shed như login, nhưng chỉ chiếm tối đa số worker của executor hash
+    hash_slots = asyncio.Semaphore(auth.password_hasher.max_workers)
+
+    async def hash_password(password: str) -> str:
+        async with hash_slots:
+            return await auth.get_password_hash(password, shed=False)
+
+    hashes = await asyncio.gather(
+        *(hash_password(user_data.password) for _, user_data in to_create),
+        return_exceptions=True
+    )
+    new_users_data, new_rows = [], []
+    for (row_no, user_data), hashed in zip(to_create, hashes):
+        if isinstance(hashed, Exception):
+            results[row_no] = schemas.UserImportRowResult(row=row_no, username=user_data.username, status="error", detail=str(hashed))
+            continue
+        new_users_data.append({
+            "username": user_data.username, "hashed_password": hashed,
+            "role": user_data.role, "full_name": user_data.full_name,
+        })
+        new_rows.append((row_no, user_data))
+
+    if new_users_data:
+        try:
+            created_users = await crud.create_users_bulk(auth_db, new_users_data)
+        except SQLAlchemyError as e:
+            await auth_db.rollback()
+            logger.error(f"User import batch failed: {e}")
+            created_users = []
+            for row_no, user_data in new_rows:
+                results[row_no] = schemas.UserImportRowResult(row=row_no, username=user_data.username,
+                                                              status="error", detail="Database error while creating user")
+        for (row_no, user_data), user in zip(new_rows, created_users):
+            results[row_no] = schemas.UserImportRowResult(row=row_no, username=user.username, status="created", user_id=user.id)
+            if user_data.assigned_devices:
+                assignments.append((row_no, user.id, user.role, user_data.assigned_devices))
+
+    if assignments:
+        try:
+            for row_no, user_id, role, serials in assignments:
+                if role != auth.Role.COORDINATOR:
+                    results[row_no].detail = "Devices can only be assigned to coordinators"
+                    continue
+                assignment = await crud.assign_devices_to_user(devices_db, user_id, serials, commit=False)
+                results[row_no].device_assignment = schemas.DeviceAssignmentResult(**assignment)
+            await devices_db.commit()
+        except SQLAlchemyError as e:
+            await devices_db.rollback()
+            logger.error(f"Device assignment in user import failed: {e}")
+            for row_no, *_ in assignments:
+                results[row_no].device_assignment = None
+                results[row_no].detail = "Database error while assigning devices"
+
+    return [results[row_no] for row_no, _ in batch]
+
+
+async def apply_import(
+    rows: list[dict],
+    auth_db: AsyncSession,
+    devices_db: AsyncSession,
+    batch_size: int = IMPORT_BATCH_SIZE
+) -> schemas.UserImportReport:
+    """Áp dụng các dòng import theo batch, mỗi batch một transaction trên mỗi database."""
+    results: list[schemas.UserImportRowResult] = []
+    seen: set[str] = set()
+    numbered: list[tuple[int, dict]] = []
+
+    # `row` là thứ tự bản ghi trong file, bắt đầu từ 1 (không tính header CSV)
+    for row_no, row in enumerate(rows, start=1):
+        username = str(row.get("username") or "").strip()
+        if username and username in seen:
+            results.append(schemas.UserImportRowResult(row=row_no, username=username, status="error",
+                                                       detail="Duplicate username in import file"))
+            continue
+        seen.add(username)
+        numbered.append((row_no, row))
+
+    for i in range(0, len(numbered), batch_size):
+        results.extend(await _apply_batch(numbered[i:i + batch_size], auth_db, devices_db))
+
+    results.sort(key=lambda r: r.row)
+    return schemas.UserImportReport(
+        total_rows=len(rows),
+        created=sum(1 for r in results if r.status == "created"),
+        updated=sum(1 for r in results if r.status == "updated"),
+        failed=sum(1 for r in results if r.status == "error"),
+        results=results,
+    )
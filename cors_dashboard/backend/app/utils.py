@@ -1,6 +1,11 @@
 # trong file: backend/app/utils.py
 import time
 
+from .metrics import NMEA_SENTENCES
+
+# Loại câu được theo dõi riêng trong metrics; các loại khác gộp thành "other"
+_TRACKED_SENTENCES = frozenset({"GGA", "GSA", "GSV", "RMC", "VTG", "GST", "ZDA"})
+
 class NMEAParser:
     """
     Phiên bản NMEAParser nâng cấp (v2.0)
@@ -22,6 +27,8 @@ class NMEAParser:
         """
         # --- BƯỚC 1: PHÂN TÍCH CÂU RIÊNG LẺ ---
         parsed_result = None
+        message_type = None
+        outcome = "rejected"
         if sentence and sentence.startswith('$') and '*' in sentence:
             try:
                 parts = sentence.split('*')[0].split(',')
@@ -29,13 +36,19 @@ class NMEAParser:
                     message_type = parts[0][3:]
                     if message_type == 'GGA':
                         parsed_result = self._parse_gga(parts)
+                        outcome = "parsed" if parsed_result else "rejected"
                     elif message_type == 'GSA':
                         parsed_result = self._parse_gsa(parts)
+                        outcome = "parsed" if parsed_result else "rejected"
                     elif message_type == 'GSV':
                         # Hàm _parse_gsv giờ chỉ thu thập dữ liệu, không trả về gì cả
                         self._parse_gsv(parts)
+                        outcome = "parsed"
+                    else:
+                        outcome = "ignored"
             except (ValueError, IndexError):
-                pass # Bỏ qua các câu bị lỗi
+                outcome = "rejected" # Bỏ qua các câu bị lỗi
+        NMEA_SENTENCES.labels(message_type if message_type in _TRACKED_SENTENCES else "other", outcome).inc()
 
         # --- BƯỚC 2: KIỂM TRA VÀ GỘP BỘ ĐỆM GSV ---
         # Nếu đã có tin nhắn GSV được xử lý và đã qua 100ms kể từ tin cuối,
@@ -114,8 +127,11 @@ class NMEAParser:
         return {
             "type": "GGA", "timestamp_utc": parts[1],
             "latitude": self._dms_to_dd(parts[2], parts[3]), "longitude": self._dms_to_dd(parts[4], parts[5]),
-            "fix_status": fix_map.get(fix_quality, f"UNKNOWN_{fix_quality}"), "satellites": int(parts[7]),
+            "fix_status": fix_map.get(fix_quality, f"UNKNOWN_{fix_quality}"), "fix_quality": fix_quality,
+            "satellites": int(parts[7]),
             "hdop": float(parts[8]) if parts[8] else 99.99, "altitude": float(parts[9]),
+            # Độ cao geoid so với ellipsoid: cao độ ellipsoid = altitude + geoid_separation
+            "geoid_separation": float(parts[11]) if len(parts) > 11 and parts[11] else None,
         }
 
     def _parse_gsa(self, parts: list) -> dict | None:
@@ -1,5 +1,10 @@
 # backend/app/websocket.py
+import time
 from fastapi import WebSocket
+from .database import settings
+from .metrics import UI_BROADCAST_DURATION, UI_BROADCAST_RECIPIENTS, WEBSOCKET_CONNECTIONS
+
+_ui_connections_gauge = WEBSOCKET_CONNECTIONS.labels("ui")
 
 class ConnectionManager:
     def __init__(self):
@@ -8,12 +13,20 @@ class ConnectionManager:
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
+        _ui_connections_gauge.set(len(self.active_connections))
 
     def disconnect(self, websocket: WebSocket):
         self.active_connections.remove(websocket)
+        _ui_connections_gauge.set(len(self.active_connections))
 
     async def broadcast(self, message: dict):
+        start = time.perf_counter()
+        if settings.WS_INCLUDE_SERVER_TS:
+            # Epoch ms lúc gửi; trình duyệt dùng để báo lại độ trễ đến lúc vẽ xong
+            message = {**message, "server_ts": int(time.time() * 1000)}
         for connection in self.active_connections:
             await connection.send_json(message)
+        UI_BROADCAST_DURATION.observe(time.perf_counter() - start)
+        UI_BROADCAST_RECIPIENTS.observe(len(self.active_connections))
 
 manager = ConnectionManager()
\ No newline at end of file
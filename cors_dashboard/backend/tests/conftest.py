@@ -0,0 +1,21 @@
+# ==============================================================================
+# == backend/tests/conftest.py ==
+# ==============================================================================
+#
+# Settings bắt buộc có giá trị khi import app.*; test không kết nối MQTT/DB thật.
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.mkdtemp(prefix="cors_tests_")
+for name, value in {
+    "MQTT_HOST": "127.0.0.1", "MQTT_PORT": "1883",
+    "DATABASE_URL": f"sqlite+aiosqlite:///{_tmp}/devices.db",
+    "AUTH_DATABASE_URL": f"sqlite+aiosqlite:///{_tmp}/auth.db",
+    "SECRET_KEY": "test", "ALGORITHM": "HS256", "ACCESS_TOKEN_EXPIRE_MINUTES": "5",
+    "SHARED_STATE_DIR": os.path.join(_tmp, "shared"),
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,58 @@
+# ==============================================================================
+# == backend/tests/test_command_builder.py ==
+# ==============================================================================
+
+import random
+
+import pytest
+
+from app import command_builder
+from app.command_builder import build_base_fixed_lla_command, build_base_survey_in_command
+
+import legacy_command_builder as legacy
+
+SENSORS = ("Ublox", "Unicorecomm")
+
+
+def _random_cases(count: int):
+    rng = random.Random(1)
+    for _ in range(count // 4):
+        duration, accuracy = rng.randint(0, 100000), round(rng.uniform(0, 10), 4)
+        lat, lon = rng.uniform(-89, 89), rng.uniform(-179, 179)
+        alt, fixed_accuracy = rng.uniform(-100, 3000), rng.uniform(0, 20)
+        for sensor in SENSORS:
+            yield "survey_in", (sensor, duration, accuracy)
+            yield "fixed_lla", (sensor, lat, lon, alt, fixed_accuracy)
+
+
+def _build(module, operation, args):
+    if operation == "survey_in":
+        return module.build_base_survey_in_command(*args)
+    return module.build_base_fixed_lla_command(*args)
+
+
+def test_matches_legacy_builder_byte_for_byte():
+    mismatches = [
+        (operation, args) for operation, args in _random_cases(8000)
+        if _build(command_builder, operation, args) != _build(legacy, operation, args)
+    ]
+    assert not mismatches[:5]
+
+
+@pytest.mark.parametrize("args", [("Unicorecomm", 300, 0), ("Unicorecomm", 300, 0.0), ("Other", 300, 0)])
+def test_survey_in_edge_cases_match_legacy(args):
+    assert build_base_survey_in_command(*args) == legacy.build_base_survey_in_command(*args)
+
+
+def test_cache_distinguishes_int_and_float():
+    # 60 == 60.0 cùng hash: nếu khóa cache không kèm kiểu, lệnh biên dịch trước sẽ bị trả cho cả hai
+    as_int = build_base_survey_in_command("Unicorecomm", 60, 1)
+    as_float = build_base_survey_in_command("Unicorecomm", 60.0, 1.0)
+    assert as_int == legacy.build_base_survey_in_command("Unicorecomm", 60, 1)
+    assert as_float == legacy.build_base_survey_in_command("Unicorecomm", 60.0, 1.0)
+    assert as_int != as_float
+
+
+def test_fixed_lla_matches_legacy_for_negative_coordinates():
+    args = ("Ublox", -33.8688, -151.2093, -12.5, 2.0)
+    assert build_base_fixed_lla_command(*args) == legacy.build_base_fixed_lla_command(*args)
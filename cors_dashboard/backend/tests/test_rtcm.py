@@ -0,0 +1,243 @@
+# ==============================================================================
+# == backend/tests/test_rtcm.py ==
+# ==============================================================================
+
+import pytest
+
+from app.rtcm import (
+    MAX_FRAME, RtcmDecodeError, RtcmFramer, RtcmMonitor, crc24q, decode_msm_header, decode_station_arp,
+    is_nmea_sentence, rtcm_frame,
+)
+
+# Ví dụ 1005 trong chuẩn RTCM 10403: station 2003, ECEF (1114104.5999, -4850729.7108, 3975521.4643)
+SPEC_1005 = bytes.fromhex("D300133ED7D30202980EDEEF34B4BD62AC0941986F33360B98")
+
+
+class BitWriter:
+    def __init__(self):
+        self.value = 0
+        self.bits = 0
+
+    def put(self, value: int, bits: int):
+        self.value = (self.value << bits) | (value & ((1 << bits) - 1))
+        self.bits += bits
+        return self
+
+    def bytes(self) -> bytes:
+        pad = -self.bits % 8
+        return (self.value << pad).to_bytes((self.bits + pad) // 8, "big")
+
+
+def msm_payload(msg_type: int, station_id: int, epoch: int, satellites: int = 10, signals: int = 2) -> bytes:
+    w = BitWriter()
+    for value, bits in ((msg_type, 12), (station_id, 12), (epoch, 30), (1, 1), (5, 3), (0, 7), (2, 2), (1, 2), (0, 4)):
+        w.put(value, bits)
+    w.put(((1 << satellites) - 1) << (64 - satellites), 64)
+    w.put(((1 << signals) - 1) << (32 - signals), 32)
+    w.put((1 << (satellites * signals)) - 2, satellites * signals)  # mọi cell trừ một
+    return w.bytes() + bytes(40)
+
+
+def collect(framer: RtcmFramer, *chunks) -> list[tuple[int, bytes]]:
+    frames = []
+    for chunk in chunks:
+        framer.feed(chunk, lambda msg_type, payload: frames.append((msg_type, bytes(payload))))
+    return frames
+
+
+# --- CRC-24Q ---
+
+def test_crc24q_matches_spec_frame():
+    assert crc24q(SPEC_1005[:-3]) == int.from_bytes(SPEC_1005[-3:], "big")
+
+
+def test_crc24q_of_whole_frame_is_zero():
+    assert crc24q(SPEC_1005) == 0
+
+
+def test_crc24q_accepts_buffers():
+    body = SPEC_1005[:-3]
+    assert crc24q(bytearray(body)) == crc24q(memoryview(body)) == crc24q(body)
+    assert crc24q(b"") == 0
+
+
+def test_rtcm_frame_round_trip():
+    assert rtcm_frame(SPEC_1005[3:-3]) == SPEC_1005
+    with pytest.raises(ValueError):
+        rtcm_frame(bytes(1024))
+
+
+# --- RtcmFramer.feed ---
+
+def test_feed_whole_frame():
+    framer = RtcmFramer()
+    assert collect(framer, SPEC_1005) == [(1005, SPEC_1005[3:-3])]
+    assert (framer.frames, framer.pending, framer.bytes_discarded) == (1, 0, 0)
+
+
+@pytest.mark.parametrize("split", [1, 2, 3, 10, len(SPEC_1005) - 3, len(SPEC_1005) - 1])
+def test_feed_split_frame(split):
+    framer = RtcmFramer()
+    assert collect(framer, SPEC_1005[:split]) == []
+    assert framer.pending == split
+    assert collect(framer, SPEC_1005[split:]) == [(1005, SPEC_1005[3:-3])]
+    assert framer.pending == 0
+
+
+def test_feed_byte_by_byte():
+    framer = RtcmFramer()
+    frames = collect(framer, *(SPEC_1005[i:i + 1] for i in range(len(SPEC_1005))))
+    assert frames == [(1005, SPEC_1005[3:-3])]
+
+
+def test_feed_skips_garbage_between_frames():
+    msm = rtcm_frame(msm_payload(1077, 7, 1000))
+    garbage = b"junk\x00\xff"
+    framer = RtcmFramer()
+    frames = collect(framer, garbage + SPEC_1005 + garbage + msm + garbage)
+    assert [msg_type for msg_type, _ in frames] == [1005, 1077]
+    assert framer.bytes_discarded == 3 * len(garbage)
+    assert framer.pending == 0
+
+
+def test_feed_skips_preamble_with_reserved_bits_set():
+    framer = RtcmFramer()
+    frames = collect(framer, b"\xd3\xfc\x00" + SPEC_1005)
+    assert [msg_type for msg_type, _ in frames] == [1005]
+    assert framer.crc_errors == 0
+
+
+def test_feed_crc_error_resynchronises():
+    corrupt = bytearray(rtcm_frame(msm_payload(1077, 7, 1000)))
+    corrupt[10] ^= 0xFF
+    assert 0xD3 not in corrupt[1:]
+    framer = RtcmFramer()
+    frames = collect(framer, bytes(corrupt) + SPEC_1005)
+    assert frames == [(1005, SPEC_1005[3:-3])]
+    assert framer.crc_errors == 1
+    assert framer.bytes_discarded == len(corrupt)
+
+
+def test_feed_crc_error_split_across_chunks():
+    corrupt = bytearray(rtcm_frame(msm_payload(1077, 7, 1000)))
+    corrupt[-1] ^= 0x01
+    framer = RtcmFramer()
+    assert collect(framer, bytes(corrupt[:8]), bytes(corrupt[8:]) + SPEC_1005[:5], SPEC_1005[5:]) == [
+        (1005, SPEC_1005[3:-3])
+    ]
+    assert framer.crc_errors == 1
+
+
+def test_feed_false_preamble_in_corrupt_frame_delays_next_frame():
+    # Payload của SPEC_1005 chứa 0xD3 (độ dài 664): sau khi khung hỏng bị bỏ, framer chờ đủ
+    # khung giả đó rồi mới thấy CRC sai và tìm ra khung thật phía sau
+    corrupt = bytearray(SPEC_1005)
+    corrupt[10] ^= 0xFF
+    framer = RtcmFramer()
+    assert collect(framer, bytes(corrupt) + SPEC_1005) == []
+    assert collect(framer, bytes(700)) == [(1005, SPEC_1005[3:-3])]
+    assert framer.crc_errors == 2
+
+
+def test_feed_caps_buffer_for_non_rtcm_stream():
+    framer = RtcmFramer()
+    # Preamble lạc với độ dài tối đa: framer chờ khung, nhưng không giữ quá MAX_FRAME byte
+    collect(framer, b"\xd3\x03\xff" + bytes(20 * 1024))
+    assert framer.pending <= MAX_FRAME
+
+
+def test_discard_drops_pending_bytes():
+    framer = RtcmFramer()
+    collect(framer, b"\xd3\x03\xff" + bytes(10))
+    assert framer.discard() == 13
+    assert framer.pending == 0
+    assert framer.bytes_discarded == 13
+    assert collect(framer, SPEC_1005) == [(1005, SPEC_1005[3:-3])]
+
+
+# --- Giải mã 1005/1006 và MSM ---
+
+def test_decode_station_arp_spec_example():
+    arp = decode_station_arp(SPEC_1005[3:-3])
+    assert arp["message_type"] == 1005
+    assert arp["station_id"] == 2003
+    assert arp["ecef"] == pytest.approx((1114104.5999, -4850729.7108, 3975521.4643), abs=1e-6)
+    assert (arp["gps"], arp["glonass"], arp["galileo"], arp["reference_station"]) == (True, False, False, False)
+    assert arp["antenna_height"] == 0.0
+    assert arp["latitude"] == pytest.approx(38.8047594, abs=1e-6)
+    assert arp["longitude"] == pytest.approx(-77.0647736, abs=1e-6)
+
+
+def test_decode_station_arp_1006_antenna_height():
+    w = BitWriter()
+    for value, bits in ((1006, 12), (42, 12), (0, 6), (1, 1), (1, 1), (1, 1), (0, 1),
+                        (-11141045999, 38), (0, 2), (48507297108, 38), (0, 2), (39755214643, 38), (15000, 16)):
+        w.put(value, bits)
+    arp = decode_station_arp(w.bytes())
+    assert arp["message_type"] == 1006
+    assert arp["ecef"] == pytest.approx((-1114104.5999, 4850729.7108, 3975521.4643), abs=1e-6)
+    assert arp["antenna_height"] == pytest.approx(1.5)
+
+
+def test_decode_station_arp_short_payload():
+    with pytest.raises(RtcmDecodeError):
+        decode_station_arp(SPEC_1005[3:15])
+
+
+def test_decode_msm_header():
+    header = decode_msm_header(msm_payload(1077, 42, 123456789))
+    assert header["constellation"] == "GPS"
+    assert (header["msm"], header["station_id"], header["epoch_ms"]) == (7, 42, 123456789)
+    assert (header["satellites"], header["signals"], header["cells"]) == (10, 2, 19)
+    assert (header["multiple_message"], header["iods"], header["clock_steering"], header["external_clock"]) == (True, 5, 2, 1)
+
+
+def test_decode_msm_header_glonass_epoch():
+    header = decode_msm_header(msm_payload(1087, 42, (3 << 27) | 5000))
+    assert header["constellation"] == "GLONASS"
+    assert header["epoch_ms"] == 5000
+
+
+def test_decode_msm_header_rejects_oversized_cell_mask():
+    with pytest.raises(RtcmDecodeError):
+        decode_msm_header(msm_payload(1127, 1, 0, satellites=20, signals=4)[:30])
+
+
+def test_monitor_decodes_frames_by_type():
+    monitor = RtcmMonitor()
+    assert monitor.feed("S1", SPEC_1005 + rtcm_frame(msm_payload(1097, 2003, 0)), now=0.0) == 2
+    station = monitor.stations["S1"]
+    assert station.station_id == 2003
+    assert station.arp["station_id"] == 2003
+    assert station.msm["Galileo"]["msm"] == 7
+    assert station.decode_errors == 0
+
+
+# --- Phân biệt NMEA / RTCM trên raw_data ---
+
+@pytest.mark.parametrize("payload", [
+    b"$GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*47",
+    b"$GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*47\r\n",
+])
+def test_is_nmea_sentence(payload):
+    assert is_nmea_sentence(payload)
+
+
+@pytest.mark.parametrize("payload", [
+    b"$GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*48",
+    b"$GPGGA,123519,4807.038,N",
+    b"$GPGGA,1*47\r\n$GPGGA,2*47\r\n",
+    SPEC_1005,
+    b"$" + SPEC_1005[1:],
+])
+def test_is_not_nmea_sentence(payload):
+    assert not is_nmea_sentence(payload)
+
+
+def test_monitor_discard_pending():
+    monitor = RtcmMonitor()
+    monitor.feed("S1", b"\xd3\x03\xff", now=0.0)
+    assert monitor.pending("S1") == 3
+    assert monitor.discard_pending("S1") == 3
+    assert monitor.pending("S1") == 0
+    assert monitor.discard_pending("unknown") == 0
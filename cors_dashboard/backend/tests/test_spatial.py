@@ -0,0 +1,158 @@
+# ==============================================================================
+# == backend/tests/test_spatial.py ==
+# ==============================================================================
+#
+# So StationIndex.nearest/within với duyệt toàn bộ trên ~5000 trạm, gồm các cụm
+# quanh kinh tuyến 180 và hai cực.
+
+import math
+import random
+
+import pytest
+
+from app.spatial import StationIndex, _chord2_to_meters, _unit_vector
+
+STATIONS = 5000
+
+
+def _build(cell_degrees: float, seed: int = 7) -> StationIndex:
+    rng = random.Random(seed)
+    index = StationIndex(cell_degrees)
+    for i in range(STATIONS):
+        kind = i % 5
+        if kind == 0:
+            # Cụm vắt qua kinh tuyến 180
+            lat, lon = rng.uniform(-60, 60), rng.choice((1, -1)) * rng.uniform(179.0, 180.0)
+        elif kind == 1:
+            lat, lon = rng.choice((1, -1)) * rng.uniform(85, 90), rng.uniform(-180, 180)
+        elif kind == 2:
+            lat, lon = rng.gauss(21.0, 0.5), rng.gauss(105.8, 0.5)
+        else:
+            lat, lon = math.degrees(math.asin(rng.uniform(-1, 1))), rng.uniform(-180, 180)
+        index.update_fix(f"S{i:05d}", {"latitude": lat, "longitude": lon, "fix_quality": 1})
+    for serial, lat, lon in (("E180", 10.0, 180.0), ("W180", -10.0, -180.0), ("NPOLE", 90.0, 0.0), ("SPOLE", -90.0, 45.0)):
+        index.update_fix(serial, {"latitude": lat, "longitude": lon, "fix_quality": 1})
+    return index
+
+
+def _distance(station, lat: float, lon: float) -> float:
+    qx, qy, qz = _unit_vector(lat, lon)
+    x, y, z = station.vector
+    return _chord2_to_meters((x - qx) ** 2 + (y - qy) ** 2 + (z - qz) ** 2)
+
+
+def _brute_nearest(index: StationIndex, lat: float, lon: float, k: int, predicate=None, max_distance=None):
+    candidates = [
+        (_distance(station, lat, lon), station.serial) for station in index.stations.values()
+        if predicate is None or predicate(station)
+    ]
+    if max_distance is not None:
+        candidates = [item for item in candidates if item[0] <= max_distance]
+    return sorted(candidates)[:k]
+
+
+def _brute_within(index: StationIndex, min_lat, min_lon, max_lat, max_lon, predicate=None):
+    result = set()
+    for station in index.stations.values():
+        if not min_lat <= station.lat <= max_lat:
+            continue
+        if min_lon > max_lon:
+            inside = station.lon >= min_lon or station.lon <= max_lon
+        else:
+            inside = min_lon <= station.lon <= max_lon
+        if inside and (predicate is None or predicate(station)):
+            result.add(station.serial)
+    return result
+
+
+def _assert_same_nearest(got, expected):
+    # So khoảng cách (trạm cách đều nhau có thể đổi thứ tự), và trạm gần hơn hẳn phải khớp
+    assert [round(d, 3) for d, _ in got] == pytest.approx([round(d, 3) for d, _ in expected], abs=1e-3)
+    tied = {serial for d, serial in expected if abs(d - expected[-1][0]) < 1e-3} if expected else set()
+    assert {s.serial for _, s in got} - tied == {serial for _, serial in expected} - tied
+
+
+def _even(station) -> bool:
+    return station.serial.endswith(("0", "2", "4", "6", "8"))
+
+
+@pytest.fixture(scope="module", params=[0.25, 1.0, 10.0], ids=lambda c: f"cell{c}")
+def index(request):
+    return _build(request.param)
+
+
+QUERY_POINTS = [
+    (21.0, 105.8), (0.0, 180.0), (0.0, -180.0), (45.0, 179.99), (-45.0, -179.99), (10.0, 179.5),
+    (89.99, 0.0), (-89.99, 170.0), (90.0, -180.0), (-90.0, 180.0), (0.0, 0.0), (60.0, -179.0),
+]
+
+
+@pytest.mark.parametrize("lat, lon", QUERY_POINTS)
+@pytest.mark.parametrize("k", [1, 7, 40])
+def test_nearest_matches_brute_force(index, lat, lon, k):
+    _assert_same_nearest(index.nearest(lat, lon, k), _brute_nearest(index, lat, lon, k))
+
+
+@pytest.mark.parametrize("lat, lon", QUERY_POINTS)
+def test_nearest_with_predicate_and_max_distance(index, lat, lon):
+    got = index.nearest(lat, lon, 10, predicate=_even, max_distance=500_000)
+    _assert_same_nearest(got, _brute_nearest(index, lat, lon, 10, _even, 500_000))
+
+
+def test_nearest_random_queries(index):
+    rng = random.Random(11)
+    for _ in range(150):
+        lat, lon = math.degrees(math.asin(rng.uniform(-1, 1))), rng.uniform(-180, 180)
+        k = rng.choice((1, 3, 25))
+        _assert_same_nearest(index.nearest(lat, lon, k), _brute_nearest(index, lat, lon, k))
+
+
+def test_nearest_rare_predicate_scans_whole_index(index):
+    rare = {"E180", "SPOLE"}
+    got = index.nearest(21.0, 105.8, 5, predicate=lambda s: s.serial in rare)
+    assert {s.serial for _, s in got} == rare
+
+
+BOXES = [
+    (20.0, 105.0, 22.0, 106.5),
+    (-60.0, 170.0, 60.0, 180.0),       # max_lon = 180: cạnh đông, không phải cột của -180
+    (-60.0, -180.0, 60.0, -170.0),
+    (-60.0, 179.0, 60.0, -179.0),      # vắt qua kinh tuyến 180
+    (0.0, 179.999, 20.0, -179.999),
+    (-90.0, -180.0, 90.0, 180.0),
+    (85.0, -180.0, 90.0, 180.0),
+    (-90.0, 10.0, -85.0, 9.0),         # gần như cả vòng kinh độ
+    (-10.0, 180.0, 10.0, 180.0),
+    (-10.0, -180.0, 10.0, -180.0),
+]
+
+
+@pytest.mark.parametrize("box", BOXES, ids=str)
+def test_within_matches_brute_force(index, box):
+    assert {s.serial for s in index.within(*box)} == _brute_within(index, *box)
+    assert {s.serial for s in index.within(*box, predicate=_even)} == _brute_within(index, *box, _even)
+
+
+def test_within_random_boxes(index):
+    rng = random.Random(13)
+    for _ in range(300):
+        lat_a, lat_b = sorted(rng.uniform(-90, 90) for _ in range(2))
+        min_lon, max_lon = rng.uniform(-180, 180), rng.uniform(-180, 180)
+        assert {s.serial for s in index.within(lat_a, min_lon, lat_b, max_lon)} == _brute_within(
+            index, lat_a, min_lon, lat_b, max_lon
+        )
+
+
+def test_moves_and_removals_keep_index_consistent():
+    index = _build(2.0, seed=3)
+    rng = random.Random(5)
+    serials = sorted(index.stations)
+    for serial in rng.sample(serials, 500):
+        index.update_fix(serial, {"latitude": rng.uniform(-90, 90), "longitude": rng.uniform(-180, 180), "fix_quality": 1})
+    for serial in rng.sample(serials, 300):
+        index.remove(serial)
+    assert sum(len(bucket) for bucket in index.cells.values()) == len(index.stations)
+    for lat, lon in QUERY_POINTS:
+        _assert_same_nearest(index.nearest(lat, lon, 15), _brute_nearest(index, lat, lon, 15))
+    for box in BOXES:
+        assert {s.serial for s in index.within(*box)} == _brute_within(index, *box)
@@ -22,6 +22,11 @@ let ws = null;
 let wsReconnectAttempts = 0;
 const MAX_RECONNECT_ATTEMPTS = 10;
 
+// === ĐO ĐỘ TRỄ VẼ (chỉ khi server gửi kèm server_ts) ===
+let renderLagSamples = [];
+const RENDER_LAG_MAX_SAMPLES = 50;
+const RENDER_LAG_REPORT_INTERVAL_MS = 10000;
+
 // === DASHBOARD STATE & LOGIC  ===
 let currentNmeaData = { gga: null, gsa: null, satellites: {} };
 let skyplotBgCanvas, skyplotBgCtx;
@@ -246,11 +251,15 @@ function connectWebSocket() {
      * Sự kiện được kích hoạt mỗi khi có một tin nhắn mới từ server.
      */
     ws.onmessage = (event) => {
+        const receivedAt = performance.now();
         try {
             // Phân tích chuỗi JSON nhận được thành đối tượng JavaScript
             const message = JSON.parse(event.data);
             // Gọi hàm trung tâm để xử lý tin nhắn
             handleWebSocketMessage(message);
+            if (message.server_ts) {
+                sampleRenderLag(message.server_ts, receivedAt);
+            }
         } catch (e) {
             console.error('Error parsing WebSocket message:', e, 'Data:', event.data);
         }
@@ -290,6 +299,28 @@ function connectWebSocket() {
     };
 }
 
+/**
+ * Ghi lại thời gian từ lúc nhận frame đến khi trình duyệt vẽ xong (frame kế tiếp),
+ * và từ server_ts đến lúc đó. Gửi gộp về server định kỳ qua chính WebSocket.
+ */
+function sampleRenderLag(serverTs, receivedAt) {
+    if (renderLagSamples.length >= RENDER_LAG_MAX_SAMPLES) return;
+    requestAnimationFrame(() => {
+        renderLagSamples.push({
+            render_ms: performance.now() - receivedAt,
+            delivery_ms: Date.now() - serverTs,
+        });
+    });
+}
+
+function reportRenderLag() {
+    if (!renderLagSamples.length || !ws || ws.readyState !== WebSocket.OPEN) return;
+    ws.send(JSON.stringify({ type: 'render_lag', samples: renderLagSamples }));
+    renderLagSamples = [];
+}
+
+setInterval(reportRenderLag, RENDER_LAG_REPORT_INTERVAL_MS);
+
 function handleWebSocketMessage(message) {
     const { type, data, serial } = message;
     let needsFullRender = false;
@@ -22,20 +22,22 @@ document.addEventListener('DOMContentLoaded', () => {
     const deviceChecklist = document.getElementById('device-checklist');
     
     let allDevices = []; // Lưu danh sách tất cả các trạm
+    let usersById = new Map(); // User kèm danh sách trạm đã gán (từ /api/users/overview)
 
-    // Hàm lấy danh sách users và hiển thị
+    // Hàm lấy danh sách users (kèm trạm đã gán) và hiển thị
     async function fetchAndDisplayUsers() {
         try {
-            const response = await fetch('/api/users', { headers: API_HEADERS });
+            const response = await fetch('/api/users/overview', { headers: API_HEADERS });
             if (!response.ok) {
                  if (response.status === 401 || response.status === 403) window.location.href = '/login.html';
                  throw new Error('Không thể lấy danh sách người dùng.');
             }
             const users = await response.json();
+            usersById = new Map(users.map(u => [String(u.id), u]));
             renderUsersTable(users);
         } catch (error) {
             console.error(error);
-            usersTableBody.innerHTML = `<tr><td colspan="6" class="text-center text-danger">${error.message}</td></tr>`;
+            usersTableBody.innerHTML = `<tr><td colspan="7" class="text-center text-danger">${error.message}</td></tr>`;
         }
     }
     
@@ -55,7 +57,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function renderUsersTable(users) {
         usersTableBody.innerHTML = '';
         if (users.length === 0) {
-            usersTableBody.innerHTML = '<tr><td colspan="6" class="text-center text-muted">Chưa có người dùng nào.</td></tr>';
+            usersTableBody.innerHTML = '<tr><td colspan="7" class="text-center text-muted">Chưa có người dùng nào.</td></tr>';
             return;
         }
         users.forEach(user => {
@@ -66,6 +68,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 <td>${user.full_name || ''}</td>
                 <td><span class="badge ${getRoleBadgeClass(user.role)}">${user.role}</span></td>
                 <td><span class="badge ${user.is_active ? 'bg-success' : 'bg-secondary'}">${user.is_active ? 'Active' : 'Inactive'}</span></td>
+                <td>${user.device_count ? `${user.online_count}/${user.device_count} online` : '-'}</td>
                 <td>
                     <button class="btn btn-sm btn-outline-primary edit-btn" data-user-id="${user.id}"><i class="bi bi-pencil-fill"></i></button>
                     <button class="btn btn-sm btn-outline-danger delete-btn" data-user-id="${user.id}" data-username="${user.username}"><i class="bi bi-trash-fill"></i></button>
@@ -101,15 +104,10 @@ document.addEventListener('DOMContentLoaded', () => {
         const userId = editButton.dataset.userId;
         
         try {
-            // Gọi API để lấy thông tin chi tiết user
-            const userResponse = await fetch(`/api/users/${userId}`, { headers: API_HEADERS });
-            if (!userResponse.ok) throw new Error('Không thể lấy thông tin user.');
-            const user = await userResponse.json();
-
-            // Gọi API để lấy các trạm của user này
-            const deviceResponse = await fetch(`/api/devices?user_id=${userId}`, { headers: API_HEADERS });
-            if (!deviceResponse.ok) throw new Error('Không thể lấy danh sách trạm của user.');
-            const userDevices = await deviceResponse.json();
+            // Thông tin user và trạm đã gán có sẵn từ /api/users/overview
+            const user = usersById.get(userId);
+            if (!user) throw new Error('Không thể lấy thông tin user.');
+            const userDevices = user.devices || [];
 
             // === Điền thông tin vào form ===
             document.getElementById('user-id').value = user.id;